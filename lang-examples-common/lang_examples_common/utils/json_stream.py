@@ -0,0 +1,298 @@
+"""
+Incremental parsing of the JSON that LLMs answer with, as it streams in.
+
+LLMs wrap their JSON in code fences or prose, copy the doubled braces of prompt
+templates (`{{"a": 1}}`), and leave trailing commas. `StreamingJsonParser` repairs all
+that on the fly, one character at a time, and hands out each top-level field (or array
+item) as soon as it's complete, parsing only that field's text. So the whole answer is
+parsed once, as it arrives, rather than cleaned up and re-parsed after the fact.
+
+`StreamingJsonOutputParser` is the langchain output parser built on it (see
+`create_chain`). With a pydantic schema, every field is validated as soon as it's
+complete, so a stream with a bad field fails right there, without waiting for the rest.
+"""
+
+import functools
+import json
+from typing import Annotated, Any, AsyncIterator, Iterator
+
+from langchain_core.exceptions import OutputParserException
+from langchain_core.messages import BaseMessage
+from langchain_core.output_parsers import PydanticOutputParser
+from langchain_core.output_parsers.transform import BaseTransformOutputParser
+from langchain_core.outputs import Generation
+from pydantic import BaseModel, TypeAdapter, ValidationError
+
+_OPENING = {"{": "}", "[": "]"}
+_CLOSING = {"}", "]"}
+
+
+class StreamingJsonParser:
+    """
+    Feed it text with `feed`, which returns the top-level fields completed by it, as
+    (key, value) pairs (keys are indexes for a top-level array). Then `close` checks the
+    JSON was complete, and returns the whole object (or array).
+
+    Everything before the first `{` or `[` (e.g. "```json") and after the value closes
+    is ignored. Anything else that isn't JSON (once repaired) raises an
+    `OutputParserException` as soon as it's fed, e.g. a top-level key without quotes
+    (`{abc}`) or without a value (`{"a"}`), or a field with an invalid value.
+    """
+
+    def __init__(self):
+        # the repaired text, as a list of chars (trailing commas are blanked in place)
+        self._out: list[str] = []
+        self._depth = 0
+        self._started = False
+        self.done = False
+        self._is_array = False
+        self._in_string = False
+        self._escaped = False
+        self._last_significant = -1  # index in `_out` of the last non-space char out of strings
+        # doubled braces: None until the char after the first `{` tells us
+        self._doubled: bool | None = None
+        self._skip: str | None = None  # the second brace of a pair, to drop
+        # the top-level field being read
+        self._key_start: int | None = None
+        self._key: Any = None
+        self._value_start: int | None = None
+        # what an object expects next, out of its values: a "key", a "colon", or None
+        # while reading a value (or in an array)
+        self._expect: str | None = None
+        self.fields: dict[Any, Any] = {}
+
+    def feed(self, text: str) -> list[tuple[Any, Any]]:
+        completed = []
+        for char in text:
+            if self.done:
+                break
+            field = self._feed_char(char)
+            if field is not None:
+                completed.append(field)
+        return completed
+
+    def close(self) -> dict | list:
+        if not self._started:
+            raise OutputParserException("No JSON object or array found in the output")
+        if not self.done:
+            raise OutputParserException("The JSON in the output is incomplete")
+        return self.partial()
+
+    def partial(self) -> dict | list:
+        """The fields completed so far, as a dict (or a list, for a top-level array)"""
+        return list(self.fields.values()) if self._is_array else dict(self.fields)
+
+    def _write(self, char: str):
+        self._out.append(char)
+        if not self._in_string and not char.isspace():
+            self._last_significant = len(self._out) - 1
+
+    def _feed_char(self, char: str) -> tuple[Any, Any] | None:
+        if not self._started:
+            if char in _OPENING:
+                self._started = True
+                self._is_array = char == "["
+                self._doubled = False if self._is_array else None
+                self._depth = 1
+                self._write(char)
+                self._value_start = len(self._out) if self._is_array else None
+                self._expect = None if self._is_array else "key"
+            return None
+
+        if self._in_string:
+            self._out.append(char)
+            if self._escaped:
+                self._escaped = False
+            elif char == "\\":
+                self._escaped = True
+            elif char == '"':
+                self._in_string = False
+                self._last_significant = len(self._out) - 1
+                if self._depth == 1 and self._key_start is not None and self._value_start is None:
+                    self._key = json.loads("".join(self._out[self._key_start :]))
+                    self._expect = "colon"
+            return None
+
+        if self._doubled is None:
+            # the first char after the opening brace
+            self._doubled = char == "{"
+            if self._doubled:
+                return None
+        if self._skip is not None:
+            skip, self._skip = self._skip, None
+            if char == skip:
+                return None
+        if self._doubled and char in "{}":
+            self._skip = char
+        if self._expect is not None and not char.isspace():
+            self._check_expected(char)
+
+        if char == '"':
+            self._in_string = True
+            if self._depth == 1 and not self._is_array and self._value_start is None:
+                self._key_start = len(self._out)
+            self._write(char)
+        elif char in _OPENING:
+            self._depth += 1
+            self._write(char)
+        elif char in _CLOSING:
+            if self._last_significant >= 0 and self._out[self._last_significant] == ",":
+                self._out[self._last_significant] = ""  # trailing comma
+            self._depth -= 1
+            if self._depth == 0:
+                field = self._end_field()
+                self._write(char)
+                self.done = True
+                return field
+            self._write(char)
+        elif char == "," and self._depth == 1:
+            field = self._end_field()
+            self._write(char)
+            if self._is_array:
+                self._value_start = len(self._out)
+            else:
+                self._expect = "key"
+            return field
+        elif char == ":" and self._expect == "colon":
+            self._write(char)
+            self._value_start = len(self._out)
+            self._expect = None
+        else:
+            self._write(char)
+        return None
+
+    def _check_expected(self, char: str):
+        # a closing brace is fine instead of a key: the object is empty, or that was a
+        # trailing comma
+        if self._expect == "key" and char not in '"}':
+            message = f"Expected a key in quotes, got {char!r}"
+        elif self._expect == "colon" and char != ":":
+            message = f"Expected ':' after key {self._key!r}, got {char!r}"
+        else:
+            return
+        raise OutputParserException(message, llm_output="".join(self._out))
+
+    def _end_field(self) -> tuple[Any, Any] | None:
+        if self._value_start is None:
+            return None
+        text = "".join(self._out[self._value_start :])
+        self._value_start = None
+        self._key_start = None
+        if self._is_array:
+            if not text.strip():  # empty array, or a trailing comma
+                return None
+            key = len(self.fields)
+        else:
+            key = self._key
+        try:
+            value = json.loads(text)
+        except json.JSONDecodeError as e:
+            raise OutputParserException(f"Invalid JSON for field {key!r}: {e}", llm_output=text) from e
+        self.fields[key] = value
+        return key, value
+
+
+@functools.lru_cache(maxsize=None)
+def _field_adapters(model: type[BaseModel]) -> dict[str, TypeAdapter]:
+    """A validator per field of `model`, by name and by alias"""
+    adapters = {}
+    for name, field in model.model_fields.items():
+        annotation = Annotated[(field.annotation, *field.metadata)] if field.metadata else field.annotation
+        adapters[name] = TypeAdapter(annotation)
+        if field.alias:
+            adapters[field.alias] = adapters[name]
+    return adapters
+
+
+def _text(chunk: str | BaseMessage) -> str:
+    if isinstance(chunk, str):
+        return chunk
+    content = chunk.content
+    if isinstance(content, list):
+        return "".join(part if isinstance(part, str) else part.get("text", "") for part in content)
+    return content
+
+
+class StreamingJsonOutputParser(BaseTransformOutputParser[Any]):
+    """
+    Parses the JSON of an LLM's output, repaired on the fly (see `StreamingJsonParser`),
+    into a dict, or into `pydantic_object` if given.
+
+    When streaming, yields the fields completed so far each time one is (a dict, or a
+    list for a top-level array), and the final result last. With `pydantic_object`, each
+    field is validated as soon as it's complete (for its type and constraints, the whole
+    model is validated at the end), raising an `OutputParserException` that stops the stream.
+    """
+
+    pydantic_object: type[BaseModel] | None = None
+
+    @property
+    def _type(self) -> str:
+        return "streaming_json"
+
+    def get_format_instructions(self) -> str:
+        if self.pydantic_object is None:
+            return "Return a JSON object."
+        return PydanticOutputParser(pydantic_object=self.pydantic_object).get_format_instructions()
+
+    def _check_field(self, key, value):
+        if self.pydantic_object is None:
+            return
+        adapter = _field_adapters(self.pydantic_object).get(key)
+        if adapter is None:
+            return
+        try:
+            adapter.validate_python(value)
+        except ValidationError as e:
+            raise OutputParserException(f"Invalid value for field {key!r}: {e}", llm_output=json.dumps(value)) from e
+
+    def _result(self, parser: StreamingJsonParser):
+        obj = parser.close()
+        if self.pydantic_object is None:
+            return obj
+        try:
+            return self.pydantic_object.model_validate(obj)
+        except ValidationError as e:
+            raise OutputParserException(f"Failed to parse {self.pydantic_object.__name__}: {e}") from e
+
+    def _feed(self, parser: StreamingJsonParser, chunk: str | BaseMessage) -> bool:
+        """Whether `chunk` completed any field"""
+        completed = parser.feed(_text(chunk))
+        for key, value in completed:
+            self._check_field(key, value)
+        return bool(completed)
+
+    def parse(self, text: str):
+        parser = StreamingJsonParser()
+        self._feed(parser, text)
+        return self._result(parser)
+
+    def parse_result(self, result: list[Generation], *, partial: bool = False):
+        """
+        With `partial`, the output may be cut short, so this returns the fields completed
+        so far (None if it isn't valid JSON so far), rather than raising
+        """
+        if not partial:
+            return self.parse(result[0].text)
+        parser = StreamingJsonParser()
+        try:
+            self._feed(parser, result[0].text)
+        except OutputParserException:
+            return None
+        if not parser.done:
+            return parser.partial()
+        return self._result(parser)
+
+    def _transform(self, input: Iterator[str | BaseMessage]) -> Iterator[Any]:
+        parser = StreamingJsonParser()
+        for chunk in input:
+            if self._feed(parser, chunk) and not parser.done:
+                yield parser.partial()
+        yield self._result(parser)
+
+    async def _atransform(self, input: AsyncIterator[str | BaseMessage]) -> AsyncIterator[Any]:
+        parser = StreamingJsonParser()
+        async for chunk in input:
+            if self._feed(parser, chunk) and not parser.done:
+                yield parser.partial()
+        yield self._result(parser)
@@ -1,14 +1,40 @@
+from __future__ import annotations
+
 import os
+from typing import TYPE_CHECKING
 
 import pandas as pd
-from langfuse import Langfuse
-from langfuse.api.resources.commons.types.trace import Trace
+from lang_examples_common.utils.lazy_utils import Lazy
+
+if TYPE_CHECKING:
+    from langfuse import Langfuse
+    from langfuse.api.resources.commons.types.trace import Trace
+
+
+def _create_langfuse() -> Langfuse:
+    from langfuse import Langfuse
+
+    return Langfuse(
+        host=os.environ["LANGFUSE_HOST"],
+        public_key=os.environ["LANGFUSE_PUBLIC_KEY"],
+        secret_key=os.environ["LANGFUSE_SECRET_KEY"],
+    )
+
+
+# created on first use, so importing this module needs neither langfuse's import time
+# nor its env vars
+_langfuse = Lazy(_create_langfuse)
+
+
+def get_langfuse() -> Langfuse:
+    return _langfuse.get()
+
 
-langfuse = Langfuse(
-    host=os.environ["LANGFUSE_HOST"],
-    public_key=os.environ["LANGFUSE_PUBLIC_KEY"],
-    secret_key=os.environ["LANGFUSE_SECRET_KEY"],
-)
+def __getattr__(name):
+    # keeps `from lang_examples_common.utils.langfuse_utils import langfuse` working
+    if name == "langfuse":
+        return get_langfuse()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 def fetch_traces(session_id) -> list[Trace]:
@@ -18,7 +44,7 @@ def fetch_traces(session_id) -> list[Trace]:
     all_traces = []
     for page in range(1, 15):
         # 100 is the max allowed by default. We could increase it if needed
-        traces = langfuse.fetch_traces(session_id=session_id, limit=100, page=page)
+        traces = get_langfuse().fetch_traces(session_id=session_id, limit=100, page=page)
         assert traces.meta.page == page
         all_traces.extend(traces.data)
         if traces.meta.total_pages == traces.meta.page:
@@ -0,0 +1,91 @@
+"""
+Deferred initialization, so importing a module doesn't pay for clients or indexes it
+may never use.
+
+`Lazy(factory)` builds its value on the first `get()` (once, even with many threads
+asking at the same time), and `warm_up()` starts building it in a background thread, for
+processes that know they will need it but don't want to block on it right away.
+
+To check what a module costs to import, in a fresh interpreter:
+    python -m lang_examples_common.utils.lazy_utils lg_tutorials.customer_support.tools.policies
+"""
+
+import logging
+import subprocess
+import sys
+import threading
+from typing import Callable, Generic, TypeVar
+
+T = TypeVar("T")
+
+logger = logging.getLogger(__name__)
+
+
+class Lazy(Generic[T]):
+
+    def __init__(self, factory: Callable[[], T]):
+        self._factory = factory
+        self._value: T | None = None
+        self._initialized = False
+        self._lock = threading.Lock()
+
+    @property
+    def initialized(self) -> bool:
+        return self._initialized
+
+    def get(self) -> T:
+        # fast path, without the lock, once the value is built
+        if self._initialized:
+            return self._value  # type: ignore
+        with self._lock:
+            if not self._initialized:
+                # if the factory raises, nothing is cached, and the next `get` tries again
+                self._value = self._factory()
+                self._initialized = True
+        return self._value  # type: ignore
+
+    def warm_up(self) -> threading.Thread:
+        """
+        Build the value in a daemon thread. A `get` meanwhile waits for it, rather than
+        building it twice. Failures are only logged: the next `get` retries, and raises.
+        """
+
+        def run():
+            try:
+                self.get()
+            except Exception:
+                logger.exception("Background warm-up failed")
+
+        thread = threading.Thread(target=run, name="lazy-warm-up", daemon=True)
+        thread.start()
+        return thread
+
+    def reset(self):
+        """Forget the value, so the next `get` builds it again"""
+        with self._lock:
+            self._value = None
+            self._initialized = False
+
+
+def measure_import_time(module: str, repeat: int = 5) -> float:
+    """
+    Best time, in ms, to import `module` (and everything it imports) in a fresh interpreter,
+    so nothing is already cached in `sys.modules`
+    """
+    code = (
+        "import time; start = time.perf_counter(); "
+        f"import {module}; "
+        "print((time.perf_counter() - start) * 1000)"
+    )
+    times = []
+    for _ in range(repeat):
+        result = subprocess.run(
+            [sys.executable, "-c", code], capture_output=True, text=True, check=True
+        )
+        times.append(float(result.stdout.strip().splitlines()[-1]))
+    return min(times)
+
+
+if __name__ == "__main__":
+    for module in sys.argv[1:]:
+        print(f"{module}: {measure_import_time(module):.1f} ms")
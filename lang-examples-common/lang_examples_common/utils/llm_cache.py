@@ -0,0 +1,155 @@
+"""
+Exact-match cache of LLM responses, in a SQLite file.
+
+Evaluation and regression runs replay the same prompts at temperature 0 over and over,
+paying the full latency and cost of the LLM each time. With `get_chat_llm(..., cache=path)`,
+a repeated call is answered from this cache instead, in about a millisecond.
+
+It's a langchain `BaseCache`, so it works with any chat model (`ChatOpenAI`, `ChatOllama`,
+fakes in tests): langchain calls it with the serialized messages and a description of
+the call (the model's params, for the models that expose them, and any bound tools), and
+both go into the key. `ChatOllama` describes itself with little more than its type, so
+`get_chat_llm` uses a `scoped` view of the cache, adding its model, temperature and
+other params to the key. So a different model, temperature or set of tools is a miss.
+
+The file keeps the `max_entries` most recently used responses.
+"""
+
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass
+from typing import Any, Sequence
+
+from langchain_core.caches import BaseCache
+from langchain_core.messages import message_to_dict, messages_from_dict
+from langchain_core.outputs import ChatGeneration, Generation
+
+
+@dataclass
+class LLMCacheStats:
+    hits: int = 0
+    misses: int = 0
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+
+def _dump(generations: Sequence[Generation]) -> str:
+    return json.dumps(
+        [
+            {"message": message_to_dict(gen.message), "generation_info": gen.generation_info}
+            if isinstance(gen, ChatGeneration)
+            else {"text": gen.text, "generation_info": gen.generation_info}
+            for gen in generations
+        ]
+    )
+
+
+def _load(value: str) -> list[Generation]:
+    return [
+        ChatGeneration(message=messages_from_dict([gen["message"]])[0], generation_info=gen["generation_info"])
+        if "message" in gen
+        else Generation(text=gen["text"], generation_info=gen["generation_info"])
+        for gen in json.loads(value)
+    ]
+
+
+class SQLiteLRUCache(BaseCache):
+
+    def __init__(self, path: str = "llm_cache.sqlite", max_entries: int = 10_000, evict_every: int = 100):
+        self.path = path
+        self.max_entries = max_entries
+        # the file is only trimmed every `evict_every` writes
+        self.evict_every = evict_every
+        self.stats = LLMCacheStats()
+        self._updates = 0
+        # one connection, shared by every thread (langchain runs async lookups in threads)
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode = WAL")
+        self._conn.execute("PRAGMA busy_timeout = 5000")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, value TEXT, last_used REAL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_responses_last_used ON responses (last_used)")
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(prompt: str, llm_string: str) -> str:
+        return hashlib.sha256(f"{llm_string}\0{prompt}".encode()).hexdigest()
+
+    def lookup(self, prompt: str, llm_string: str) -> Sequence[Generation] | None:
+        key = self.key(prompt, llm_string)
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.stats.misses += 1
+                return None
+            self._conn.execute("UPDATE responses SET last_used = ? WHERE key = ?", (time.time(), key))
+            self.stats.hits += 1
+        return _load(row[0])
+
+    def update(self, prompt: str, llm_string: str, return_val: Sequence[Generation]):
+        key = self.key(prompt, llm_string)
+        value = _dump(return_val)
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?)", (key, value, time.time())
+            )
+            self._updates += 1
+            if self._updates % self.evict_every == 0:
+                # drop everything but the `max_entries` most recently used
+                self._conn.execute(
+                    "DELETE FROM responses WHERE key IN "
+                    "(SELECT key FROM responses ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                    (self.max_entries,),
+                )
+
+    def clear(self, **kwargs: Any):
+        with self._lock:
+            self._conn.execute("DELETE FROM responses")
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+    def scoped(self, namespace: str) -> "ScopedCache":
+        """A view of this cache whose keys also include `namespace`"""
+        return ScopedCache(self, namespace)
+
+
+class ScopedCache(BaseCache):
+
+    def __init__(self, cache: SQLiteLRUCache, namespace: str):
+        self.cache = cache
+        self.namespace = namespace
+
+    @property
+    def stats(self) -> LLMCacheStats:
+        return self.cache.stats
+
+    def lookup(self, prompt: str, llm_string: str) -> Sequence[Generation] | None:
+        return self.cache.lookup(prompt, f"{self.namespace}\0{llm_string}")
+
+    def update(self, prompt: str, llm_string: str, return_val: Sequence[Generation]):
+        self.cache.update(prompt, f"{self.namespace}\0{llm_string}", return_val)
+
+    def clear(self, **kwargs: Any):
+        self.cache.clear(**kwargs)
+
+
+_caches: dict[str, SQLiteLRUCache] = {}
+_caches_lock = threading.Lock()
+
+
+def get_llm_cache(path: str = "llm_cache.sqlite") -> SQLiteLRUCache:
+    """The cache for `path`, shared by every model using it in this process"""
+    with _caches_lock:
+        cache = _caches.get(path)
+        if cache is None:
+            cache = _caches[path] = SQLiteLRUCache(path)
+        return cache
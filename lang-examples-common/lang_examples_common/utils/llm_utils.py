@@ -1,21 +1,38 @@
+import asyncio
+import heapq
 import json
 import os
-import re
-from typing import Callable
+import random
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from email.utils import parsedate_to_datetime
+from typing import AsyncIterator, Awaitable, Callable, Iterable, Iterator
 
-import tiktoken
 from dotenv import load_dotenv
 from lang_examples_common.paths import ENV_PATH
-from langchain.output_parsers import PydanticOutputParser
-from langchain.output_parsers.json import SimpleJsonOutputParser
+from lang_examples_common.utils.json_stream import StreamingJsonOutputParser
+from lang_examples_common.utils.lazy_utils import Lazy
+from lang_examples_common.utils.llm_cache import SQLiteLRUCache, get_llm_cache
+from lang_examples_common.utils.token_utils import num_tokens
+from langchain_core.caches import BaseCache
 from langchain_core.prompts import ChatPromptTemplate
-from langchain_core.runnables import RunnableLambda
 from langchain_ollama import ChatOllama
 from langchain_openai import ChatOpenAI
-from langfuse.callback import CallbackHandler
 from pydantic import BaseModel
 
-assert load_dotenv(ENV_PATH, override=True), "Failed to load .env file"
+
+def _load_env() -> bool:
+    assert load_dotenv(ENV_PATH, override=True), "Failed to load .env file"
+    return True
+
+
+# loaded on the first call that needs the env vars, rather than on import
+_env = Lazy(_load_env)
+
+
+def load_env():
+    _env.get()
+
 
 def get_family(model):
     if "llama" in model:
@@ -30,11 +47,24 @@ def get_chat_llm(
     family=None,  # openai, llama
     temperature: float = 0.0,
     max_retries: int = 3,
+    cache: BaseCache | str | bool | None = None,
     **llm_kwargs,
 ):
+    """
+    `cache` is passed to the model as is (a langchain cache, or a bool to use the global
+    one or none), except for a path, to cache its responses in that SQLite file (see
+    `llm_cache`). Only identical calls (messages, model, params and tools) are cached.
+    """
+    load_env()
     if family is None:
         family = get_family(model)
-        
+
+    if isinstance(cache, str):
+        cache = get_llm_cache(cache)
+    if isinstance(cache, SQLiteLRUCache):
+        params = dict(family=family, model=model, temperature=temperature, **llm_kwargs)
+        cache = cache.scoped(json.dumps(params, sort_keys=True, default=str))
+
     if family != "llama":
         env_name = f"{family.upper()}_API_KEY"
         llm_kwargs["api_key"] = os.getenv(env_name)
@@ -50,6 +80,7 @@ def get_chat_llm(
         temperature=temperature,
         max_retries=max_retries,
         request_timeout=60,
+        cache=cache,
         **llm_kwargs,
     )
     return llm
@@ -66,12 +97,14 @@ def create_chain(
     **llm_kwargs,
 ):
     """
-    Create a simple chain `prompt | llm | parser`.
+    Create a simple chain `prompt | llm | parser`, where the parser reads the JSON in
+    the LLM output (repairing code fences, doubled braces and trailing commas) as it
+    streams in (see `json_stream`).
     If pydantic_object is passed, then use it to
         - add `format_instructions` to the prompt
-        - add a PydanticOutputParser to the chain
+        - parse the output into it, validating each field as soon as it's complete
     else:
-        - add a SimpleJsonOutputParser to the chain
+        - parse the output into a dict
     """
     llm = get_chat_llm(model=model_name, family=family, temperature=temperature, **llm_kwargs)
     prompt = ChatPromptTemplate.from_messages(
@@ -82,30 +115,134 @@ def create_chain(
         ]
     ).partial(**partial_kwargs)
 
+    parser = StreamingJsonOutputParser(pydantic_object=pydantic_object)
     if pydantic_object is not None:
-        parser = PydanticOutputParser(pydantic_object=pydantic_object)  # type: ignore
         prompt = prompt.partial(format_instructions=parser.get_format_instructions())
-    else:
-        parser = SimpleJsonOutputParser()
 
-    return prompt | llm | RunnableLambda(postprocess_llm_output) | parser
+    return prompt | llm | parser
 
 
-def postprocess_llm_output(llm_output):
-    new_output = (
-        llm_output.content.replace("{{", "{").replace("}}", "}").replace("\\/", "/")
+def _run_chain(chain, query, config: dict, stream: bool):
+    if not stream:
+        return chain.invoke(dict(query=query), config=config)
+    response = None
+    # the last item is the final output; raising mid-stream stops the generation
+    for response in chain.stream(dict(query=query), config=config):
+        pass
+    return response
+
+
+def _create_langfuse_handler(name: str, session_id: str, tags: list[str]):
+    # langfuse is slow to import, and only needed here
+    from langfuse.callback import CallbackHandler
+
+    session_id = session_id if session_id else "session"
+    # it seems like host needs to be passed and does not get read from env vars.
+    # Tried without it and was getting errors
+    return CallbackHandler(
+        trace_name=name,
+        host=os.environ["LANGFUSE_HOST"],
+        tags=list(tags),  # avoid modifying the original list
+        session_id=session_id,
     )
+
+
+def _retry_after(error: Exception) -> float | None:
+    """Seconds to wait asked by a rate-limit error (e.g. `openai.RateLimitError`), if any"""
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    if "retry-after-ms" in headers:
+        return float(headers["retry-after-ms"]) / 1000
+    value = headers.get("retry-after")
+    if value is None:
+        return None
     try:
-        json.loads(new_output)
-        json_decodable = True
-    except:
-        json_decodable = False
+        return float(value)
+    except ValueError:
+        # it can also be an HTTP date
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+
+
+def _retry_delay(error: Exception, attempt: int, base_delay: float, max_delay: float) -> float:
+    """What the error asks for, or exponential backoff with full jitter, at most `max_delay`"""
+    retry_after = _retry_after(error)
+    if retry_after is not None:
+        return min(max_delay, retry_after)
+    return random.uniform(0, min(max_delay, base_delay * 2**attempt))
+
+
+class _Retries:
+    """
+    The retry logic of `invoke_with_retries`, `invoke_many` and `ainvoke_many`: validating
+    each response, logging (and visualizing) failures, and waiting between attempts
+    (see `_retry_delay`). `run` and `arun` call `attempt(i)` for the i-th attempt, and
+    return its response, or None if all of them failed. `invoke_many` schedules the
+    attempts itself, with `succeeded` and `failed`.
+    """
+
+    def __init__(
+        self,
+        label: str,
+        validator: Callable | None,
+        visualizer: Callable | None,
+        max_retries: int,
+        base_delay: float,
+        max_delay: float,
+        logger: Callable,
+    ):
+        self.label = label
+        self.validator = validator
+        self.visualizer = visualizer
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.logger = logger
 
-    if json_decodable:
-        return new_output
+    def succeeded(self, response, attempt: int):
+        if self.validator is not None:
+            self.validator(response)
+        if attempt > 0:
+            self.logger(f"Success on {self.label} after {attempt} retries")
+        return response
 
-    # remove trailing commas
-    return re.sub(r",\s*([\]}])", r"\1", new_output)
+    def failed(self, error: Exception, response, attempt: int) -> float | None:
+        """Seconds to wait before the next attempt, or None if there are no more"""
+        self.logger(f"{self.label}: {error}")
+        if response and self.visualizer is not None:
+            self.visualizer(response)
+        if attempt + 1 >= self.max_retries:
+            self.logger(f"Failed to get response from LLM for {self.label}")
+            return None
+        self.logger(f"Retrying {self.label} ({attempt + 1}/{self.max_retries})")
+        return _retry_delay(error, attempt, self.base_delay, self.max_delay)
+
+    def run(self, attempt: Callable[[int], object]):
+        for i in range(self.max_retries):
+            response = None
+            try:
+                response = attempt(i)
+                return self.succeeded(response, i)
+            except Exception as e:
+                delay = self.failed(e, response, i)
+                if delay is None:
+                    break
+                time.sleep(delay)
+        return None
+
+    async def arun(self, attempt: Callable[[int], Awaitable], semaphore: asyncio.Semaphore):
+        """Same as `run`, holding `semaphore` during each attempt (but not between them)"""
+        for i in range(self.max_retries):
+            response = None
+            try:
+                async with semaphore:
+                    response = await attempt(i)
+                return self.succeeded(response, i)
+            except Exception as e:
+                delay = self.failed(e, response, i)
+                if delay is None:
+                    break
+                await asyncio.sleep(delay)
+        return None
 
 
 def invoke_with_retries(
@@ -118,57 +255,170 @@ def invoke_with_retries(
     visualizer: Callable | None = None,
     max_retries: int = 5,
     logger: Callable = print,
+    stream: bool = False,
+    base_delay: float = 0.0,
+    max_delay: float = 60.0,
 ):
     """
     Run invoke a max of `max_retries` times, using a `validator` and potentially
     showing failures via the `visualizer`. It logs everything to langfuse, as long
-    as it is enabled.
+    as it is enabled. Between attempts, it waits what a rate-limit error asks for (at
+    most `max_delay`), or else backs off exponentially from `base_delay` (by default,
+    it doesn't wait at all).
+
+    With `stream`, the chain is streamed instead, so a parser that validates as the
+    output arrives (see `create_chain`) stops a bad generation as soon as it sees it,
+    rather than after the whole output.
 
     Returns the response, or None if the chain failed to complete.
     """
+    load_env()
     name = name if name else "chain"
-    session_id = session_id if session_id else "session"
+    langfuse_handler = _create_langfuse_handler(name, session_id, tags)
 
-    # it seems like host needs to be passed and does not get read from env vars.
-    # Tried without it and was getting errors
-    langfuse_handler = CallbackHandler(
-        trace_name=name,
-        host=os.environ["LANGFUSE_HOST"],
-        tags=list(tags),  # avoid modifying the original list
-        session_id=session_id,
-    )
+    def attempt(i):
+        if i > 0:
+            langfuse_handler.trace_name = f"{name} (retry {i})"
+            if "retry" not in langfuse_handler.tags:
+                langfuse_handler.tags.append("retry")
+        return _run_chain(chain, query, dict(callbacks=[langfuse_handler]), stream)
 
-    response = None
-    for i in range(max_retries):
+    retries = _Retries(f"`{name}`", validator, visualizer, max_retries, base_delay, max_delay, logger)
+    return retries.run(attempt)
+
+
+def _item_config(langfuse_handler, name: str, index: int, attempt: int) -> dict:
+    # one handler for the whole batch, so each item is told apart by its run name, and
+    # the handler itself is never modified (items run concurrently)
+    config = dict(callbacks=[langfuse_handler], run_name=f"{name} #{index}")
+    if attempt > 0:
+        config.update(run_name=f"{name} #{index} (retry {attempt})", tags=["retry"])
+    return config
+
+
+def invoke_many(
+    chain,
+    queries: Iterable,
+    validator: Callable | None = None,
+    name: str = "",
+    session_id: str = "",
+    tags: list[str] = [],
+    visualizer: Callable | None = None,
+    max_retries: int = 5,
+    max_concurrency: int = 8,
+    base_delay: float = 1.0,
+    max_delay: float = 60.0,
+    logger: Callable = print,
+) -> Iterator[tuple[int, object]]:
+    """
+    Same as `invoke_with_retries` for each of `queries`, running up to `max_concurrency`
+    at a time (in threads), and waiting between attempts: what a rate-limit error asks
+    for (its retry-after header), or else exponential backoff with jitter, starting at
+    `base_delay`, and never more than `max_delay`. An item waiting to retry is scheduled
+    again rather than sleeping in its thread, so it doesn't count towards
+    `max_concurrency` (like in `ainvoke_many`). All items are logged to langfuse with the
+    same handler.
+
+    Yields (index in `queries`, response or None) as each item completes.
+    """
+    load_env()
+    name = name if name else "chain"
+    langfuse_handler = _create_langfuse_handler(name, session_id, tags)
+    queries = list(queries)
+    retries = [
+        _Retries(f"`{name}` #{index}", validator, visualizer, max_retries, base_delay, max_delay, logger)
+        for index in range(len(queries))
+    ]
+
+    def attempt(index: int, i: int):
+        """(True, the validated response) or (False, (the error, the response if any))"""
+        response = None
         try:
-            response = chain.invoke(
-                dict(query=query), config=dict(callbacks=[langfuse_handler])
-            )
-            if validator is not None:
-                validator(response)
-            if i > 0:
-                logger(f"Success on `{name}` after {i} retries")
-            return response
+            config = _item_config(langfuse_handler, name, index, i)
+            response = chain.invoke(dict(query=queries[index]), config=config)
+            return True, retries[index].succeeded(response, i)
         except Exception as e:
-            logger(str(e))
-            if response and visualizer is not None:
-                visualizer(response)
+            return False, (e, response)
 
-            logger(f"Retrying `{name}` ({i + 1}/{max_retries})")
-            langfuse_handler.trace_name = f"{name} (retry {i + 1})"
-            if "retry" not in langfuse_handler.tags:
-                langfuse_handler.tags.append("retry")
+    # (when it can start, index, attempt) of the attempts not started yet
+    scheduled = [(0.0, index, 0) for index in range(len(queries))]
+    running = {}
+    executor = ThreadPoolExecutor(max_workers=max_concurrency)
+    try:
+        while scheduled or running:
+            now = time.monotonic()
+            while scheduled and scheduled[0][0] <= now and len(running) < max_concurrency:
+                _, index, i = heapq.heappop(scheduled)
+                running[executor.submit(attempt, index, i)] = index, i
+            timeout = None
+            if scheduled and len(running) < max_concurrency:
+                timeout = max(0.0, scheduled[0][0] - now)
+            if not running:
+                # every item left is waiting to retry (`wait` returns at once without futures)
+                time.sleep(timeout)
+                continue
+            done, _ = wait(running, timeout=timeout, return_when=FIRST_COMPLETED)
+            for future in done:
+                index, i = running.pop(future)
+                ok, result = future.result()
+                if ok:
+                    yield index, result
+                    continue
+                delay = retries[index].failed(*result, i)
+                if delay is None:
+                    yield index, None
+                else:
+                    heapq.heappush(scheduled, (time.monotonic() + delay, index, i + 1))
+    finally:
+        # if the caller stops early, the attempts not started yet are dropped
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+async def ainvoke_many(
+    chain,
+    queries: Iterable,
+    validator: Callable | None = None,
+    name: str = "",
+    session_id: str = "",
+    tags: list[str] = [],
+    visualizer: Callable | None = None,
+    max_retries: int = 5,
+    max_concurrency: int = 8,
+    base_delay: float = 1.0,
+    max_delay: float = 60.0,
+    logger: Callable = print,
+) -> AsyncIterator[tuple[int, object]]:
+    """
+    Same as `invoke_many`, with `chain.ainvoke`, in the running event loop. An item
+    waiting to retry doesn't count towards `max_concurrency`.
+    """
+    load_env()
+    name = name if name else "chain"
+    langfuse_handler = _create_langfuse_handler(name, session_id, tags)
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def run(index, query):
+        def attempt(i):
+            return chain.ainvoke(dict(query=query), config=_item_config(langfuse_handler, name, index, i))
 
-    logger("Failed to get response from LLM")
-    return None
+        label = f"`{name}` #{index}"
+        retries = _Retries(label, validator, visualizer, max_retries, base_delay, max_delay, logger)
+        return index, await retries.arun(attempt, semaphore)
+
+    tasks = [asyncio.ensure_future(run(index, query)) for index, query in enumerate(queries)]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            yield await next_done
+    finally:
+        # if the caller stops early, don't leave the rest running
+        for task in tasks:
+            task.cancel()
 
 
 def num_tokens_from_string(string: str, encoding_name: str = "ada") -> int:
     """
     Returns the number of tokens in a text string.
-    "ada" uses "cl100k_base", which works for text-embedding-ada-002, gpt-3.5-turbo and gpt-4
-    See https://github.com/openai/openai-cookbook/blob/main/examples/How_to_count_tokens_with_tiktoken.ipynb
+    `encoding_name` is a model ("ada" uses "r50k_base", "gpt-4" uses "cl100k_base") or an
+    encoding. To count many strings, `token_utils.num_tokens_batch` is much faster.
     """
-    encoding = tiktoken.encoding_for_model(encoding_name)
-    num_tokens = len(encoding.encode(string))
-    return num_tokens
+    return num_tokens(string, encoding_name)
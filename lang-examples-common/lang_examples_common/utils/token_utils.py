@@ -0,0 +1,104 @@
+"""
+Token counting with tiktoken.
+
+`tiktoken.encoding_for_model` resolves the model name and takes a lock on every call,
+which adds up when counting one short text at a time, so encodings are cached per model,
+for the whole process.
+`num_tokens_batch` counts many texts at once, over several threads (tiktoken releases the
+GIL while encoding), which is what to use over whole datasets of prompts or traces.
+
+`num_tokens_messages` estimates the prompt tokens of a chat, including what the chat
+format adds per message, following
+https://github.com/openai/openai-cookbook/blob/main/examples/How_to_count_tokens_with_tiktoken.ipynb
+"""
+
+import functools
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable
+
+import tiktoken
+from langchain_core.messages import BaseMessage
+from langchain_core.prompt_values import PromptValue
+
+# what the chat format adds to each message, to a message with a name, and to the prompt
+# (to prime the reply), for the current OpenAI chat models
+TOKENS_PER_MESSAGE = 3
+TOKENS_PER_NAME = 1
+TOKENS_PER_REPLY = 3
+
+DEFAULT_NUM_THREADS = 8
+# below this many texts per thread, threads cost more than they save
+MIN_TEXTS_PER_THREAD = 100
+
+
+@functools.lru_cache(maxsize=None)
+def get_encoding(model: str = "ada") -> tiktoken.Encoding:
+    """Encoding of `model`, which can also be the name of an encoding (e.g. "cl100k_base")"""
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding(model)
+
+
+def num_tokens(text: str, model: str = "ada") -> int:
+    return len(get_encoding(model).encode(text))
+
+
+def num_tokens_batch(
+    texts: Iterable[str], model: str = "ada", num_threads: int = DEFAULT_NUM_THREADS
+) -> list[int]:
+    """
+    Number of tokens of each of `texts`, split in a chunk per thread (up to `num_threads`,
+    and the number of CPUs). Unlike `Encoding.encode_batch`, which submits a task per
+    text, the threading overhead doesn't grow with the number of texts.
+    """
+    encoding = get_encoding(model)
+    texts = list(texts)
+    num_threads = min(num_threads, os.cpu_count() or 1, len(texts) // MIN_TEXTS_PER_THREAD)
+
+    def count(chunk: list[str]) -> list[int]:
+        return [len(encoding.encode(text)) for text in chunk]
+
+    if num_threads <= 1:
+        return count(texts)
+    size = -(-len(texts) // num_threads)  # ceil
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        counts = executor.map(count, [texts[start : start + size] for start in range(0, len(texts), size)])
+        return [n for chunk in counts for n in chunk]
+
+
+def _message_parts(message) -> tuple[str, str | None]:
+    """(text to count, name) of a message, as a langchain message or an OpenAI-style dict"""
+    if isinstance(message, BaseMessage):
+        content, name = message.content, message.name
+        tool_calls = getattr(message, "tool_calls", None)
+    else:
+        content, name = message.get("content") or "", message.get("name")
+        tool_calls = message.get("tool_calls")
+    if isinstance(content, list):
+        content = "".join(part if isinstance(part, str) else part.get("text", "") for part in content)
+    if tool_calls:
+        content += json.dumps(tool_calls, default=str)
+    return content, name
+
+
+def num_tokens_messages(
+    messages: PromptValue | Iterable, model: str = "gpt-4o", num_threads: int = DEFAULT_NUM_THREADS
+) -> int:
+    """
+    Estimated prompt tokens of `messages`: a prompt value (e.g. what a `ChatPromptTemplate`
+    returns), langchain messages, or OpenAI-style dicts with "content" (and maybe "name")
+    """
+    if isinstance(messages, PromptValue):
+        messages = messages.to_messages()
+    parts = [_message_parts(message) for message in messages]
+    names = [name for _, name in parts if name]
+    counts = num_tokens_batch([content for content, _ in parts] + names, model, num_threads)
+    return (
+        sum(counts)
+        + TOKENS_PER_MESSAGE * len(parts)
+        + TOKENS_PER_NAME * len(names)
+        + TOKENS_PER_REPLY
+    )
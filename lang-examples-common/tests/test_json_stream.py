@@ -0,0 +1,64 @@
+import pytest
+from langchain_core.exceptions import OutputParserException
+from langchain_core.outputs import Generation
+from lang_examples_common.utils.json_stream import StreamingJsonOutputParser, StreamingJsonParser
+from pydantic import BaseModel
+
+
+class Answer(BaseModel):
+    name: str
+    count: int
+
+
+@pytest.mark.parametrize(
+    "text, expected",
+    [
+        ('```json\n{"a": 1, "b": [1, {"c": 2}],}\n```', {"a": 1, "b": [1, {"c": 2}]}),
+        ('{{"a": {{"b": 1}}}}', {"a": {"b": 1}}),
+        ('Sure: {"a": "x,}"} Anything else?', {"a": "x,}"}),
+        ("{ }", {}),
+        ("[1, 2,]", [1, 2]),
+    ],
+    ids=["fences and trailing comma", "doubled braces", "prose", "empty", "array"],
+)
+def test_repairs(text, expected):
+    assert StreamingJsonOutputParser().parse(text) == expected
+
+
+@pytest.mark.parametrize(
+    "text",
+    ["{abc}", '{"a"}', '{"a" 1}', '{"a":}', '{"a": 1 "b": 2}', '{"a": 1, b: 2}', "[abc]", '{"a": 1', "no JSON"],
+)
+def test_invalid_output_raises(text):
+    with pytest.raises(OutputParserException):
+        StreamingJsonOutputParser().parse(text)
+
+
+def test_fails_as_soon_as_the_output_is_invalid():
+    parser = StreamingJsonParser()
+    assert parser.feed('{"name": "x", ') == [("name", "x")]
+    with pytest.raises(OutputParserException, match="Expected a key"):
+        parser.feed("count: 1}")
+
+
+def test_stream_validates_each_field():
+    parser = StreamingJsonOutputParser(pydantic_object=Answer)
+    chunks = ['{"name": ', '"x", "count"', ': 2}']
+    assert list(parser.transform(iter(chunks))) == [{"name": "x"}, Answer(name="x", count=2)]
+    with pytest.raises(OutputParserException, match="count"):
+        list(parser.transform(iter(['{"name": "x", "count": "many"}'])))
+
+
+def test_stream_array():
+    parser = StreamingJsonOutputParser()
+    chunks = ["[1, ", '{"a": 2}, ', "3]"]
+    assert list(parser.transform(iter(chunks))) == [[1], [1, {"a": 2}], [1, {"a": 2}, 3]]
+    assert parser.parse_result([Generation(text="[1, 2")], partial=True) == [1]
+
+
+def test_partial_results():
+    parser = StreamingJsonOutputParser()
+    assert parser.parse_result([Generation(text='{"a": 1, "b": [')], partial=True) == {"a": 1}
+    assert parser.parse_result([Generation(text='{"a"}')], partial=True) is None
+    with pytest.raises(OutputParserException):
+        parser.parse_result([Generation(text='{"a": 1, "b": [')])
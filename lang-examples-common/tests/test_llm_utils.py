@@ -0,0 +1,117 @@
+import asyncio
+import time
+
+import pytest
+from lang_examples_common.utils import llm_utils
+
+
+class FakeHandler:
+    def __init__(self, trace_name: str, tags: list[str]):
+        self.trace_name = trace_name
+        self.tags = tags
+
+
+class RateLimited(Exception):
+    def __init__(self, retry_after: str):
+        super().__init__("rate limited")
+        self.response = type("Response", (), {"headers": {"retry-after": retry_after}})()
+
+
+class FakeChain:
+    """Fails the first `failures[query]` calls for each query, asking to wait an hour"""
+
+    def __init__(self, failures: dict, delay: float = 0.0):
+        self.failures = dict(failures)
+        self.delay = delay
+        self.calls: list[tuple[str, dict]] = []
+
+    def _answer(self, query: str, config: dict):
+        self.calls.append((query, config))
+        if self.failures.get(query, 0) > 0:
+            self.failures[query] -= 1
+            raise RateLimited("3600")
+        return {"answer": query}
+
+    def invoke(self, inputs: dict, config: dict):
+        return self._answer(inputs["query"], config)
+
+    async def ainvoke(self, inputs: dict, config: dict):
+        await asyncio.sleep(self.delay)
+        return self._answer(inputs["query"], config)
+
+
+@pytest.fixture(autouse=True)
+def no_langfuse(monkeypatch):
+    monkeypatch.setattr(llm_utils, "load_env", lambda: None)
+    monkeypatch.setattr(
+        llm_utils, "_create_langfuse_handler", lambda name, session_id, tags: FakeHandler(name, list(tags))
+    )
+
+
+def test_retry_delay_is_capped():
+    assert llm_utils._retry_delay(RateLimited("3600"), 0, base_delay=1.0, max_delay=0.5) == 0.5
+    assert llm_utils._retry_delay(RateLimited("0.1"), 0, base_delay=1.0, max_delay=0.5) == 0.1
+    assert 0 <= llm_utils._retry_delay(ValueError(), 10, base_delay=1.0, max_delay=0.5) <= 0.5
+
+
+def test_invoke_with_retries():
+    chain = FakeChain({})
+    seen = []
+
+    def validator(response):
+        seen.append(response)
+        if len(seen) < 3:
+            raise ValueError("not yet")
+
+    logs = []
+    response = llm_utils.invoke_with_retries(chain, "q", validator=validator, name="test", logger=logs.append)
+    assert response == {"answer": "q"}
+    assert len(chain.calls) == 3
+    handler = chain.calls[-1][1]["callbacks"][0]
+    assert handler.trace_name == "test (retry 2)"
+    assert handler.tags == ["retry"]
+    assert logs[-1] == "Success on `test` after 2 retries"
+
+    chain = FakeChain({"q": 10})
+    assert llm_utils.invoke_with_retries(chain, "q", max_retries=3, max_delay=0.01, logger=lambda _: None) is None
+    assert len(chain.calls) == 3
+
+
+def test_invoke_many_retries():
+    chain = FakeChain({"a": 2, "c": 5})
+    start = time.monotonic()
+    results = dict(
+        llm_utils.invoke_many(chain, ["a", "b", "c"], max_retries=3, max_delay=0.01, logger=lambda _: None)
+    )
+    # the hour asked by the rate limit is capped to `max_delay`
+    assert time.monotonic() - start < 5
+    assert results == {0: {"answer": "a"}, 1: {"answer": "b"}, 2: None}
+    run_names = sorted(config["run_name"] for query, config in chain.calls if query == "a")
+    assert run_names == ["chain #0", "chain #0 (retry 1)", "chain #0 (retry 2)"]
+
+
+def test_invoke_many_releases_slot_while_waiting():
+    chain = FakeChain({"a": 1})
+    results = list(
+        llm_utils.invoke_many(chain, ["a", "b"], max_concurrency=1, max_delay=0.2, logger=lambda _: None)
+    )
+    # "b" runs while "a" waits to retry, rather than after it
+    assert results == [(1, {"answer": "b"}), (0, {"answer": "a"})]
+    assert [query for query, config in chain.calls] == ["a", "b", "a"]
+
+
+def test_ainvoke_many_releases_slot_while_waiting():
+    chain = FakeChain({"a": 1}, delay=0.01)
+
+    async def collect():
+        return [
+            item
+            async for item in llm_utils.ainvoke_many(
+                chain, ["a", "b"], max_concurrency=1, base_delay=0.0, max_delay=1.0, logger=lambda _: None
+            )
+        ]
+
+    results = asyncio.run(collect())
+    # "b" runs while "a" waits to retry, rather than after it
+    assert results == [(1, {"answer": "b"}), (0, {"answer": "a"})]
+    assert [query for query, config in chain.calls] == ["a", "b", "a"]
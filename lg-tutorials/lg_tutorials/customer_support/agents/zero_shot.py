@@ -6,6 +6,7 @@ from langchain_community.tools.tavily_search import TavilySearchResults
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.runnables import Runnable, RunnableConfig
 from langgraph.graph.message import AnyMessage, add_messages
+from lg_tutorials.customer_support.context_window import DEFAULT_MODEL, fit_messages
 from lg_tutorials.customer_support.tools.car_rental import (
     book_car_rental,
     cancel_car_rental,
@@ -22,6 +23,7 @@ from lg_tutorials.customer_support.tools.flights import (
     cancel_ticket,
     fetch_user_flight_information,
     search_flights,
+    search_itineraries,
     update_ticket_to_new_flight,
 )
 from lg_tutorials.customer_support.tools.hotels import (
@@ -39,6 +41,7 @@ class Assistant:
         TavilySearchResults(max_results=1),
         fetch_user_flight_information,
         search_flights,
+        search_itineraries,
         update_ticket_to_new_flight,
         cancel_ticket,
         lookup_policy,
@@ -62,7 +65,19 @@ class Assistant:
                 \n\nCurrent user:\n<User>\n{user_info}\n</User>
                 \nCurrent time: {time}."""
 
-    def __init__(self, llm, system_message: Optional[str] = None, invoke_config: Optional[str] = None):
+    def __init__(
+        self,
+        llm,
+        system_message: Optional[str] = None,
+        invoke_config: Optional[str] = None,
+        max_history_tokens: Optional[int] = 8000,
+        max_tool_output_tokens: int = 200,
+    ):
+        """
+        The history sent on each turn is kept within `max_history_tokens` (None to send all
+        of it), cutting old tool results to `max_tool_output_tokens` (see `context_window`).
+        Tokens are counted with the encoding of `llm`'s model
+        """
         primary_assistant_prompt = ChatPromptTemplate.from_messages(
             [
                 ("system", system_message or self.system_message),
@@ -71,8 +86,17 @@ class Assistant:
         ).partial(time=datetime.now)
         self.runnable = primary_assistant_prompt | llm.bind_tools(self.part_1_tools)
         self.invoke_config = invoke_config or dict()
+        self.max_history_tokens = max_history_tokens
+        self.max_tool_output_tokens = max_tool_output_tokens
+        # `model_name` for OpenAI models, `model` for Ollama ones
+        self.token_model = getattr(llm, "model_name", None) or getattr(llm, "model", None) or DEFAULT_MODEL
 
     def __call__(self, state: SimpleState, config: RunnableConfig):
+        if self.max_history_tokens is not None:
+            messages = fit_messages(
+                state["messages"], self.max_history_tokens, self.max_tool_output_tokens, self.token_model
+            )
+            state = {**state, "messages": messages}
         # Run a while True to re-run the assistant until it returns a non-empty response.
         while True:
             configuration = config.get("configurable", {})
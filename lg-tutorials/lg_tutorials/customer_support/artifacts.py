@@ -0,0 +1,191 @@
+"""
+Download (and cache) the artifacts the tutorial needs: the travel DB and the policies FAQ.
+
+Downloads are streamed to disk in chunks, so memory stays flat no matter the file size,
+and resumed with a `Range` request if a previous attempt was interrupted. The resumed
+request carries an `If-Range` with the `ETag` (or `Last-Modified`) the download started
+with, so if the file changed meanwhile the server sends it whole, rather than the rest of
+a different version. Finished files live in a content-addressed cache (`objects/<sha256>`),
+shared by every process pointing to the same `cache_dir`, so a new worker doesn't fetch
+again what another one already has. With `refresh=True`, the cached copy is revalidated
+with a conditional request, which only downloads the file again if it changed.
+
+    cache_dir/
+        objects/<sha256>         the downloaded files, named by their content hash
+        urls/<sha256 of url>     the content hash last downloaded for that url, with its
+                                 `ETag` and `Last-Modified` (as JSON)
+        partial/<...>.part       in-progress downloads
+        partial/<...>.part.json  the `ETag` and `Last-Modified` they started with
+        locks/<...>.lock         so that only one process downloads a given url at a time
+"""
+
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+from contextlib import contextmanager
+from pathlib import Path
+
+import requests
+
+CACHE_DIR = Path(os.environ.get("LG_TUTORIALS_CACHE", Path.home() / ".cache" / "lg-tutorials"))
+CHUNK_SIZE = 1024 * 1024
+
+
+def _sha256(text: str) -> str:
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+def _write_atomic(path: Path, data: str):
+    with tempfile.NamedTemporaryFile("w", dir=path.parent, delete=False) as f:
+        f.write(data)
+    os.replace(f.name, path)
+
+
+@contextmanager
+def _locked(path: Path):
+    with open(path, "w") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _read_json(path: Path) -> dict:
+    return json.loads(path.read_text()) if path.exists() else {}
+
+
+def _url_index(cache_dir: Path, url: str) -> dict:
+    """What the cache knows of `url`: the "sha256", "etag" and "last_modified" of its last download"""
+    path = cache_dir / "urls" / _sha256(url)
+    if not path.exists():
+        return {}
+    text = path.read_text().strip()
+    # older caches only stored the hash
+    return json.loads(text) if text.startswith("{") else {"sha256": text}
+
+
+def _cached_object(cache_dir: Path, url: str, sha256: str | None) -> Path | None:
+    if sha256 is None:
+        sha256 = _url_index(cache_dir, url).get("sha256")
+        if sha256 is None:
+            return None
+    path = cache_dir / "objects" / sha256
+    return path if path.exists() else None
+
+
+def _validators(response: requests.Response) -> dict:
+    return {"etag": response.headers.get("ETag"), "last_modified": response.headers.get("Last-Modified")}
+
+
+def _range_validator(validators: dict) -> str | None:
+    """What to send as `If-Range`, which doesn't take weak ETags"""
+    etag = validators.get("etag")
+    if etag and not etag.startswith("W/"):
+        return etag
+    return validators.get("last_modified")
+
+
+def _hash_file(path: Path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(CHUNK_SIZE):
+            digest.update(chunk)
+    return digest
+
+
+def _download(url: str, part: Path, session: requests.Session, cached: dict | None = None) -> dict | None:
+    """
+    Download `url` into `part`, resuming from whatever is there, if the server can tell
+    it's still the same file. Returns the "sha256", "etag" and "last_modified" of the
+    download. Given the url index of a `cached` copy, the request is conditional, and
+    returns None if the file didn't change since.
+    """
+    meta = part.with_name(f"{part.name}.json")
+    offset = part.stat().st_size if part.exists() else 0
+    started = _read_json(meta) if offset else {}
+    validator = _range_validator(started)
+    headers = {}
+    if offset and validator:
+        headers = {"Range": f"bytes={offset}-", "If-Range": validator}
+    elif cached:
+        if cached.get("etag"):
+            headers["If-None-Match"] = cached["etag"]
+        if cached.get("last_modified"):
+            headers["If-Modified-Since"] = cached["last_modified"]
+
+    with session.get(url, headers=headers, stream=True, timeout=60) as response:
+        if response.status_code == 304:
+            return None
+        if "Range" in headers and response.status_code == 416:
+            # Range not satisfiable: the partial file is already complete
+            return {"sha256": _hash_file(part).hexdigest(), **started}
+        response.raise_for_status()
+        if "Range" in headers and response.status_code == 206:
+            digest = _hash_file(part)
+            validators = started
+        else:
+            # the file changed (or the server ignored the Range header, or there was
+            # nothing to resume), so it starts over
+            digest = hashlib.sha256()
+            offset = 0
+            validators = _validators(response)
+            _write_atomic(meta, json.dumps(validators))
+
+        with open(part, "ab" if offset else "wb") as f:
+            for chunk in response.iter_content(CHUNK_SIZE):
+                f.write(chunk)
+                digest.update(chunk)
+    return {"sha256": digest.hexdigest(), **validators}
+
+
+def fetch_artifact(
+    url: str,
+    dest: str | Path,
+    sha256: str | None = None,
+    cache_dir: str | Path = CACHE_DIR,
+    session: requests.Session | None = None,
+    refresh: bool = False,
+) -> Path:
+    """
+    Make sure `dest` holds the file at `url`, downloading it only if it isn't cached yet
+    or, with `refresh`, if it changed since it was (unless `sha256` pins its content).
+    If `sha256` is given, the download is checked against it. `dest` gets a copy of the
+    cached object (never a link, as callers may modify it), written atomically.
+    """
+    cache_dir = Path(cache_dir)
+    for subdir in ("objects", "urls", "partial", "locks"):
+        (cache_dir / subdir).mkdir(parents=True, exist_ok=True)
+    refresh = refresh and sha256 is None
+
+    obj = _cached_object(cache_dir, url, sha256)
+    if obj is None or refresh:
+        key = _sha256(url)
+        with _locked(cache_dir / "locks" / f"{key}.lock"):
+            # someone else may have finished the download while we waited for the lock
+            obj = _cached_object(cache_dir, url, sha256)
+            if obj is None or refresh:
+                part = cache_dir / "partial" / f"{key}.part"
+                cached = _url_index(cache_dir, url) if obj is not None else None
+                downloaded = _download(url, part, session or requests.Session(), cached)
+                if downloaded is not None:
+                    meta = part.with_name(f"{part.name}.json")
+                    digest = downloaded["sha256"]
+                    if sha256 is not None and digest != sha256:
+                        part.unlink()
+                        meta.unlink(missing_ok=True)
+                        raise ValueError(f"Checksum mismatch for {url}: expected {sha256}, got {digest}")
+                    obj = cache_dir / "objects" / digest
+                    os.replace(part, obj)
+                    meta.unlink(missing_ok=True)
+                    _write_atomic(cache_dir / "urls" / key, json.dumps(downloaded))
+
+    dest = Path(dest)
+    with tempfile.NamedTemporaryFile(dir=dest.parent, delete=False) as f:
+        with open(obj, "rb") as src:
+            shutil.copyfileobj(src, f, CHUNK_SIZE)
+    os.replace(f.name, dest)
+    return dest
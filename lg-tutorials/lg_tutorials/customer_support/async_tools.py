@@ -0,0 +1,80 @@
+"""
+Async execution of the customer support tools.
+
+When the LLM asks for several tools at once (e.g. `search_hotels`, `search_car_rentals`
+and `lookup_policy`), `ToolNode` runs them concurrently on the async path, so the turn
+takes as long as the slowest call rather than the sum of all of them. For that, every
+tool needs a coroutine: `db_tool` gives the SQLite-backed ones a coroutine that runs the
+(blocking) function on `db_executor`, a thread pool sized like the connection pools, so
+threads don't pile up waiting for a connection. `lookup_policy` has its own, native one.
+
+`limit_session_concurrency` caps how many tool calls of the same conversation (i.e.
+`thread_id`) run at the same time, so one session fanning out can't take every thread.
+"""
+
+import asyncio
+import contextvars
+import functools
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+
+from langchain_core.runnables import ensure_config
+from langchain_core.tools import BaseTool, StructuredTool
+from lg_tutorials.customer_support.db_pool import POOL_SIZE
+
+# as many threads as connections in a pool, so they never wait for one
+DB_EXECUTOR_WORKERS = POOL_SIZE
+
+db_executor = ThreadPoolExecutor(max_workers=DB_EXECUTOR_WORKERS, thread_name_prefix="db")
+
+
+async def run_in_db_executor(func: Callable, *args, **kwargs):
+    """
+    Run `func` on `db_executor`, with a copy of the current context, so context variables
+    (e.g. the config langchain keeps for callbacks and tracing) are still set there.
+    """
+    context = contextvars.copy_context()
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(db_executor, functools.partial(context.run, func, *args, **kwargs))
+
+
+def db_tool(func: Callable) -> StructuredTool:
+    """Same as `@tool`, but with a coroutine running `func` on `db_executor`"""
+
+    @functools.wraps(func)
+    async def coroutine(*args, **kwargs):
+        return await run_in_db_executor(func, *args, **kwargs)
+
+    return StructuredTool.from_function(func=func, coroutine=coroutine)
+
+
+# thread_id -> semaphore, dropped once no call of that session holds a reference to it
+_session_semaphores: weakref.WeakValueDictionary = weakref.WeakValueDictionary()
+
+
+def limit_session_concurrency(tools: list[BaseTool], max_concurrency: int) -> list[BaseTool]:
+    """
+    Copies of `tools` whose async calls run at most `max_concurrency` at a time per
+    session (`config["configurable"]["thread_id"]`, calls without one share a single
+    limit). Tools without a coroutine are returned as they are.
+    """
+    limited = []
+    for tool in tools:
+        coroutine = getattr(tool, "coroutine", None)
+        if coroutine is None:
+            limited.append(tool)
+            continue
+
+        @functools.wraps(coroutine)
+        async def limited_coroutine(*args, _coroutine=coroutine, **kwargs):
+            thread_id = ensure_config().get("configurable", {}).get("thread_id")
+            key = (thread_id, max_concurrency)
+            semaphore = _session_semaphores.get(key)
+            if semaphore is None:
+                semaphore = _session_semaphores[key] = asyncio.Semaphore(max_concurrency)
+            async with semaphore:
+                return await _coroutine(*args, **kwargs)
+
+        limited.append(tool.model_copy(update={"coroutine": limited_coroutine}))
+    return limited
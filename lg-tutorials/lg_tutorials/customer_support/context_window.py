@@ -0,0 +1,132 @@
+"""
+Keep the history sent to the LLM within a token budget.
+
+A long support session piles up tool results (flight searches, ticket details) that the
+LLM only needed for the turn that asked for them, and sending all of them on every turn
+makes prompts (and latency) grow with the length of the conversation. `fit_messages`
+works on the history before each LLM call:
+
+- tool results from previous turns (before the last human message) are cut down to
+  `max_tool_output_tokens`, with a note saying how much was left out;
+- if that's still over `max_tokens`, the oldest turns are dropped.
+
+Turns (a human message and everything up to the next one) are kept or dropped whole, so
+the history always starts with a human message, and an AI message with tool calls is
+never separated from its tool results, as providers reject a tool result without its
+call (and the other way round). The current turn is never touched.
+
+Tokens are counted with the encoding of the model the history is sent to (or that of
+`DEFAULT_MODEL`, as an estimate, for models tiktoken doesn't know, e.g. llama ones).
+Counts are cached per message (by model, id and content), so each message is counted
+once, however many turns it stays in the history.
+"""
+
+import functools
+import json
+import threading
+from collections import OrderedDict
+
+from lang_examples_common.utils.token_utils import TOKENS_PER_MESSAGE, get_encoding, num_tokens
+from langchain_core.messages import BaseMessage, HumanMessage, ToolMessage
+
+_token_counts: OrderedDict[tuple, int] = OrderedDict()
+_token_counts_lock = threading.Lock()
+_MAX_CACHED_COUNTS = 10_000
+DEFAULT_MODEL = "gpt-4o"
+
+
+def _message_text(message: BaseMessage) -> str:
+    content = message.content
+    if isinstance(content, list):
+        content = "".join(
+            part if isinstance(part, str) else part.get("text", "") for part in content
+        )
+    tool_calls = getattr(message, "tool_calls", None)
+    if tool_calls:
+        content += json.dumps([{"name": tc["name"], "args": tc["args"]} for tc in tool_calls])
+    return content
+
+
+@functools.lru_cache(maxsize=None)
+def _token_model(model: str) -> str:
+    """`model`, or `DEFAULT_MODEL` if tiktoken has no encoding for it"""
+    try:
+        get_encoding(model)
+    except ValueError:
+        return DEFAULT_MODEL
+    return model
+
+
+def count_tokens(message: BaseMessage, model: str = DEFAULT_MODEL) -> int:
+    model = _token_model(model)
+    text = _message_text(message)
+    key = (model, message.id, message.type, hash(text))
+    with _token_counts_lock:
+        count = _token_counts.get(key)
+        if count is not None:
+            _token_counts.move_to_end(key)
+            return count
+    count = num_tokens(text, model) + TOKENS_PER_MESSAGE
+    with _token_counts_lock:
+        _token_counts[key] = count
+        if len(_token_counts) > _MAX_CACHED_COUNTS:
+            _token_counts.popitem(last=False)
+    return count
+
+
+def truncate_tool_output(message: ToolMessage, max_tokens: int, model: str = DEFAULT_MODEL) -> ToolMessage:
+    """
+    A copy of `message` with its content cut to about `max_tokens`. The cut is by
+    characters, in proportion to the token count, so it doesn't need to tokenize again.
+    """
+    tokens = count_tokens(message, model) - TOKENS_PER_MESSAGE
+    if tokens <= max_tokens:
+        return message
+    text = _message_text(message)
+    kept = text[: len(text) * max_tokens // tokens]
+    content = f"{kept}\n[... truncated {tokens - max_tokens} of {tokens} tokens of an old tool result]"
+    return message.model_copy(update={"content": content})
+
+
+def _turns(messages: list[BaseMessage]) -> list[list[BaseMessage]]:
+    """Split `messages` before each human message"""
+    turns = []
+    for message in messages:
+        if isinstance(message, HumanMessage) or not turns:
+            turns.append([message])
+        else:
+            turns[-1].append(message)
+    return turns
+
+
+def fit_messages(
+    messages: list[BaseMessage],
+    max_tokens: int,
+    max_tool_output_tokens: int = 200,
+    model: str = DEFAULT_MODEL,
+) -> list[BaseMessage]:
+    """
+    The `messages` to send to `model` so the history takes at most `max_tokens` (see the
+    module docstring). If the current turn alone is over budget, it is still sent as a whole.
+    """
+    last_human = max(
+        (idx for idx, message in enumerate(messages) if isinstance(message, HumanMessage)),
+        default=0,
+    )
+    current = messages[last_human:]
+    previous = [
+        truncate_tool_output(message, max_tool_output_tokens, model)
+        if isinstance(message, ToolMessage)
+        else message
+        for message in messages[:last_human]
+    ]
+
+    budget = max_tokens - sum(count_tokens(message, model) for message in current)
+    kept = []
+    for turn in reversed(_turns(previous)):
+        tokens = sum(count_tokens(message, model) for message in turn)
+        if tokens > budget:
+            break
+        kept.append(turn)
+        budget -= tokens
+    return [message for turn in reversed(kept) for message in turn] + current
@@ -1,31 +1,149 @@
 import os
+import re
 import shutil
 import sqlite3
+import tempfile
+import threading
+from contextlib import contextmanager
+from datetime import date, datetime, timezone
+from functools import partial
+from typing import Iterator
 
 import pandas as pd
-import requests
+from lg_tutorials.customer_support.artifacts import fetch_artifact
+from lg_tutorials.customer_support.db_pool import close_pool, connection, get_pool
+from lg_tutorials.customer_support.queries import epoch_sql, fts_from_where, fts_keys, page_query
+from lg_tutorials.customer_support.result_cache import VERSIONS_TABLE
+from lg_tutorials.customer_support.tools import car_rental, excursions, flights, hotels
 
 DB_URL = "https://storage.googleapis.com/benchmarks-artifacts/travel-db/travel2.sqlite"
+# The expected sha256 of the file at `DB_URL`, checked on download. There is no published
+# digest for it, so set it (e.g. from `~/.cache/lg-tutorials/urls/`) to pin the DB
+DB_SHA256: str | None = None
 LOCAL_FILE = "travel2.sqlite"
 # The backup lets us restart for each tutorial section
 BACKUP_FILE = "travel2.backup.sqlite"
 
+# The only tables the tools write to
+WRITE_TABLES = ("ticket_flights", "hotels", "car_rentals", "trip_recommendations")
+
+# The columns shifted to present time by `update_dates`
+DATETIME_COLUMNS = {
+    "flights": ["scheduled_departure", "scheduled_arrival", "actual_departure", "actual_arrival"],
+    "bookings": ["book_date"],
+}
+
+# (table, columns, unique). `to_sql(if_exists="replace")` drops every key and index, so these
+# stand in for the original primary keys plus the indexes the tools' lookups need.
+# Some are covering, i.e. they hold every column a query reads, so the table isn't even visited
+INDEXES = [
+    ("flights", ("flight_id",), True),
+    # on the epochs of `create_epoch_columns`, and ending with the sort key of `search_flights`
+    ("flights", ("departure_airport", "arrival_airport", "scheduled_departure_epoch", "flight_id"), False),
+    ("flights", ("arrival_airport", "scheduled_departure_epoch", "flight_id"), False),
+    ("flights", ("scheduled_departure_epoch", "flight_id"), False),
+    ("tickets", ("ticket_no",), True),
+    ("tickets", ("passenger_id", "ticket_no", "book_ref"), False),
+    ("ticket_flights", ("ticket_no", "flight_id", "fare_conditions"), True),
+    ("boarding_passes", ("ticket_no", "flight_id", "seat_no"), True),
+    ("bookings", ("book_ref",), True),
+    ("hotels", ("id",), True),
+    ("car_rentals", ("id",), True),
+    ("trip_recommendations", ("id",), True),
+]
+
+# Full-text (FTS5) indexes for the search tools: table -> indexed columns. They are
+# "external content" indexes, i.e. they store only the index and read the rows from the
+# table itself, and triggers on the table keep them in sync with every write
+FTS_TABLES = {
+    "hotels": ("name", "location"),
+    "car_rentals": ("name", "location"),
+    "trip_recommendations": ("name", "location", "keywords"),
+}
+
+# A day to fill in the time filters of `search_flights` with, to build its queries
+_SOME_DAY = date(2024, 1, 1)
+# The filters of `search_flights` (departure, arrival, start and end) to check
+_FLIGHT_FILTERS = {
+    "all filters": ("BSL", "ZRH", _SOME_DAY, _SOME_DAY),
+    "airports only": ("BSL", "ZRH", None, None),
+    "departure only": ("BSL", None, _SOME_DAY, None),
+    "arrival only": (None, "ZRH", _SOME_DAY, None),
+    "dates only": (None, None, _SOME_DAY, _SOME_DAY),
+}
+
+# The lookups done by the tools, which must never need a full table scan, built from the
+# very statements the tools run. The substring searches (`LIKE '%term%'`) are not here,
+# since no b-tree index can help them
+PLAN_CHECKS = {
+    "fetch_user_flight_information": flights.USER_FLIGHTS_QUERY,
+    **{
+        f"search_flights ({name}{', next page' if after else ''})": page_query(
+            "*", flights.flights_from_where(*filters)[0], flights.FLIGHTS_KEYS, after=after
+        )
+        for name, filters in _FLIGHT_FILTERS.items()
+        for after in (False, True)
+    },
+    "validate ticket change": flights.VALIDATE_CHANGE,
+    "validate ticket cancel": flights.VALIDATE_CANCEL,
+    "update ticket flight": flights.UPDATE_TICKET_FLIGHT,
+    "cancel ticket": flights.CANCEL_TICKET,
+    **{
+        f"search_{table} (full text{', next page' if after else ''})": page_query(
+            f"{table}.*", fts_from_where(table), fts_keys(table), after=after
+        )
+        for table in FTS_TABLES
+        for after in (False, True)
+    },
+    "book hotel": hotels.BOOK_HOTEL,
+    "book car rental": car_rental.BOOK_CAR_RENTAL,
+    "book excursion": excursions.BOOK_EXCURSION,
+}
+
 
 def download_db(overwrite=False):
     if overwrite or not os.path.exists(LOCAL_FILE):
-        response = requests.get(DB_URL)
-        response.raise_for_status()  # Ensure the request was successful
-        with open(LOCAL_FILE, "wb") as f:
-            f.write(response.content)
+        # streamed into the artifacts cache, so this only hits the network once per machine
+        # (and, with `overwrite`, again only if the DB changed on the server)
+        close_pool(LOCAL_FILE)
+        fetch_artifact(DB_URL, LOCAL_FILE, sha256=DB_SHA256, refresh=overwrite)
         # Backup - we will use this to "reset" our DB in each section
-        shutil.copy(LOCAL_FILE, BACKUP_FILE)
+        fetch_artifact(DB_URL, BACKUP_FILE, sha256=DB_SHA256)
+
 
+def _present_offset(example_time: str) -> int:
+    """Seconds from `example_time` (e.g. "2024-05-01 10:00:00.000+03") to now"""
+    now = datetime.now(timezone.utc)
+    return round((now - datetime.fromisoformat(example_time)).total_seconds())
 
-def update_dates(file):
+
+def _shift_column(values: pd.Series, offset: pd.Timedelta) -> pd.Series:
     """
-    Convert the flights to present time for our tutorial
+    Shift timestamps like "2024-05-01 10:00:00.000+03" by `offset`, keeping their text
+    format (fraction and UTC offset included) as it was, and missing ones ("\\N") as they are
     """
+    missing = values.isna() | (values == "\\N")
+    present = values[~missing]
+    shifted = (pd.to_datetime(present.str[:19]) + offset).dt.strftime("%Y-%m-%d %H:%M:%S") + present.str[19:]
+    return values.where(missing, shifted)
+
+
+def update_dates(file, in_place: bool = False):
+    """
+    Convert the flights to present time for our tutorial, i.e. shift every date by how
+    long ago the most recent departure was. Timestamps keep their original text format.
+    With `in_place=True`, see `shift_dates_in_place`, which gives the same dates.
+    """
+    if in_place:
+        return shift_dates_in_place(file)
+
+    # pooled connections would keep pointing to the file we are about to replace
+    close_pool(file)
     shutil.copy(BACKUP_FILE, file)
+    # leftovers from a previous WAL session don't belong to the fresh copy
+    for suffix in ("-wal", "-shm"):
+        if os.path.exists(file + suffix):
+            os.remove(file + suffix)
     conn = sqlite3.connect(file)
 
     # Get list of all tables in the SQLite database
@@ -38,36 +156,339 @@ def update_dates(file):
     }
 
     # Find the most recent flight departure time in the database
-    example_time = pd.to_datetime(
-        tables["flights"]["actual_departure"].replace("\\N", pd.NaT)
-    ).max()
-    current_time = pd.to_datetime("now").tz_localize(example_time.tz)
-
-    # Compute diff, so will add this offset to all times
-    offset = current_time - example_time
+    departures = tables["flights"]["actual_departure"]
+    offset = pd.Timedelta(seconds=_present_offset(departures[departures != "\\N"].max()))
 
-    # Add ofset to book_date
-    tables["bookings"]["book_date"] = (
-        pd.to_datetime(tables["bookings"]["book_date"].replace("\\N", pd.NaT), utc=True) + offset
-    )
-
-    # Add offset to times in the `flights` table
-    datetime_columns = [
-        "scheduled_departure",
-        "scheduled_arrival",
-        "actual_departure",
-        "actual_arrival",
-    ]
-    for column in datetime_columns:
-        tables["flights"][column] = (
-            pd.to_datetime(tables["flights"][column].replace("\\N", pd.NaT)) + offset
-        )
+    # Add offset to the times in `bookings` and `flights`
+    for table, columns in DATETIME_COLUMNS.items():
+        for column in columns:
+            tables[table][column] = _shift_column(tables[table][column], offset)
 
     # write back to the DB
     for table_name, df in tables.items():
         df.to_sql(table_name, conn, if_exists="replace", index=False)
 
     conn.commit()
+    create_indexes(conn)
+    check_query_plans(conn)
     conn.close()
 
     return file
+
+
+def shift_dates_in_place(file):
+    """
+    Same as `update_dates`, but shifting the dates with a couple of `UPDATE`s in a single
+    transaction instead of round-tripping every table through pandas. Only `flights` and
+    `bookings` are written, so the rest of the tables (and all indexes) stay as they are,
+    and a reset takes milliseconds rather than seconds.
+
+    If `file` doesn't exist yet, it's created from the backup first. Otherwise, note this
+    only moves the dates to the present: it does not undo the writes done by the tools.
+    Either way, the query plans of the tools are checked at the end (see `check_query_plans`).
+    """
+    if not os.path.exists(file):
+        close_pool(file)
+        shutil.copy(BACKUP_FILE, file)
+        with connection(file) as conn:
+            create_indexes(conn)
+
+    with connection(file) as conn:
+        # Timestamps look like "2024-05-01 10:00:00.000+03" and share the same offset,
+        # so the lexicographic max is also the most recent departure
+        (example_time,) = conn.execute(
+            "SELECT max(actual_departure) FROM flights WHERE actual_departure != '\\N'"
+        ).fetchone()
+        offset = _present_offset(example_time)
+
+        # SQLite's datetime() can't parse a "+03" suffix, so we shift the first 19 chars
+        # ("YYYY-MM-DD HH:MM:SS") and keep the fraction and UTC offset as they were,
+        # like `_shift_column` does
+        for table, columns in DATETIME_COLUMNS.items():
+            assignments = ", ".join(
+                f"{column} = CASE WHEN {column} IS NULL OR {column} = '\\N' THEN {column} "
+                f"ELSE datetime(substr({column}, 1, 19), '{offset:+d} seconds') || substr({column}, 20) END"
+                for column in columns
+            )
+            conn.execute(f"UPDATE {table} SET {assignments}")
+        if _has_table(conn, VERSIONS_TABLE):
+            placeholders = ", ".join("?" * len(DATETIME_COLUMNS))
+            conn.execute(
+                f"UPDATE {VERSIONS_TABLE} SET version = version + 1 WHERE name IN ({placeholders})",
+                tuple(DATETIME_COLUMNS),
+            )
+
+    # on a connection of its own: EXPLAIN statements aren't prepared again when the schema
+    # changes, so those cached by a pooled connection can show the plan of an older one
+    conn = sqlite3.connect(file)
+    try:
+        check_query_plans(conn)
+    finally:
+        conn.close()
+    return file
+
+
+def _has_table(conn: sqlite3.Connection, name: str, schema: str = "main") -> bool:
+    query = f"SELECT 1 FROM {schema}.sqlite_master WHERE type = 'table' AND name = ?"
+    return conn.execute(query, (name,)).fetchone() is not None
+
+
+def create_epoch_columns(conn: sqlite3.Connection):
+    """
+    Add an integer `<column>_epoch` next to each of the flights' `DATETIME_COLUMNS`, since
+    the text timestamps don't sort in time order once their UTC offsets differ. They are
+    virtual generated columns: computed from the text when read, so they can't get out
+    of sync (shifting the dates included), but stored in the indexes built on them.
+    Their expression (see `queries.epoch_sql`) depends on the SQLite version creating
+    them, and is stored in the schema, so the DB then needs at least that version.
+    """
+    existing = {row[1] for row in conn.execute("PRAGMA table_xinfo(flights)")}
+    for column in DATETIME_COLUMNS["flights"]:
+        if f"{column}_epoch" not in existing:
+            conn.execute(
+                f"ALTER TABLE flights ADD COLUMN {column}_epoch INTEGER "
+                f"GENERATED ALWAYS AS ({epoch_sql(column)}) VIRTUAL"
+            )
+
+
+def create_indexes(conn: sqlite3.Connection):
+    create_epoch_columns(conn)
+    for table, columns, unique in INDEXES:
+        name = f"idx_{table}_{'_'.join(columns)}"
+        conn.execute(
+            f"CREATE {'UNIQUE ' if unique else ''}INDEX IF NOT EXISTS {name} "
+            f"ON {table} ({', '.join(columns)})"
+        )
+    create_fts_indexes(conn)
+    create_version_tracking(conn)
+    # refresh the statistics the query planner uses to pick between indexes
+    conn.execute("ANALYZE")
+    conn.commit()
+
+
+def create_fts_indexes(conn: sqlite3.Connection, schema: str = "main", tables=None):
+    """
+    Create (if needed) and rebuild the full-text index of each table in `FTS_TABLES`
+    (or only those in `tables`), along with the triggers that keep it in sync.
+    """
+    for table, columns in FTS_TABLES.items():
+        if tables is not None and table not in tables:
+            continue
+        fts = f"{table}_fts"
+        column_list = ", ".join(columns)
+        new_values = ", ".join(f"new.{column}" for column in columns)
+        old_values = ", ".join(f"old.{column}" for column in columns)
+        # an external content index is updated by inserting the old values with the
+        # special 'delete' command, and then the new ones
+        delete_old = f"INSERT INTO {fts} ({fts}, rowid, {column_list}) VALUES ('delete', old.id, {old_values});"
+        insert_new = f"INSERT INTO {fts} (rowid, {column_list}) VALUES (new.id, {new_values});"
+
+        conn.execute(
+            f"CREATE VIRTUAL TABLE IF NOT EXISTS {schema}.{fts} USING fts5("
+            f"{column_list}, content='{table}', content_rowid='id', prefix='2 3')"
+        )
+        conn.execute(
+            f"CREATE TRIGGER IF NOT EXISTS {schema}.{fts}_insert AFTER INSERT ON {table} "
+            f"BEGIN {insert_new} END"
+        )
+        conn.execute(
+            f"CREATE TRIGGER IF NOT EXISTS {schema}.{fts}_delete AFTER DELETE ON {table} "
+            f"BEGIN {delete_old} END"
+        )
+        # bookings only touch `booked`, so they don't fire this one
+        conn.execute(
+            f"CREATE TRIGGER IF NOT EXISTS {schema}.{fts}_update AFTER UPDATE OF id, {column_list} "
+            f"ON {table} BEGIN {delete_old} {insert_new} END"
+        )
+        conn.execute(f"INSERT INTO {schema}.{fts} ({fts}) VALUES ('rebuild')")
+
+
+def create_version_tracking(conn: sqlite3.Connection, schema: str = "main", tables=None, triggers: bool = True):
+    """
+    Create `VERSIONS_TABLE` with a row for each table in `schema` (or only for `tables`),
+    and (with `triggers`) the triggers bumping them on any write to `WRITE_TABLES`.
+    `shift_dates_in_place` bumps the tables it shifts itself, with a single statement.
+    """
+    conn.execute(
+        f"CREATE TABLE IF NOT EXISTS {schema}.{VERSIONS_TABLE} "
+        "(name TEXT PRIMARY KEY, version INTEGER NOT NULL DEFAULT 0)"
+    )
+    if tables is None:
+        tables = [
+            name
+            for (name,) in conn.execute(
+                f"SELECT name FROM {schema}.sqlite_master WHERE type = 'table' "
+                f"AND name NOT LIKE 'sqlite_%' AND name NOT LIKE '%_fts%' AND name != ?",
+                (VERSIONS_TABLE,),
+            )
+        ]
+    conn.executemany(
+        f"INSERT OR IGNORE INTO {schema}.{VERSIONS_TABLE} (name) VALUES (?)",
+        [(table,) for table in tables],
+    )
+    for table in WRITE_TABLES:
+        if not triggers or table not in tables:
+            continue
+        # one trigger per kind of write, as a trigger can only fire on one
+        for event in ("INSERT", "UPDATE", "DELETE"):
+            conn.execute(
+                f"CREATE TRIGGER IF NOT EXISTS {schema}.{table}_version_{event.lower()} "
+                f"AFTER {event} ON {table} BEGIN "
+                f"UPDATE {VERSIONS_TABLE} SET version = version + 1 WHERE name = '{table}'; END"
+            )
+
+
+def check_query_plans(conn: sqlite3.Connection):
+    """
+    Run `EXPLAIN QUERY PLAN` on every tool lookup, and raise if any of them would
+    scan a whole table. Better to fail here than to find out once the DB has grown.
+    """
+    full_scans = {}
+    for name, query in PLAN_CHECKS.items():
+        # the tools' statements take either named (":name") or positional ("?") params
+        names = set(re.findall(r":(\w+)", query))
+        params = dict.fromkeys(names) if names else [None] * query.count("?")
+        plan = conn.execute(f"EXPLAIN QUERY PLAN {query}", params).fetchall()
+        # each row is (id, parent, notused, detail). A full scan reads like "SCAN flights"
+        # (or "SCAN flights USING COVERING INDEX ...", which reads the whole index instead).
+        # "SCAN hotels_fts VIRTUAL TABLE INDEX ..." is a full-text lookup, not a scan, and
+        # "SCAN CONSTANT ROW" is the single row of a `SELECT` without `FROM`
+        scans = [
+            row[3]
+            for row in plan
+            if row[3].startswith("SCAN ")
+            and "VIRTUAL TABLE" not in row[3]
+            and row[3] != "SCAN CONSTANT ROW"
+        ]
+        if scans:
+            full_scans[name] = scans
+    if full_scans:
+        raise RuntimeError(f"Tool queries doing full table scans: {full_scans}")
+
+
+def _key_columns(table: str) -> tuple[str, ...]:
+    """The columns identifying a row of `table`: those of its unique index in `INDEXES`"""
+    return next(columns for name, columns, unique in INDEXES if name == table and unique)
+
+
+def _create_delta_views(conn: sqlite3.Connection, tables):
+    """
+    For each of `tables`, a TEMP view with its name showing the rows of `base` merged
+    with the changes in `main.<table>_delta`, and triggers turning any write to the view
+    into changes there (see `SnapshotManager`). TEMP views can read other DBs, unlike
+    those stored in a DB file, which is why every connection creates its own.
+    """
+    for table in tables:
+        columns = [row[1] for row in conn.execute(f"PRAGMA base.table_info({table})")]
+        column_list = ", ".join(columns)
+        same_key = " AND ".join(f"delta.{column} = b.{column}" for column in _key_columns(table))
+        conn.execute(
+            f"CREATE TEMP VIEW {table} AS "
+            f"SELECT {column_list} FROM main.{table}_delta WHERE NOT _deleted "
+            f"UNION ALL "
+            f"SELECT {column_list} FROM base.{table} AS b "
+            f"WHERE NOT EXISTS (SELECT 1 FROM main.{table}_delta AS delta WHERE {same_key})"
+        )
+
+        # a row's change replaces any previous one, and a deleted row leaves a tombstone.
+        # Table names in triggers can't be qualified, but `{table}_delta` and
+        # `VERSIONS_TABLE` are only found in `main`, before `base`
+        def write(row: str, deleted: int) -> str:
+            values = ", ".join(f"{row}.{column}" for column in columns)
+            return f"INSERT OR REPLACE INTO {table}_delta ({column_list}, _deleted) VALUES ({values}, {deleted});"
+
+        bump = f"UPDATE {VERSIONS_TABLE} SET version = version + 1 WHERE name = '{table}';"
+        for event, body in (
+            ("INSERT", write("new", 0)),
+            ("DELETE", write("old", 1)),
+            # the old key gets a tombstone, in case the update changes it
+            ("UPDATE", write("old", 1) + " " + write("new", 0)),
+        ):
+            conn.execute(
+                f"CREATE TEMP TRIGGER {table}_delta_{event.lower()} INSTEAD OF {event} ON {table} "
+                f"BEGIN {body} {bump} END"
+            )
+
+
+class SnapshotManager:
+    """
+    Give each conversation its own mutable view of `base_file` (already shifted with
+    `update_dates`), so that many of them can run in parallel without one booking
+    showing up in another's searches.
+
+    Nothing is copied: each snapshot is a small SQLite file with `base_file` attached
+    behind it as `base`, holding only the rows its session changed. For each of
+    `WRITE_TABLES`, `main.<table>_delta` keeps the changed rows (and a tombstone for each
+    deleted one), and a TEMP view named like the table merges them with the base rows
+    (see `_create_delta_views`). SQLite resolves unqualified names in `temp`, then `main`,
+    then the attached DBs, so the tools read and write the session's view of the tables
+    they write to, and the shared base for everything else (flights, tickets, ...),
+    without knowing anything about it. The base rows are found through the base indexes,
+    full-text ones included, so creating a snapshot takes milliseconds whatever the size
+    of the DB. Full-text searches match on the text of the base rows, which is fine as
+    the tools only ever change `booked` and the flights of tickets.
+
+    The views are created by the snapshot's connection pool, so read it through
+    `db_pool.connection(path)` (as the tools do), by passing the path returned by
+    `create` as `config["configurable"]["db"]`.
+    """
+
+    def __init__(self, base_file: str, directory: str | None = None, write_tables=WRITE_TABLES):
+        self.base_file = os.path.abspath(base_file)
+        self.directory = directory or tempfile.mkdtemp(prefix="travel-snapshots-")
+        self.write_tables = tuple(write_tables)
+        self._snapshots: dict[str, str] = {}
+        self._lock = threading.Lock()
+
+    def create(self, session_id: str) -> str:
+        path = os.path.join(self.directory, f"{session_id}.sqlite")
+        with self._lock:
+            if session_id in self._snapshots:
+                raise ValueError(f"Snapshot for session {session_id} already exists")
+            self._snapshots[session_id] = path
+
+        conn = sqlite3.connect(path)
+        try:
+            conn.execute("ATTACH DATABASE ? AS base", (self.base_file,))
+            for table in self.write_tables:
+                columns = ", ".join(
+                    f"{name} {type_}" for _, name, type_, *_ in conn.execute(f"PRAGMA base.table_info({table})")
+                )
+                key = ", ".join(_key_columns(table))
+                conn.execute(f"CREATE TABLE main.{table}_delta ({columns}, _deleted INTEGER NOT NULL DEFAULT 0)")
+                conn.execute(f"CREATE UNIQUE INDEX main.idx_{table}_delta_key ON {table}_delta ({key})")
+            # the session's writes only bump the versions in the snapshot (the triggers
+            # of the views do, see `_create_delta_views`)
+            create_version_tracking(conn, schema="main", tables=self.write_tables, triggers=False)
+            conn.commit()
+        finally:
+            conn.close()
+
+        get_pool(
+            path,
+            attach={"base": self.base_file},
+            setup=partial(_create_delta_views, tables=self.write_tables),
+        )
+        return path
+
+    def release(self, session_id: str):
+        with self._lock:
+            path = self._snapshots.pop(session_id, None)
+        if path is None:
+            return
+        close_pool(path)
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+
+    @contextmanager
+    def session(self, session_id: str) -> Iterator[str]:
+        path = self.create(session_id)
+        try:
+            yield path
+        finally:
+            self.release(session_id)
+
+    def release_all(self):
+        for session_id in list(self._snapshots):
+            self.release(session_id)
@@ -0,0 +1,230 @@
+"""
+Pooled SQLite connections for the customer support tools.
+
+Every tool used to open (and parse the schema of) a brand new connection for a single
+statement. Here we keep a small pool per database file instead: connections are opened
+once with tuned PRAGMAs and lent out through `connection(db)`. Connections are created
+with `check_same_thread=False`, so they can be handed to whatever worker thread `ToolNode`
+runs a tool call on, but a connection is only ever lent to one caller at a time.
+"""
+
+import sqlite3
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Callable, Iterator
+
+from langchain_core.runnables import RunnableConfig
+
+# Tuned for a read-heavy workload with small, short write transactions
+PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "cache_size": -64_000,  # negative means KiB, so ~64MB of page cache per connection
+    "mmap_size": 256 * 1024 * 1024,
+    "temp_store": "MEMORY",
+    "busy_timeout": 5_000,  # ms to wait on a locked DB before raising
+}
+
+# Connections per pool, by default. `async_tools.db_executor` has as many threads
+POOL_SIZE = 8
+
+
+@dataclass
+class PoolStats:
+    hits: int = 0  # an idle connection was reused
+    misses: int = 0  # a new connection had to be opened
+    waits: int = 0  # the pool was exhausted and the caller had to wait
+    wait_time: float = 0.0  # total seconds spent waiting
+
+
+class ConnectionPool:
+    """
+    A bounded pool of connections to a single SQLite file.
+    Idle connections are reused LIFO, so the hottest (best cached) one goes out first.
+    """
+
+    def __init__(
+        self,
+        db: str,
+        max_size: int = POOL_SIZE,
+        timeout: float = 30.0,
+        attach: dict[str, str] | None = None,
+        setup: Callable[[sqlite3.Connection], None] | None = None,
+    ):
+        self.db = db
+        # alias -> file, attached to every connection (see `database.SnapshotManager`)
+        self.attach = attach or {}
+        # called on every new connection, once attached (e.g. to create TEMP views)
+        self.setup = setup
+        self.max_size = max_size
+        self.timeout = timeout
+        self.stats = PoolStats()
+        self._idle: deque[sqlite3.Connection] = deque()
+        self._num_open = 0
+        self._closed = False
+        self._cond = threading.Condition()
+
+    def open_connection(self) -> sqlite3.Connection:
+        """A connection set up like the pooled ones, but owned (and closed) by the caller"""
+        conn = sqlite3.connect(self.db, check_same_thread=False, cached_statements=256)
+        for name, value in PRAGMAS.items():
+            conn.execute(f"PRAGMA {name} = {value}")
+        for alias, file in self.attach.items():
+            conn.execute("ATTACH DATABASE ? AS ?", (file, alias))
+            for name in ("cache_size", "mmap_size"):
+                conn.execute(f"PRAGMA {alias}.{name} = {PRAGMAS[name]}")
+        if self.setup is not None:
+            self.setup(conn)
+        return conn
+
+    def acquire(self) -> sqlite3.Connection:
+        with self._cond:
+            if self._closed:
+                raise RuntimeError(f"Connection pool for {self.db} is closed")
+            if self._idle:
+                self.stats.hits += 1
+                return self._idle.pop()
+            if self._num_open >= self.max_size:
+                self.stats.waits += 1
+                start = time.perf_counter()
+                available = self._cond.wait_for(
+                    lambda: self._idle or self._closed, timeout=self.timeout
+                )
+                self.stats.wait_time += time.perf_counter() - start
+                if not available or self._closed:
+                    raise TimeoutError(f"Timed out waiting for a connection to {self.db}")
+                self.stats.hits += 1
+                return self._idle.pop()
+            self.stats.misses += 1
+            self._num_open += 1
+
+        # open outside the lock, so other threads can keep borrowing meanwhile
+        try:
+            return self.open_connection()
+        except Exception:
+            with self._cond:
+                self._num_open -= 1
+                self._cond.notify()
+            raise
+
+    def release(self, conn: sqlite3.Connection):
+        with self._cond:
+            if self._closed:
+                conn.close()
+                self._num_open -= 1
+                return
+            self._idle.append(conn)
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self) -> Iterator[sqlite3.Connection]:
+        conn = self.acquire()
+        try:
+            yield conn
+            if conn.in_transaction:
+                conn.commit()
+        except BaseException:
+            if conn.in_transaction:
+                conn.rollback()
+            raise
+        finally:
+            self.release(conn)
+
+    def close(self):
+        """Close idle connections now, and borrowed ones as soon as they are returned"""
+        with self._cond:
+            self._closed = True
+            while self._idle:
+                self._idle.pop().close()
+                self._num_open -= 1
+            self._cond.notify_all()
+
+
+_pools: dict[str, ConnectionPool] = {}
+_pools_lock = threading.Lock()
+# called with the db file whenever its pool is closed (see `close_pool`)
+_close_listeners: list[Callable[[str], None]] = []
+
+
+def get_pool(
+    db: str,
+    attach: dict[str, str] | None = None,
+    setup: Callable[[sqlite3.Connection], None] | None = None,
+) -> ConnectionPool:
+    """`attach` and `setup` only take effect when the pool for `db` is created"""
+    with _pools_lock:
+        pool = _pools.get(db)
+        if pool is None:
+            pool = _pools[db] = ConnectionPool(db, attach=attach, setup=setup)
+        return pool
+
+
+def close_pool(db: str):
+    """
+    Drop the pool for `db`. Needed whenever the file is replaced on disk (e.g. when
+    resetting the DB), since open connections would keep reading the old file.
+    """
+    with _pools_lock:
+        pool = _pools.pop(db, None)
+    if pool is not None:
+        pool.close()
+    for listener in list(_close_listeners):
+        listener(db)
+
+
+def add_close_listener(listener: Callable[[str], None]):
+    """
+    Call `listener(db)` on every `close_pool(db)`, so anything derived from the contents
+    of `db` (e.g. cached results) can be dropped along with its connections.
+    """
+    _close_listeners.append(listener)
+
+
+def pool_stats() -> dict[str, PoolStats]:
+    with _pools_lock:
+        return {db: pool.stats for db, pool in _pools.items()}
+
+
+@contextmanager
+def connection(db: str) -> Iterator[sqlite3.Connection]:
+    """
+    Borrow a pooled connection to `db`. Any open transaction is committed when the
+    block exits normally, and rolled back if it raises.
+    """
+    with get_pool(db).connection() as conn:
+        yield conn
+
+
+@contextmanager
+def write_transaction(db: str) -> Iterator[sqlite3.Connection]:
+    """
+    Like `connection`, but the block runs in a transaction that takes the write lock of
+    `db` upfront. Whatever the block checks before writing can't be changed by another
+    connection until it commits, and a busy DB makes it wait (up to `busy_timeout`)
+    before doing any work, rather than failing halfway.
+
+    Only `db` itself is locked: `BEGIN IMMEDIATE` would also lock every attached DB (e.g.
+    the base of all snapshots, see `database.SnapshotManager`), so with attached DBs the
+    lock is taken with a write to `main` that changes nothing instead.
+    """
+    pool = get_pool(db)
+    with pool.connection() as conn:
+        if not pool.attach:
+            conn.execute("BEGIN IMMEDIATE")
+        else:
+            (table,) = conn.execute(
+                "SELECT name FROM main.sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%' LIMIT 1"
+            ).fetchone()
+            conn.execute("BEGIN")
+            conn.execute(f'UPDATE main."{table}" SET rowid = rowid WHERE 0')
+        yield conn
+
+
+def get_db(config: RunnableConfig) -> str:
+    configuration = config.get("configurable", {})
+    if "db" not in configuration:
+        raise ValueError("No database configured.")
+    return configuration["db"]
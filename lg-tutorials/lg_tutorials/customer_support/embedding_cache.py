@@ -0,0 +1,114 @@
+"""
+Cache of query embeddings, so `lookup_policy` doesn't pay an embeddings round-trip for
+queries it has already seen.
+
+Two tiers: an in-process LRU in front of a SQLite file shared by every process (and run).
+Keys are the model name plus the query normalized for case and whitespace, since
+"Can I change my flight?" and "can i change my  flight?" should not be embedded twice.
+"""
+
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+
+import numpy as np
+from lg_tutorials.customer_support.db_pool import connection
+
+
+@dataclass
+class EmbeddingCacheStats:
+    memory_hits: int = 0
+    disk_hits: int = 0
+    misses: int = 0
+
+
+def normalize_text(text: str) -> str:
+    return " ".join(text.lower().split())
+
+
+class EmbeddingCache:
+
+    def __init__(
+        self,
+        path: str = "embeddings_cache.sqlite",
+        max_memory_entries: int = 1024,
+        max_disk_entries: int = 100_000,
+        evict_every: int = 100,
+    ):
+        self.path = path
+        self.max_memory_entries = max_memory_entries
+        self.max_disk_entries = max_disk_entries
+        # the disk tier is only trimmed every `evict_every` writes
+        self.evict_every = evict_every
+        # updated under `_lock`, like the LRU, as callers can be on several threads
+        self.stats = EmbeddingCacheStats()
+        self._memory: OrderedDict[str, np.ndarray] = OrderedDict()
+        self._lock = threading.Lock()
+        self._puts = 0
+
+        with connection(self.path) as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings "
+                "(key TEXT PRIMARY KEY, model TEXT, vector BLOB, last_used REAL)"
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_embeddings_last_used ON embeddings (last_used)"
+            )
+
+    @staticmethod
+    def key(text: str, model: str) -> str:
+        return hashlib.sha256(f"{model}\0{normalize_text(text)}".encode()).hexdigest()
+
+    def _remember(self, key: str, vector: np.ndarray):
+        with self._lock:
+            self._memory[key] = vector
+            self._memory.move_to_end(key)
+            if len(self._memory) > self.max_memory_entries:
+                self._memory.popitem(last=False)
+
+    def get(self, text: str, model: str) -> np.ndarray | None:
+        key = self.key(text, model)
+        with self._lock:
+            vector = self._memory.get(key)
+            if vector is not None:
+                self._memory.move_to_end(key)
+                self.stats.memory_hits += 1
+                return vector
+
+        with connection(self.path) as conn:
+            row = conn.execute("SELECT vector FROM embeddings WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                with self._lock:
+                    self.stats.misses += 1
+                return None
+            conn.execute("UPDATE embeddings SET last_used = ? WHERE key = ?", (time.time(), key))
+
+        with self._lock:
+            self.stats.disk_hits += 1
+        vector = np.frombuffer(row[0], dtype=np.float32)
+        self._remember(key, vector)
+        return vector
+
+    def put(self, text: str, model: str, vector) -> np.ndarray:
+        key = self.key(text, model)
+        vector = np.asarray(vector, dtype=np.float32)
+        self._remember(key, vector)
+
+        with connection(self.path) as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?, ?)",
+                (key, model, vector.tobytes(), time.time()),
+            )
+            with self._lock:
+                self._puts += 1
+                evict = self._puts % self.evict_every == 0
+            if evict:
+                # drop everything but the `max_disk_entries` most recently used
+                conn.execute(
+                    "DELETE FROM embeddings WHERE key IN "
+                    "(SELECT key FROM embeddings ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                    (self.max_disk_entries,),
+                )
+        return vector
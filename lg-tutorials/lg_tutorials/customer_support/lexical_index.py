@@ -0,0 +1,77 @@
+"""
+In-memory BM25 index over the policy sections.
+
+Dense retrieval is good at paraphrases, but questions about exact terms (fare classes,
+"24 hours", "Swiss Choice") are better answered by matching the words themselves, and
+that needs no embeddings call. The index is a plain inverted list per term, so a query
+only touches the postings of its own terms.
+"""
+
+import math
+import re
+from collections import Counter
+
+import numpy as np
+
+
+def tokenize(text: str) -> list[str]:
+    return re.findall(r"\w+", text.lower())
+
+
+class BM25Index:
+
+    def __init__(self, texts: list[str], k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.num_docs = len(texts)
+        doc_tokens = [tokenize(text) for text in texts]
+        lengths = np.array([len(tokens) for tokens in doc_tokens], dtype=np.float32)
+        avg_length = lengths.mean() if self.num_docs and lengths.mean() > 0 else 1.0
+        # BM25 length normalization, per doc, computed once
+        self._norms = k1 * (1 - b + b * lengths / avg_length)
+
+        # term -> (doc ids, term frequencies)
+        postings: dict[str, tuple[list[int], list[int]]] = {}
+        for doc_id, tokens in enumerate(doc_tokens):
+            for term, tf in Counter(tokens).items():
+                ids, tfs = postings.setdefault(term, ([], []))
+                ids.append(doc_id)
+                tfs.append(tf)
+        self._postings = {
+            term: (np.array(ids), np.array(tfs, dtype=np.float32))
+            for term, (ids, tfs) in postings.items()
+        }
+
+    def idf(self, term: str) -> float:
+        """Terms missing from the index get the idf of the rarest possible term"""
+        df = len(self._postings[term][0]) if term in self._postings else 0
+        return math.log(1 + (self.num_docs - df + 0.5) / (df + 0.5))
+
+    def scores(self, query: str) -> np.ndarray:
+        scores = np.zeros(self.num_docs, dtype=np.float32)
+        for term in set(tokenize(query)):
+            if term not in self._postings:
+                continue
+            ids, tfs = self._postings[term]
+            scores[ids] += self.idf(term) * tfs * (self.k1 + 1) / (tfs + self._norms[ids])
+        return scores
+
+    def search(self, query: str, k: int) -> tuple[np.ndarray, np.ndarray]:
+        """(scores, ids) of the top `k` docs with any query term, by decreasing score"""
+        scores = self.scores(query)
+        ids = np.flatnonzero(scores)
+        ids = ids[np.argsort(-scores[ids], kind="stable")[:k]]
+        return scores[ids], ids
+
+    def coverage(self, query: str, doc_id: int) -> float:
+        """Fraction of the query's idf mass whose terms appear in `doc_id`"""
+        terms = set(tokenize(query))
+        total = sum(self.idf(term) for term in terms)
+        if not total:
+            return 0.0
+        matched = sum(
+            self.idf(term)
+            for term in terms
+            if term in self._postings and doc_id in self._postings[term][0]
+        )
+        return matched / total
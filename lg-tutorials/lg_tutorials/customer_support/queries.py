@@ -0,0 +1,256 @@
+"""
+Shared query execution for the customer support tools.
+
+sqlite3 already keeps a per-connection cache of prepared statements keyed by the SQL text
+(see `cached_statements` in `db_pool`), so as long as tools build their SQL
+deterministically, every call after the first reuses the prepared statement. On top of
+that, here we keep a registry of the column names of each statement, so turning rows into
+dicts doesn't need to walk `cursor.description` on every call (or, as some tools did,
+on every row).
+"""
+
+import base64
+import hashlib
+import json
+import re
+import sqlite3
+import threading
+from collections import OrderedDict
+from typing import Iterable, Optional, Sequence
+
+
+class StatementRegistry:
+    """LRU registry of SQL text -> column names of its result set"""
+
+    def __init__(self, max_size: int = 512):
+        self.max_size = max_size
+        self._columns: OrderedDict[str, tuple[str, ...]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def columns(self, sql: str, cursor: sqlite3.Cursor) -> tuple[str, ...]:
+        with self._lock:
+            names = self._columns.get(sql)
+            if names is not None:
+                self._columns.move_to_end(sql)
+                return names
+        names = tuple(column[0] for column in cursor.description)
+        with self._lock:
+            self._columns[sql] = names
+            if len(self._columns) > self.max_size:
+                self._columns.popitem(last=False)
+        return names
+
+
+# page sizes the LLM asks for are clamped to this, whatever it passes
+MAX_PAGE_SIZE = 50
+# matches are only counted up to this, so counting never costs much more than a page
+COUNT_LIMIT = 1000
+
+statements = StatementRegistry()
+# (database file, table) -> columns, used to validate projections. Keyed by file, as the
+# same process can use several DBs
+_table_columns: dict[tuple[str, str], tuple[str, ...]] = {}
+
+
+def fetch_dicts(conn: sqlite3.Connection, sql: str, params: Sequence = ()) -> list[dict]:
+    cursor = conn.execute(sql, params)
+    rows = cursor.fetchall()
+    names = statements.columns(sql, cursor)
+    return [dict(zip(names, row)) for row in rows]
+
+
+def database_file(conn: sqlite3.Connection) -> str:
+    """The file of the main database of `conn`, "" for an in-memory or temporary one"""
+    return conn.execute("PRAGMA database_list").fetchone()[2]
+
+
+def table_columns(conn: sqlite3.Connection, table: str) -> tuple[str, ...]:
+    """
+    The columns of `table`, or an empty tuple if it doesn't exist. Missing tables, and
+    tables of in-memory DBs (which have no file to tell them apart), aren't cached.
+    """
+    key = (database_file(conn), table)
+    if key not in _table_columns:
+        rows = conn.execute(f"PRAGMA table_info({table})").fetchall()
+        if not rows:
+            return ()
+        if not key[0]:
+            return tuple(row[1] for row in rows)
+        _table_columns[key] = tuple(row[1] for row in rows)
+    return _table_columns[key]
+
+
+def select_list(
+    conn: sqlite3.Connection,
+    table: str,
+    columns: Optional[Iterable[str]] = None,
+    qualified: bool = False,
+) -> str:
+    """
+    Build the `SELECT` list for `table`, keeping only `columns` if given. Column names
+    come from the LLM, so they are checked against the actual schema before going into SQL.
+    With `qualified`, columns are prefixed with the table name, for queries with joins.
+    All columns means all but the generated ones (see `database.create_epoch_columns`),
+    which `PRAGMA table_info` leaves out, unlike `*`.
+    """
+    prefix = f"{table}." if qualified else ""
+    available = table_columns(conn, table)
+    if not columns:
+        return ", ".join(f"{prefix}{column}" for column in available) or f"{prefix}*"
+    # dedupe but keep the order requested
+    columns = list(dict.fromkeys(columns))
+    unknown = [column for column in columns if column not in available]
+    if unknown:
+        raise ValueError(
+            f"Unknown columns for {table}: {unknown}. Available columns: {list(available)}"
+        )
+    return ", ".join(f"{prefix}{column}" for column in columns)
+
+
+# `unixepoch()` came with SQLite 3.38, older versions get the same from `strftime('%s', ...)`
+UNIXEPOCH_VERSION = (3, 38, 0)
+
+
+def epoch_sql(column: str) -> str:
+    """
+    SQL for the unix epoch of a timestamp column of the travel DB, NULL for NULL or "\\N".
+    Timestamps come as "2024-05-01 10:00:00.000+03" in the downloaded DB, and as
+    "2024-05-01 10:00:00.123456+03:00" once rewritten by pandas, but SQLite only
+    understands the UTC offset as "+HH:MM".
+    """
+    value = f"CASE WHEN {column} GLOB '*[+-][0-9][0-9]' THEN {column} || ':00' ELSE {column} END"
+    if sqlite3.sqlite_version_info >= UNIXEPOCH_VERSION:
+        return f"unixepoch({value})"
+    return f"CAST(strftime('%s', {value}) AS INTEGER)"
+
+
+def has_fts(conn: sqlite3.Connection, table: str) -> bool:
+    """
+    Whether `table` has a full-text index (see `database.FTS_TABLES`), in any of the
+    databases of `conn`. Not cached, as indexing a DB adds it.
+    """
+    fts = f"{table}_fts"
+    return any(
+        conn.execute(f"SELECT 1 FROM {schema}.sqlite_master WHERE name = ?", (fts,)).fetchone()
+        for _, schema, _ in conn.execute("PRAGMA database_list").fetchall()
+    )
+
+
+def fts_from_where(table: str) -> str:
+    """The `FROM ... WHERE ...` of a full-text search on `table`, whose param is the `fts_match`"""
+    return f"FROM {table}_fts JOIN {table} ON {table}.id = {table}_fts.rowid WHERE {table}_fts MATCH ?"
+
+
+def fts_keys(table: str) -> tuple[str, str]:
+    """The sort keys of a full-text search on `table` (see `fetch_page`): best matches first"""
+    return f"{table}_fts.rank", f"{table}.id"
+
+
+def fts_match(terms: dict[str, Iterable[Optional[str]]]) -> Optional[str]:
+    """
+    Build an FTS5 `MATCH` expression from column -> search terms. A row matches if, for
+    every column, any of its terms is in it, where the last word of a term can be a
+    prefix: "grand hy" matches "Grand Hyatt". Terms are reduced to their words and
+    quoted, so nothing the LLM passes can be interpreted as FTS5 syntax.
+    Returns None if there is nothing to search for.
+    """
+    filters = []
+    for column, column_terms in terms.items():
+        phrases = []
+        for term in column_terms:
+            words = re.findall(r"\w+", term or "")
+            if words:
+                phrases.append(f'"{" ".join(words)}"*')
+        if phrases:
+            filters.append(f"{column} : ({' OR '.join(phrases)})")
+    return " AND ".join(filters) or None
+
+
+def _signature(*parts) -> str:
+    return hashlib.sha256(repr(parts).encode()).hexdigest()[:16]
+
+
+def encode_cursor(signature: str, after: list, total) -> str:
+    state = json.dumps({"search": signature, "after": after, "total": total})
+    return base64.urlsafe_b64encode(state.encode()).decode()
+
+
+def decode_cursor(cursor: str, signature: str) -> dict:
+    try:
+        state = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except ValueError:
+        state = None
+    if not isinstance(state, dict):
+        raise ValueError("Invalid cursor. Repeat the search without a cursor to start over.")
+    if state.get("search") != signature:
+        raise ValueError(
+            "This cursor belongs to a different search. Pass the same filters as the call "
+            "that returned it, or repeat the search without a cursor to start over."
+        )
+    return state
+
+
+def count_estimate(conn: sqlite3.Connection, from_where: str, params: Sequence = ()):
+    """Number of matching rows, or e.g. "1000+" if there are more than `COUNT_LIMIT`"""
+    (count,) = conn.execute(
+        f"SELECT count(*) FROM (SELECT 1 {from_where} LIMIT ?)", [*params, COUNT_LIMIT + 1]
+    ).fetchone()
+    return count if count <= COUNT_LIMIT else f"{COUNT_LIMIT}+"
+
+
+def page_query(select: str, from_where: str, keys: Sequence[str], after: bool = False) -> str:
+    """
+    The query `fetch_page` runs for a page (the first one, or one `after` a cursor). Its
+    params are those of `from_where`, then the keys of the previous page's last row (if
+    `after`), then the number of rows.
+    """
+    key_list = ", ".join(keys)
+    if after:
+        from_where += f" AND ({key_list}) > ({', '.join('?' * len(keys))})"
+    # the keys are selected too (under names that can't clash), to build the cursor
+    key_columns = ", ".join(f"{key} AS _key{i}" for i, key in enumerate(keys))
+    return f"SELECT {select}, {key_columns} {from_where} ORDER BY {key_list} LIMIT ?"
+
+
+def fetch_page(
+    conn: sqlite3.Connection,
+    select: str,
+    from_where: str,
+    params: Sequence,
+    keys: Sequence[str],
+    limit: int,
+    cursor: Optional[str] = None,
+) -> dict:
+    """
+    One page of `SELECT {select} {from_where}`, using keyset pagination: rows are sorted by
+    `keys` (which must identify a row, e.g. end with the primary key), and the next page
+    starts right after the keys of the last row returned, so each page is an index range
+    read rather than an `OFFSET` that reads and skips everything before it.
+
+    Returns the rows, plus the `next_cursor` to pass back for the next page (None on the
+    last one) and the `total_estimate` of matching rows (see `count_estimate`).
+    """
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    # a cursor is only valid for the search that created it
+    signature = _signature(from_where, [str(param) for param in params], tuple(keys))
+    state = decode_cursor(cursor, signature) if cursor else None
+
+    page_params = list(params)
+    if state is not None:
+        page_params.extend(state["after"])
+    query = page_query(select, from_where, keys, after=state is not None)
+    # one extra row tells whether there's a next page
+    rows = fetch_dicts(conn, query, [*page_params, limit + 1])
+
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    total = state["total"] if state is not None else count_estimate(conn, from_where, params)
+    after = [rows[-1][f"_key{i}"] for i in range(len(keys))] if rows else []
+    for row in rows:
+        for i in range(len(keys)):
+            del row[f"_key{i}"]
+    return {
+        "results": rows,
+        "next_cursor": encode_cursor(signature, after, total) if has_more else None,
+        "total_estimate": total,
+    }
@@ -0,0 +1,205 @@
+"""
+Cache of read-only tool results, per DB file.
+
+Within a conversation, the assistant calls the same read tools with the same arguments
+over and over (e.g. `fetch_user_flight_information` after every change, to confirm it).
+`cached_tool` serves those repeats from memory, keyed by (tool, arguments, passenger_id),
+with LRU eviction and a TTL.
+
+Entries remember the version of every table they read (see `VERSIONS_TABLE`),
+and are only served while those versions are unchanged, so a booking invalidates hotel
+searches but not flight searches. To notice writes from any connection or process, a
+`_Watcher` keeps its own connection to the DB (which never writes) and asks SQLite for
+`PRAGMA data_version`, which changes whenever *another* connection commits. Only then
+does it re-read the (tiny) versions table. So a repeat read costs that pragma, but no
+query. DBs without a versions table still work: any commit invalidates everything.
+"""
+
+import copy
+import functools
+import inspect
+import json
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Callable, Sequence
+
+from lg_tutorials.customer_support.db_pool import add_close_listener, get_db, get_pool
+
+# A version per table, bumped on every write (see `database.create_version_tracking`)
+VERSIONS_TABLE = "_table_versions"
+
+
+@dataclass
+class ResultCacheStats:
+    hits: int = 0
+    misses: int = 0
+    stale: int = 0  # found, but expired or invalidated by a write
+
+
+class _Watcher:
+    """Tracks the version of each table of a DB, as seen by any connection"""
+
+    def __init__(self, db: str):
+        self._conn = get_pool(db).open_connection()
+        # `main` last, so its versions override those of attached DBs (see `SnapshotManager`)
+        self._schemas = [
+            name for _, name, _ in self._conn.execute("PRAGMA database_list") if name != "temp"
+        ]
+        self._schemas.sort(key=lambda name: name == "main")
+        self._data_versions = None
+        self._generation = 0
+        self._versions: dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def versions(self, tables: Sequence[str]) -> tuple:
+        with self._lock:
+            data_versions = [
+                self._conn.execute(f"PRAGMA {schema}.data_version").fetchone()[0]
+                for schema in self._schemas
+            ]
+            if data_versions != self._data_versions:
+                self._data_versions = data_versions
+                self._generation += 1
+                self._versions = self._read_versions()
+            # tables without a version change with every commit
+            return tuple(self._versions.get(table, ("any", self._generation)) for table in tables)
+
+    def _read_versions(self) -> dict[str, int]:
+        versions = {}
+        for schema in self._schemas:
+            has_versions = self._conn.execute(
+                f"SELECT 1 FROM {schema}.sqlite_master WHERE type = 'table' AND name = ?",
+                (VERSIONS_TABLE,),
+            ).fetchone()
+            if has_versions:
+                rows = self._conn.execute(f"SELECT name, version FROM {schema}.{VERSIONS_TABLE}")
+                versions.update(rows)
+        return versions
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class ResultCache:
+
+    def __init__(self, db: str, max_entries: int = 1024, ttl: float = 300.0):
+        self.db = db
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.stats = ResultCacheStats()
+        self._watcher = _Watcher(db)
+        # key -> (expires at, table versions, result)
+        self._entries: OrderedDict[str, tuple[float, tuple, object]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def versions(self, tables: Sequence[str]) -> tuple:
+        return self._watcher.versions(tables)
+
+    def get(self, key: str, versions: tuple):
+        """The result for `key`, if cached with the same table `versions` and not expired"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.stats.misses += 1
+                return None
+            expires_at, entry_versions, result = entry
+            if entry_versions != versions or time.monotonic() > expires_at:
+                del self._entries[key]
+                self.stats.stale += 1
+                return None
+            self._entries.move_to_end(key)
+            self.stats.hits += 1
+        # callers may modify what they get, which must not change the cached copy
+        return copy.deepcopy(result)
+
+    def put(self, key: str, versions: tuple, result):
+        """`versions` must be read before running the query, so a concurrent write makes it stale"""
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, versions, copy.deepcopy(result))
+            self._entries.move_to_end(key)
+            if len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def close(self):
+        with self._lock:
+            self._entries.clear()
+        self._watcher.close()
+
+
+_caches: dict[str, ResultCache] = {}
+_caches_lock = threading.Lock()
+
+
+def get_result_cache(db: str) -> ResultCache:
+    with _caches_lock:
+        cache = _caches.get(db)
+        if cache is None:
+            cache = _caches[db] = ResultCache(db)
+        return cache
+
+
+def drop_result_cache(db: str):
+    with _caches_lock:
+        cache = _caches.pop(db, None)
+    if cache is not None:
+        cache.close()
+
+
+def result_cache_stats() -> dict[str, ResultCacheStats]:
+    with _caches_lock:
+        return {db: cache.stats for db, cache in _caches.items()}
+
+
+# a replaced file (e.g. by `update_dates`) has nothing to do with what we cached from it
+add_close_listener(drop_result_cache)
+
+
+def _normalize(value):
+    if isinstance(value, str):
+        return value.strip()
+    if isinstance(value, (list, tuple)):
+        return [_normalize(item) for item in value]
+    return value
+
+
+def cached_tool(tables: Sequence[str]) -> Callable:
+    """
+    Cache the results of a read-only tool reading `tables`. Goes between `@tool` and the
+    function, which must take `config: RunnableConfig` (the DB and passenger come from it):
+
+        @tool
+        @cached_tool(tables=("hotels",))
+        def search_hotels(..., *, config: RunnableConfig) -> dict:
+    """
+    tables = tuple(tables)
+
+    def decorator(func: Callable) -> Callable:
+        signature = inspect.signature(func)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            config = bound.arguments["config"]
+            arguments = {
+                name: _normalize(value)
+                for name, value in bound.arguments.items()
+                if name != "config" and value is not None
+            }
+            passenger_id = config.get("configurable", {}).get("passenger_id")
+            key = json.dumps([func.__name__, arguments, passenger_id], sort_keys=True, default=str)
+
+            cache = get_result_cache(get_db(config))
+            versions = cache.versions(tables)
+            result = cache.get(key, versions)
+            if result is None:
+                result = func(*args, **kwargs)
+                cache.put(key, versions, result)
+            return result
+
+        return wrapper
+
+    return decorator
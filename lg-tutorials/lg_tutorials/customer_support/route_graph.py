@@ -0,0 +1,139 @@
+"""
+Multi-leg itinerary search over the `flights` table.
+
+`search_flights` only finds direct flights, so finding a connection takes the assistant
+a search per leg (and an LLM turn per search). `RouteGraph` loads the flights once into
+a time-expanded graph, where each flight can be followed by any flight leaving its
+arrival airport between `min_connection` and `max_connection` seconds after it lands,
+and `search` runs a Dijkstra-style label search on it, ordered by arrival time. Each
+flight is settled at most `limit` times, so finding the top `limit` itineraries only
+expands the labels that could still be part of one.
+
+Graphs are cached per DB, and rebuilt when the flights change (see `result_cache` for how
+that's tracked) or the DB is replaced.
+"""
+
+import bisect
+import heapq
+import itertools
+import threading
+from collections import Counter
+from typing import Iterator, NamedTuple
+
+from lg_tutorials.customer_support.db_pool import add_close_listener, connection
+from lg_tutorials.customer_support.result_cache import get_result_cache
+
+
+class Flight(NamedTuple):
+    flight_id: int
+    flight_no: str
+    departure_airport: str
+    arrival_airport: str
+    scheduled_departure: str
+    scheduled_arrival: str
+    departure_epoch: int
+    arrival_epoch: int
+
+
+class RouteGraph:
+
+    def __init__(self, flights: list[Flight]):
+        self.flights = flights
+        # airport -> (departure epochs, indexes into `flights`), both sorted by departure
+        self._departures: dict[str, tuple[list[int], list[int]]] = {}
+        order = sorted(range(len(flights)), key=lambda idx: flights[idx].departure_epoch)
+        for idx in order:
+            epochs, indexes = self._departures.setdefault(flights[idx].departure_airport, ([], []))
+            epochs.append(flights[idx].departure_epoch)
+            indexes.append(idx)
+
+    @classmethod
+    def load(cls, conn) -> "RouteGraph":
+        rows = conn.execute(
+            "SELECT flight_id, flight_no, departure_airport, arrival_airport, "
+            "scheduled_departure, scheduled_arrival, scheduled_departure_epoch, scheduled_arrival_epoch "
+            "FROM flights WHERE status != 'Cancelled' "
+            "AND scheduled_departure_epoch IS NOT NULL AND scheduled_arrival_epoch IS NOT NULL"
+        ).fetchall()
+        return cls([Flight(*row) for row in rows])
+
+    def _departing(self, airport: str, earliest: int, latest: int) -> Iterator[int]:
+        """Indexes of the flights leaving `airport` between `earliest` and `latest`"""
+        epochs, indexes = self._departures.get(airport, ([], []))
+        start = bisect.bisect_left(epochs, earliest)
+        end = bisect.bisect_right(epochs, latest)
+        return iter(indexes[start:end])
+
+    def search(
+        self,
+        origin: str,
+        destination: str,
+        earliest: int,
+        latest: int,
+        max_legs: int = 3,
+        min_connection: int = 3600,
+        max_connection: int = 24 * 3600,
+        limit: int = 5,
+    ) -> list[list[Flight]]:
+        """
+        Up to `limit` itineraries from `origin` to `destination`, leaving between the
+        `earliest` and `latest` epochs, with at most `max_legs` flights and no airport
+        visited twice. Sorted by arrival time, then by number of legs.
+        """
+        flights = self.flights
+        counter = itertools.count()  # tie-breaker, so the heap never compares paths
+        # labels are (arrival epoch, legs, tie-breaker, path as indexes into `flights`)
+        heap = [
+            (flights[idx].arrival_epoch, 1, next(counter), (idx,))
+            for idx in self._departing(origin, earliest, latest)
+        ]
+        heapq.heapify(heap)
+        settled = Counter()
+        itineraries = []
+        while heap and len(itineraries) < limit:
+            arrival, legs, _, path = heapq.heappop(heap)
+            last = path[-1]
+            # any later label ending with this flight can only lead to slower itineraries
+            # than the `limit` that already went through it
+            if settled[last] >= limit:
+                continue
+            settled[last] += 1
+
+            airport = flights[last].arrival_airport
+            if airport == destination:
+                itineraries.append([flights[idx] for idx in path])
+                continue
+            if legs == max_legs:
+                continue
+            visited = {origin, *(flights[idx].arrival_airport for idx in path)}
+            for idx in self._departing(airport, arrival + min_connection, arrival + max_connection):
+                if flights[idx].arrival_airport not in visited:
+                    heapq.heappush(heap, (flights[idx].arrival_epoch, legs + 1, next(counter), path + (idx,)))
+        return itineraries
+
+
+# db -> (versions of `flights` when loaded, graph)
+_graphs: dict[str, tuple[tuple, RouteGraph]] = {}
+_graphs_lock = threading.Lock()
+
+
+def get_route_graph(db: str) -> RouteGraph:
+    # read before loading, so a concurrent change to the flights makes the graph stale
+    versions = get_result_cache(db).versions(("flights",))
+    with _graphs_lock:
+        entry = _graphs.get(db)
+        if entry is not None and entry[0] == versions:
+            return entry[1]
+    with connection(db) as conn:
+        graph = RouteGraph.load(conn)
+    with _graphs_lock:
+        _graphs[db] = (versions, graph)
+    return graph
+
+
+def drop_route_graph(db: str):
+    with _graphs_lock:
+        _graphs.pop(db, None)
+
+
+add_close_listener(drop_route_graph)
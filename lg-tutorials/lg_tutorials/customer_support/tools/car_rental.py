@@ -1,18 +1,39 @@
-import sqlite3
 from datetime import date, datetime
 from typing import Optional, Union
 
-from langchain_core.tools import tool
+from langchain_core.runnables import RunnableConfig
+from lg_tutorials.customer_support.async_tools import db_tool
+from lg_tutorials.customer_support.db_pool import connection, get_db
+from lg_tutorials.customer_support.queries import (
+    fetch_page,
+    fts_from_where,
+    fts_keys,
+    fts_match,
+    has_fts,
+    select_list,
+)
+from lg_tutorials.customer_support.result_cache import cached_tool
 
 
-@tool
+# see `database.PLAN_CHECKS`
+BOOK_CAR_RENTAL = "UPDATE car_rentals SET booked = 1 WHERE id = ? RETURNING id"
+
+
+@db_tool
+@cached_tool(tables=("car_rentals",))
 def search_car_rentals(
     location: Optional[str] = None,
     name: Optional[str] = None,
     price_tier: Optional[str] = None,
     start_date: Optional[Union[datetime, date]] = None,
     end_date: Optional[Union[datetime, date]] = None,
-) -> list[dict]:
+    columns: Optional[list[str]] = None,
+    full_text: bool = False,
+    limit: int = 20,
+    cursor: Optional[str] = None,
+    *,
+    config: RunnableConfig,
+) -> dict:
     """
     Search for car rentals based on location, name, price tier, start date, and end date.
 
@@ -22,34 +43,40 @@ def search_car_rentals(
         price_tier (Optional[str]): The price tier of the car rental. Defaults to None.
         start_date (Optional[Union[datetime, date]]): The start date of the car rental. Defaults to None.
         end_date (Optional[Union[datetime, date]]): The end date of the car rental. Defaults to None.
+        columns (Optional[list[str]]): Only return these columns. Defaults to None, meaning all columns.
+        full_text (bool): Match whole words and word prefixes instead of substrings, best matches first. Defaults to False.
+        limit (int): The maximum number of results per page (at most 50). Defaults to 20.
+        cursor (Optional[str]): The `next_cursor` of a previous call with the same filters, to get the next page. Defaults to None.
 
     Returns:
-        list[dict]: A list of car rental dictionaries matching the search criteria.
+        dict: A page of car rental dictionaries matching the search criteria under `results`, the `next_cursor` (None on the last page) and a `total_estimate` of matches.
     """
-    conn = sqlite3.connect(db)
-    cursor = conn.cursor()
-
-    query = "SELECT * FROM car_rentals WHERE 1=1"
+    conditions = ""
     params = []
 
     if location:
-        query += " AND location LIKE ?"
+        conditions += " AND location LIKE ?"
         params.append(f"%{location}%")
     if name:
-        query += " AND name LIKE ?"
+        conditions += " AND name LIKE ?"
         params.append(f"%{name}%")
     # For our tutorial, we will let you match on any dates and price tier.
     # (since our toy dataset doesn't have much data)
-    cursor.execute(query, params)
-    results = cursor.fetchall()
+    with connection(get_db(config)) as conn:
+        # ranked search on the full-text index, if the DB has one
+        match = fts_match({"location": [location], "name": [name]}) if full_text else None
+        if match and has_fts(conn, "car_rentals"):
+            select = select_list(conn, "car_rentals", columns, qualified=True)
+            from_where, keys = fts_from_where("car_rentals"), fts_keys("car_rentals")
+            return fetch_page(conn, select, from_where, [match], keys, limit, cursor)
 
-    conn.close()
+        select = select_list(conn, "car_rentals", columns)
+        from_where = f"FROM car_rentals WHERE 1=1{conditions}"
+        return fetch_page(conn, select, from_where, params, ("id",), limit, cursor)
 
-    return [dict(zip([column[0] for column in cursor.description], row)) for row in results]
 
-
-@tool
-def book_car_rental(rental_id: int) -> str:
+@db_tool
+def book_car_rental(rental_id: int, *, config: RunnableConfig) -> str:
     """
     Book a car rental by its ID.
 
@@ -59,25 +86,23 @@ def book_car_rental(rental_id: int) -> str:
     Returns:
         str: A message indicating whether the car rental was successfully booked or not.
     """
-    conn = sqlite3.connect(db)
-    cursor = conn.cursor()
-
-    cursor.execute("UPDATE car_rentals SET booked = 1 WHERE id = ?", (rental_id,))
-    conn.commit()
+    with connection(get_db(config)) as conn:
+        updated = conn.execute(BOOK_CAR_RENTAL, (rental_id,)).fetchall()
+        conn.commit()
 
-    if cursor.rowcount > 0:
-        conn.close()
+    if updated:
         return f"Car rental {rental_id} successfully booked."
     else:
-        conn.close()
         return f"No car rental found with ID {rental_id}."
 
 
-@tool
+@db_tool
 def update_car_rental(
     rental_id: int,
     start_date: Optional[Union[datetime, date]] = None,
     end_date: Optional[Union[datetime, date]] = None,
+    *,
+    config: RunnableConfig,
 ) -> str:
     """
     Update a car rental's start and end dates by its ID.
@@ -90,29 +115,28 @@ def update_car_rental(
     Returns:
         str: A message indicating whether the car rental was successfully updated or not.
     """
-    conn = sqlite3.connect(db)
-    cursor = conn.cursor()
-
-    if start_date:
-        cursor.execute(
-            "UPDATE car_rentals SET start_date = ? WHERE id = ?",
-            (start_date, rental_id),
-        )
-    if end_date:
-        cursor.execute("UPDATE car_rentals SET end_date = ? WHERE id = ?", (end_date, rental_id))
-
-    conn.commit()
-
-    if cursor.rowcount > 0:
-        conn.close()
+    with connection(get_db(config)) as conn:
+        cursor = conn.cursor()
+        updated = []
+        if start_date:
+            updated = cursor.execute(
+                "UPDATE car_rentals SET start_date = ? WHERE id = ? RETURNING id",
+                (start_date, rental_id),
+            ).fetchall()
+        if end_date:
+            updated = cursor.execute(
+                "UPDATE car_rentals SET end_date = ? WHERE id = ? RETURNING id", (end_date, rental_id)
+            ).fetchall()
+        conn.commit()
+
+    if updated:
         return f"Car rental {rental_id} successfully updated."
     else:
-        conn.close()
         return f"No car rental found with ID {rental_id}."
 
 
-@tool
-def cancel_car_rental(rental_id: int) -> str:
+@db_tool
+def cancel_car_rental(rental_id: int, *, config: RunnableConfig) -> str:
     """
     Cancel a car rental by its ID.
 
@@ -122,15 +146,13 @@ def cancel_car_rental(rental_id: int) -> str:
     Returns:
         str: A message indicating whether the car rental was successfully cancelled or not.
     """
-    conn = sqlite3.connect(db)
-    cursor = conn.cursor()
-
-    cursor.execute("UPDATE car_rentals SET booked = 0 WHERE id = ?", (rental_id,))
-    conn.commit()
+    with connection(get_db(config)) as conn:
+        updated = conn.execute(
+            "UPDATE car_rentals SET booked = 0 WHERE id = ? RETURNING id", (rental_id,)
+        ).fetchall()
+        conn.commit()
 
-    if cursor.rowcount > 0:
-        conn.close()
+    if updated:
         return f"Car rental {rental_id} successfully cancelled."
     else:
-        conn.close()
         return f"No car rental found with ID {rental_id}."
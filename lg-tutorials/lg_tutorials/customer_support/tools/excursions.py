@@ -1,15 +1,36 @@
-import sqlite3
 from typing import Optional
 
-from langchain_core.tools import tool
+from langchain_core.runnables import RunnableConfig
+from lg_tutorials.customer_support.async_tools import db_tool
+from lg_tutorials.customer_support.db_pool import connection, get_db
+from lg_tutorials.customer_support.queries import (
+    fetch_page,
+    fts_from_where,
+    fts_keys,
+    fts_match,
+    has_fts,
+    select_list,
+)
+from lg_tutorials.customer_support.result_cache import cached_tool
 
 
-@tool
+# see `database.PLAN_CHECKS`
+BOOK_EXCURSION = "UPDATE trip_recommendations SET booked = 1 WHERE id = ? RETURNING id"
+
+
+@db_tool
+@cached_tool(tables=("trip_recommendations",))
 def search_trip_recommendations(
     location: Optional[str] = None,
     name: Optional[str] = None,
     keywords: Optional[str] = None,
-) -> list[dict]:
+    columns: Optional[list[str]] = None,
+    full_text: bool = False,
+    limit: int = 20,
+    cursor: Optional[str] = None,
+    *,
+    config: RunnableConfig,
+) -> dict:
     """
     Search for trip recommendations based on location, name, and keywords.
 
@@ -17,38 +38,45 @@ def search_trip_recommendations(
         location (Optional[str]): The location of the trip recommendation. Defaults to None.
         name (Optional[str]): The name of the trip recommendation. Defaults to None.
         keywords (Optional[str]): The keywords associated with the trip recommendation. Defaults to None.
+        columns (Optional[list[str]]): Only return these columns. Defaults to None, meaning all columns.
+        full_text (bool): Match whole words and word prefixes instead of substrings, best matches first. Defaults to False.
+        limit (int): The maximum number of results per page (at most 50). Defaults to 20.
+        cursor (Optional[str]): The `next_cursor` of a previous call with the same filters, to get the next page. Defaults to None.
 
     Returns:
-        list[dict]: A list of trip recommendation dictionaries matching the search criteria.
+        dict: A page of trip recommendation dictionaries matching the search criteria under `results`, the `next_cursor` (None on the last page) and a `total_estimate` of matches.
     """
-    conn = sqlite3.connect(db)
-    cursor = conn.cursor()
-
-    query = "SELECT * FROM trip_recommendations WHERE 1=1"
+    conditions = ""
     params = []
+    keyword_list = keywords.split(",") if keywords else []
 
     if location:
-        query += " AND location LIKE ?"
+        conditions += " AND location LIKE ?"
         params.append(f"%{location}%")
     if name:
-        query += " AND name LIKE ?"
+        conditions += " AND name LIKE ?"
         params.append(f"%{name}%")
     if keywords:
-        keyword_list = keywords.split(",")
         keyword_conditions = " OR ".join(["keywords LIKE ?" for _ in keyword_list])
-        query += f" AND ({keyword_conditions})"
+        conditions += f" AND ({keyword_conditions})"
         params.extend([f"%{keyword.strip()}%" for keyword in keyword_list])
 
-    cursor.execute(query, params)
-    results = cursor.fetchall()
-
-    conn.close()
+    with connection(get_db(config)) as conn:
+        # ranked search on the full-text index, if the DB has one
+        terms = {"location": [location], "name": [name], "keywords": keyword_list}
+        match = fts_match(terms) if full_text else None
+        if match and has_fts(conn, "trip_recommendations"):
+            select = select_list(conn, "trip_recommendations", columns, qualified=True)
+            from_where, keys = fts_from_where("trip_recommendations"), fts_keys("trip_recommendations")
+            return fetch_page(conn, select, from_where, [match], keys, limit, cursor)
 
-    return [dict(zip([column[0] for column in cursor.description], row)) for row in results]
+        select = select_list(conn, "trip_recommendations", columns)
+        from_where = f"FROM trip_recommendations WHERE 1=1{conditions}"
+        return fetch_page(conn, select, from_where, params, ("id",), limit, cursor)
 
 
-@tool
-def book_excursion(recommendation_id: int) -> str:
+@db_tool
+def book_excursion(recommendation_id: int, *, config: RunnableConfig) -> str:
     """
     Book a excursion by its recommendation ID.
 
@@ -58,22 +86,18 @@ def book_excursion(recommendation_id: int) -> str:
     Returns:
         str: A message indicating whether the trip recommendation was successfully booked or not.
     """
-    conn = sqlite3.connect(db)
-    cursor = conn.cursor()
+    with connection(get_db(config)) as conn:
+        updated = conn.execute(BOOK_EXCURSION, (recommendation_id,)).fetchall()
+        conn.commit()
 
-    cursor.execute("UPDATE trip_recommendations SET booked = 1 WHERE id = ?", (recommendation_id,))
-    conn.commit()
-
-    if cursor.rowcount > 0:
-        conn.close()
+    if updated:
         return f"Trip recommendation {recommendation_id} successfully booked."
     else:
-        conn.close()
         return f"No trip recommendation found with ID {recommendation_id}."
 
 
-@tool
-def update_excursion(recommendation_id: int, details: str) -> str:
+@db_tool
+def update_excursion(recommendation_id: int, details: str, *, config: RunnableConfig) -> str:
     """
     Update a trip recommendation's details by its ID.
 
@@ -84,25 +108,21 @@ def update_excursion(recommendation_id: int, details: str) -> str:
     Returns:
         str: A message indicating whether the trip recommendation was successfully updated or not.
     """
-    conn = sqlite3.connect(db)
-    cursor = conn.cursor()
-
-    cursor.execute(
-        "UPDATE trip_recommendations SET details = ? WHERE id = ?",
-        (details, recommendation_id),
-    )
-    conn.commit()
-
-    if cursor.rowcount > 0:
-        conn.close()
+    with connection(get_db(config)) as conn:
+        updated = conn.execute(
+            "UPDATE trip_recommendations SET details = ? WHERE id = ? RETURNING id",
+            (details, recommendation_id),
+        ).fetchall()
+        conn.commit()
+
+    if updated:
         return f"Trip recommendation {recommendation_id} successfully updated."
     else:
-        conn.close()
         return f"No trip recommendation found with ID {recommendation_id}."
 
 
-@tool
-def cancel_excursion(recommendation_id: int) -> str:
+@db_tool
+def cancel_excursion(recommendation_id: int, *, config: RunnableConfig) -> str:
     """
     Cancel a trip recommendation by its ID.
 
@@ -112,15 +132,13 @@ def cancel_excursion(recommendation_id: int) -> str:
     Returns:
         str: A message indicating whether the trip recommendation was successfully cancelled or not.
     """
-    conn = sqlite3.connect(db)
-    cursor = conn.cursor()
-
-    cursor.execute("UPDATE trip_recommendations SET booked = 0 WHERE id = ?", (recommendation_id,))
-    conn.commit()
+    with connection(get_db(config)) as conn:
+        updated = conn.execute(
+            "UPDATE trip_recommendations SET booked = 0 WHERE id = ? RETURNING id", (recommendation_id,)
+        ).fetchall()
+        conn.commit()
 
-    if cursor.rowcount > 0:
-        conn.close()
+    if updated:
         return f"Trip recommendation {recommendation_id} successfully cancelled."
     else:
-        conn.close()
         return f"No trip recommendation found with ID {recommendation_id}."
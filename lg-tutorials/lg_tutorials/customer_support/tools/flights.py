@@ -1,13 +1,51 @@
-import sqlite3
-from datetime import date, datetime
+import time
+from datetime import date, datetime, timedelta, timezone
 from typing import Optional
 
-import pytz
 from langchain_core.runnables import RunnableConfig
-from langchain_core.tools import tool
+from lg_tutorials.customer_support.async_tools import db_tool
+from lg_tutorials.customer_support.db_pool import connection, get_db, write_transaction
+from lg_tutorials.customer_support.queries import fetch_dicts, fetch_page, select_list
+from lg_tutorials.customer_support.result_cache import cached_tool
+from lg_tutorials.customer_support.route_graph import get_route_graph
 
+# the flight times in the DB are all in this timezone
+FLIGHTS_TIMEZONE = timezone(timedelta(hours=3))
 
-@tool
+
+def to_epoch(value: date | datetime, end_of_day: bool = False) -> int:
+    """
+    Unix epoch of `value`, taken in `FLIGHTS_TIMEZONE` if it has no timezone. A date
+    means its start, or its last second with `end_of_day`.
+    """
+    if not isinstance(value, datetime):
+        value = datetime.combine(value, datetime.min.time())
+        if end_of_day:
+            value += timedelta(days=1, seconds=-1)
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=FLIGHTS_TIMEZONE)
+    return int(value.timestamp())
+
+
+# The fixed statements of the tools are module constants, so `database.PLAN_CHECKS` can
+# check the query plans of exactly what runs
+USER_FLIGHTS_QUERY = """
+SELECT
+    t.ticket_no, t.book_ref,
+    f.flight_id, f.flight_no, f.departure_airport, f.arrival_airport, f.scheduled_departure, f.scheduled_arrival,
+    bp.seat_no, tf.fare_conditions
+FROM
+    tickets t
+    JOIN ticket_flights tf ON t.ticket_no = tf.ticket_no
+    JOIN flights f ON tf.flight_id = f.flight_id
+    JOIN boarding_passes bp ON bp.ticket_no = t.ticket_no AND bp.flight_id = f.flight_id
+WHERE
+    t.passenger_id = ?
+"""
+
+
+@db_tool
+@cached_tool(tables=("tickets", "ticket_flights", "flights", "boarding_passes"))
 def fetch_user_flight_information(config: RunnableConfig) -> list[dict]:
     """Fetch all tickets for the user along with corresponding flight information and seat assignments.
 
@@ -20,79 +58,189 @@ def fetch_user_flight_information(config: RunnableConfig) -> list[dict]:
     if not passenger_id:
         raise ValueError("No passenger ID configured.")
 
-    conn = sqlite3.connect(configuration["db"])
-    # import pdb; pdb.set_trace()
-    cursor = conn.cursor()
-
-    query = """
-    SELECT 
-        t.ticket_no, t.book_ref,
-        f.flight_id, f.flight_no, f.departure_airport, f.arrival_airport, f.scheduled_departure, f.scheduled_arrival,
-        bp.seat_no, tf.fare_conditions
-    FROM 
-        tickets t
-        JOIN ticket_flights tf ON t.ticket_no = tf.ticket_no
-        JOIN flights f ON tf.flight_id = f.flight_id
-        JOIN boarding_passes bp ON bp.ticket_no = t.ticket_no AND bp.flight_id = f.flight_id
-    WHERE 
-        t.passenger_id = ?
-    """
-    cursor.execute(query, (passenger_id,))
-    rows = cursor.fetchall()
-    column_names = [column[0] for column in cursor.description]
-    results = [dict(zip(column_names, row)) for row in rows]
+    with connection(get_db(config)) as conn:
+        return fetch_dicts(conn, USER_FLIGHTS_QUERY, (passenger_id,))
 
-    cursor.close()
-    conn.close()
 
-    return results
+# the sort keys of `search_flights`, which the flights' indexes end with
+FLIGHTS_KEYS = ("scheduled_departure_epoch", "flight_id")
 
 
-@tool
-def search_flights(
-    db: str,
+def flights_from_where(
     departure_airport: Optional[str] = None,
     arrival_airport: Optional[str] = None,
     start_time: Optional[date | datetime] = None,
     end_time: Optional[date | datetime] = None,
-    limit: int = 20,
-) -> list[dict]:
-    """Search for flights based on departure airport, arrival airport, and departure time range."""
-    conn = sqlite3.connect(db)
-    cursor = conn.cursor()
-
-    query = "SELECT * FROM flights WHERE 1 = 1"
+) -> tuple[str, list]:
+    """The `FROM ... WHERE ...` of `search_flights` for these filters, and its params"""
+    conditions = ""
     params = []
 
     if departure_airport:
-        query += " AND departure_airport = ?"
+        conditions += " AND departure_airport = ?"
         params.append(departure_airport)
 
     if arrival_airport:
-        query += " AND arrival_airport = ?"
+        conditions += " AND arrival_airport = ?"
         params.append(arrival_airport)
 
+    # compared as epochs, so the index on them gives us the time window as a range
     if start_time:
-        query += " AND scheduled_departure >= ?"
-        params.append(start_time)
+        conditions += " AND scheduled_departure_epoch >= ?"
+        params.append(to_epoch(start_time))
 
     if end_time:
-        query += " AND scheduled_departure <= ?"
-        params.append(end_time)
-    query += " LIMIT ?"
-    params.append(limit)
-    cursor.execute(query, params)
-    rows = cursor.fetchall()
-    column_names = [column[0] for column in cursor.description]
-    results = [dict(zip(column_names, row)) for row in rows]
+        conditions += " AND scheduled_departure_epoch <= ?"
+        params.append(to_epoch(end_time, end_of_day=True))
+
+    return f"FROM flights WHERE 1 = 1{conditions}", params
 
-    cursor.close()
-    conn.close()
 
-    return results
+@db_tool
+@cached_tool(tables=("flights",))
+def search_flights(
+    departure_airport: Optional[str] = None,
+    arrival_airport: Optional[str] = None,
+    start_time: Optional[date | datetime] = None,
+    end_time: Optional[date | datetime] = None,
+    limit: int = 20,
+    columns: Optional[list[str]] = None,
+    cursor: Optional[str] = None,
+    *,
+    config: RunnableConfig,
+) -> dict:
+    """Search for flights based on departure airport, arrival airport, and departure time range.
+    Pass `columns` to only return those columns (e.g. ["flight_id", "scheduled_departure"]).
+    Naive times are in the airports' timezone (UTC+3), and an `end_time` date includes that whole day.
+    Flights come sorted by departure time, in pages of `limit` (at most 50) under `results`,
+    along with a `total_estimate` of matches. To get the next page, repeat the call with the
+    returned `next_cursor` as `cursor` (it's None on the last page)."""
+    from_where, params = flights_from_where(departure_airport, arrival_airport, start_time, end_time)
+    with connection(get_db(config)) as conn:
+        select = select_list(conn, "flights", columns)
+        return fetch_page(conn, select, from_where, params, FLIGHTS_KEYS, limit, cursor)
+
+
+# server-side caps for `search_itineraries`
+MAX_ITINERARIES = 10
+MAX_LEGS = 4
 
 
-@tool
+def _find_itineraries(
+    departure_airport: str,
+    arrival_airport: str,
+    earliest: int,
+    latest: int,
+    max_legs: int,
+    min_connection_minutes: int,
+    limit: int,
+    *,
+    config: RunnableConfig,
+) -> list[dict]:
+    itineraries = get_route_graph(get_db(config)).search(
+        departure_airport,
+        arrival_airport,
+        earliest,
+        latest,
+        max_legs=max(1, min(max_legs, MAX_LEGS)),
+        min_connection=min_connection_minutes * 60,
+        limit=max(1, min(limit, MAX_ITINERARIES)),
+    )
+    return [
+        {
+            "departure": legs[0].scheduled_departure,
+            "arrival": legs[-1].scheduled_arrival,
+            "duration_minutes": (legs[-1].arrival_epoch - legs[0].departure_epoch) // 60,
+            "legs": [
+                {
+                    "flight_id": leg.flight_id,
+                    "flight_no": leg.flight_no,
+                    "departure_airport": leg.departure_airport,
+                    "arrival_airport": leg.arrival_airport,
+                    "scheduled_departure": leg.scheduled_departure,
+                    "scheduled_arrival": leg.scheduled_arrival,
+                }
+                for leg in legs
+            ],
+        }
+        for legs in itineraries
+    ]
+
+
+# keyed on the departure window, once resolved to epochs
+_cached_find_itineraries = cached_tool(tables=("flights",))(_find_itineraries)
+
+
+@db_tool
+def search_itineraries(
+    departure_airport: str,
+    arrival_airport: str,
+    start_time: Optional[date | datetime] = None,
+    end_time: Optional[date | datetime] = None,
+    max_legs: int = 3,
+    min_connection_minutes: int = 60,
+    limit: int = 5,
+    *,
+    config: RunnableConfig,
+) -> list[dict]:
+    """Search for itineraries from departure airport to arrival airport, direct or with connections.
+    Use it to find alternatives with connections in a single call, e.g. when rebooking.
+    Naive times are in the airports' timezone (UTC+3).
+
+    Args:
+        departure_airport (str): The airport to depart from.
+        arrival_airport (str): The airport to arrive at.
+        start_time (Optional[Union[datetime, date]]): Depart no earlier than this. Defaults to None, meaning now.
+        end_time (Optional[Union[datetime, date]]): Depart no later than this (a date includes the whole day). Defaults to None, meaning one day after `start_time`.
+        max_legs (int): The maximum number of flights per itinerary (at most 4). Defaults to 3.
+        min_connection_minutes (int): The minimum time between landing and the next departure. Defaults to 60.
+        limit (int): The maximum number of itineraries (at most 10). Defaults to 5.
+
+    Returns:
+        list[dict]: Itineraries sorted by arrival time, each with its `departure`, `arrival`, `duration_minutes` and `legs` (the flights to take).
+    """
+    if start_time is None:
+        # a window starting now moves on with the clock, so it isn't cached: a result
+        # cached a few minutes ago could list flights that have departed since
+        earliest = int(time.time())
+        find = _find_itineraries
+    else:
+        earliest = to_epoch(start_time)
+        find = _cached_find_itineraries
+    latest = to_epoch(end_time, end_of_day=True) if end_time else earliest + 24 * 3600
+    return find(
+        departure_airport,
+        arrival_airport,
+        earliest,
+        latest,
+        max_legs,
+        min_connection_minutes,
+        limit,
+        config=config,
+    )
+
+
+# Everything `update_ticket_to_new_flight` and `cancel_ticket` check, in one statement
+_TICKET_CHECKS = """
+    EXISTS (SELECT 1 FROM ticket_flights WHERE ticket_no = :ticket_no) AS has_flights,
+    EXISTS (
+        SELECT 1 FROM tickets WHERE ticket_no = :ticket_no AND passenger_id = :passenger_id
+    ) AS is_owner"""
+VALIDATE_CANCEL = f"SELECT {_TICKET_CHECKS}"
+# a flight without a valid departure time (e.g. "\N", so a NULL epoch) is no valid new flight
+VALIDATE_CHANGE = f"""
+SELECT {_TICKET_CHECKS},
+    (
+        SELECT scheduled_departure FROM flights
+        WHERE flight_id = :flight_id AND scheduled_departure_epoch IS NOT NULL
+    ) AS departure,
+    (SELECT scheduled_departure_epoch FROM flights WHERE flight_id = :flight_id) AS departure_epoch
+"""
+UPDATE_TICKET_FLIGHT = "UPDATE ticket_flights SET flight_id = ? WHERE ticket_no = ?"
+CANCEL_TICKET = "DELETE FROM ticket_flights WHERE ticket_no = ?"
+
+
+@db_tool
 def update_ticket_to_new_flight(
     ticket_no: str,
     new_flight_id: int,
@@ -105,94 +253,51 @@ def update_ticket_to_new_flight(
     if not passenger_id:
         raise ValueError("No passenger ID configured.")
 
-    conn = sqlite3.connect(db)
-    cursor = conn.cursor()
+    # the checks and the update share one transaction, holding the write lock throughout,
+    # so no other session can change the ticket in between
+    with write_transaction(get_db(config)) as conn:
+        has_flights, is_owner, departure, departure_epoch = conn.execute(
+            VALIDATE_CHANGE,
+            {"ticket_no": ticket_no, "passenger_id": passenger_id, "flight_id": new_flight_id},
+        ).fetchone()
+        if departure is None or departure_epoch is None:
+            return "Invalid new flight ID provided."
+        if departure_epoch - time.time() < 3 * 3600:
+            return f"Not permitted to reschedule to a flight that is less than 3 hours from the current time. Selected flight is at {departure}."
+        if not has_flights:
+            return "No existing ticket found for the given ticket number."
+        # Check the signed-in user actually has this ticket
+        if not is_owner:
+            return f"Current signed-in passenger with ID {passenger_id} not the owner of ticket {ticket_no}"
 
-    cursor.execute(
-        "SELECT departure_airport, arrival_airport, scheduled_departure FROM flights WHERE flight_id = ?",
-        (new_flight_id,),
-    )
-    new_flight = cursor.fetchone()
-    if not new_flight:
-        cursor.close()
-        conn.close()
-        return "Invalid new flight ID provided."
-    column_names = [column[0] for column in cursor.description]
-    new_flight_dict = dict(zip(column_names, new_flight))
-    timezone = pytz.timezone("Etc/GMT-3")
-    current_time = datetime.now(tz=timezone)
-    departure_time = datetime.strptime(
-        new_flight_dict["scheduled_departure"], "%Y-%m-%d %H:%M:%S.%f%z"
-    )
-    time_until = (departure_time - current_time).total_seconds()
-    if time_until < (3 * 3600):
-        return f"Not permitted to reschedule to a flight that is less than 3 hours from the current time. Selected flight is at {departure_time}."
-
-    cursor.execute("SELECT flight_id FROM ticket_flights WHERE ticket_no = ?", (ticket_no,))
-    current_flight = cursor.fetchone()
-    if not current_flight:
-        cursor.close()
-        conn.close()
-        return "No existing ticket found for the given ticket number."
-
-    # Check the signed-in user actually has this ticket
-    cursor.execute(
-        "SELECT * FROM tickets WHERE ticket_no = ? AND passenger_id = ?",
-        (ticket_no, passenger_id),
-    )
-    current_ticket = cursor.fetchone()
-    if not current_ticket:
-        cursor.close()
-        conn.close()
-        return f"Current signed-in passenger with ID {passenger_id} not the owner of ticket {ticket_no}"
-
-    # In a real application, you'd likely add additional checks here to enforce business logic,
-    # like "does the new departure airport match the current ticket", etc.
-    # While it's best to try to be *proactive* in 'type-hinting' policies to the LLM
-    # it's inevitably going to get things wrong, so you **also** need to ensure your
-    # API enforces valid behavior
-    cursor.execute(
-        "UPDATE ticket_flights SET flight_id = ? WHERE ticket_no = ?",
-        (new_flight_id, ticket_no),
-    )
-    conn.commit()
+        # In a real application, you'd likely add additional checks here to enforce business logic,
+        # like "does the new departure airport match the current ticket", etc.
+        # While it's best to try to be *proactive* in 'type-hinting' policies to the LLM
+        # it's inevitably going to get things wrong, so you **also** need to ensure your
+        # API enforces valid behavior
+        conn.execute(UPDATE_TICKET_FLIGHT, (new_flight_id, ticket_no))
 
-    cursor.close()
-    conn.close()
     return "Ticket successfully updated to new flight."
 
 
-@tool
+@db_tool
 def cancel_ticket(ticket_no: str, *, config: RunnableConfig) -> str:
     """Cancel the user's ticket and remove it from the database."""
     configuration = config.get("configurable", {})
     passenger_id = configuration.get("passenger_id", None)
     if not passenger_id:
         raise ValueError("No passenger ID configured.")
-    conn = sqlite3.connect(db)
-    cursor = conn.cursor()
-
-    cursor.execute("SELECT flight_id FROM ticket_flights WHERE ticket_no = ?", (ticket_no,))
-    existing_ticket = cursor.fetchone()
-    if not existing_ticket:
-        cursor.close()
-        conn.close()
-        return "No existing ticket found for the given ticket number."
-
-    # Check the signed-in user actually has this ticket
-    cursor.execute(
-        "SELECT flight_id FROM tickets WHERE ticket_no = ? AND passenger_id = ?",
-        (ticket_no, passenger_id),
-    )
-    current_ticket = cursor.fetchone()
-    if not current_ticket:
-        cursor.close()
-        conn.close()
-        return f"Current signed-in passenger with ID {passenger_id} not the owner of ticket {ticket_no}"
 
-    cursor.execute("DELETE FROM ticket_flights WHERE ticket_no = ?", (ticket_no,))
-    conn.commit()
+    with write_transaction(get_db(config)) as conn:
+        has_flights, is_owner = conn.execute(
+            VALIDATE_CANCEL, {"ticket_no": ticket_no, "passenger_id": passenger_id}
+        ).fetchone()
+        if not has_flights:
+            return "No existing ticket found for the given ticket number."
+        # Check the signed-in user actually has this ticket
+        if not is_owner:
+            return f"Current signed-in passenger with ID {passenger_id} not the owner of ticket {ticket_no}"
+
+        conn.execute(CANCEL_TICKET, (ticket_no,))
 
-    cursor.close()
-    conn.close()
     return "Ticket successfully cancelled."
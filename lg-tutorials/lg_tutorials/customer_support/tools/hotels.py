@@ -1,18 +1,39 @@
-import sqlite3
 from datetime import date, datetime
 from typing import Optional
 
-from langchain_core.tools import tool
+from langchain_core.runnables import RunnableConfig
+from lg_tutorials.customer_support.async_tools import db_tool
+from lg_tutorials.customer_support.db_pool import connection, get_db
+from lg_tutorials.customer_support.queries import (
+    fetch_page,
+    fts_from_where,
+    fts_keys,
+    fts_match,
+    has_fts,
+    select_list,
+)
+from lg_tutorials.customer_support.result_cache import cached_tool
 
 
-@tool
+# see `database.PLAN_CHECKS`
+BOOK_HOTEL = "UPDATE hotels SET booked = 1 WHERE id = ? RETURNING id"
+
+
+@db_tool
+@cached_tool(tables=("hotels",))
 def search_hotels(
     location: Optional[str] = None,
     name: Optional[str] = None,
     price_tier: Optional[str] = None,
     checkin_date: Optional[datetime | date] = None,
     checkout_date: Optional[datetime | date] = None,
-) -> list[dict]:
+    columns: Optional[list[str]] = None,
+    full_text: bool = False,
+    limit: int = 20,
+    cursor: Optional[str] = None,
+    *,
+    config: RunnableConfig,
+) -> dict:
     """
     Search for hotels based on location, name, price tier, check-in date, and check-out date.
 
@@ -22,33 +43,39 @@ def search_hotels(
         price_tier (Optional[str]): The price tier of the hotel. Defaults to None. Examples: Midscale, Upper Midscale, Upscale, Luxury
         checkin_date (Optional[Union[datetime, date]]): The check-in date of the hotel. Defaults to None.
         checkout_date (Optional[Union[datetime, date]]): The check-out date of the hotel. Defaults to None.
+        columns (Optional[list[str]]): Only return these columns. Defaults to None, meaning all columns.
+        full_text (bool): Match whole words and word prefixes instead of substrings, best matches first. Defaults to False.
+        limit (int): The maximum number of results per page (at most 50). Defaults to 20.
+        cursor (Optional[str]): The `next_cursor` of a previous call with the same filters, to get the next page. Defaults to None.
 
     Returns:
-        list[dict]: A list of hotel dictionaries matching the search criteria.
+        dict: A page of hotel dictionaries matching the search criteria under `results`, the `next_cursor` (None on the last page) and a `total_estimate` of matches.
     """
-    conn = sqlite3.connect(db)
-    cursor = conn.cursor()
-
-    query = "SELECT * FROM hotels WHERE 1=1"
+    conditions = ""
     params = []
 
     if location:
-        query += " AND location LIKE ?"
+        conditions += " AND location LIKE ?"
         params.append(f"%{location}%")
     if name:
-        query += " AND name LIKE ?"
+        conditions += " AND name LIKE ?"
         params.append(f"%{name}%")
     # For the sake of this tutorial, we will let you match on any dates and price tier.
-    cursor.execute(query, params)
-    results = cursor.fetchall()
+    with connection(get_db(config)) as conn:
+        # ranked search on the full-text index, if the DB has one
+        match = fts_match({"location": [location], "name": [name]}) if full_text else None
+        if match and has_fts(conn, "hotels"):
+            select = select_list(conn, "hotels", columns, qualified=True)
+            from_where, keys = fts_from_where("hotels"), fts_keys("hotels")
+            return fetch_page(conn, select, from_where, [match], keys, limit, cursor)
 
-    conn.close()
+        select = select_list(conn, "hotels", columns)
+        from_where = f"FROM hotels WHERE 1=1{conditions}"
+        return fetch_page(conn, select, from_where, params, ("id",), limit, cursor)
 
-    return [dict(zip([column[0] for column in cursor.description], row)) for row in results]
 
-
-@tool
-def book_hotel(hotel_id: int) -> str:
+@db_tool
+def book_hotel(hotel_id: int, *, config: RunnableConfig) -> str:
     """
     Book a hotel by its ID.
 
@@ -58,25 +85,23 @@ def book_hotel(hotel_id: int) -> str:
     Returns:
         str: A message indicating whether the hotel was successfully booked or not.
     """
-    conn = sqlite3.connect(db)
-    cursor = conn.cursor()
-
-    cursor.execute("UPDATE hotels SET booked = 1 WHERE id = ?", (hotel_id,))
-    conn.commit()
+    with connection(get_db(config)) as conn:
+        updated = conn.execute(BOOK_HOTEL, (hotel_id,)).fetchall()
+        conn.commit()
 
-    if cursor.rowcount > 0:
-        conn.close()
+    if updated:
         return f"Hotel {hotel_id} successfully booked."
     else:
-        conn.close()
         return f"No hotel found with ID {hotel_id}."
 
 
-@tool
+@db_tool
 def update_hotel(
     hotel_id: int,
     checkin_date: Optional[datetime | date] = None,
     checkout_date: Optional[datetime | date] = None,
+    *,
+    config: RunnableConfig,
 ) -> str:
     """
     Update a hotel's check-in and check-out dates by its ID.
@@ -89,29 +114,28 @@ def update_hotel(
     Returns:
         str: A message indicating whether the hotel was successfully updated or not.
     """
-    conn = sqlite3.connect(db)
-    cursor = conn.cursor()
-
-    if checkin_date:
-        cursor.execute("UPDATE hotels SET checkin_date = ? WHERE id = ?", (checkin_date, hotel_id))
-    if checkout_date:
-        cursor.execute(
-            "UPDATE hotels SET checkout_date = ? WHERE id = ?",
-            (checkout_date, hotel_id),
-        )
-
-    conn.commit()
-
-    if cursor.rowcount > 0:
-        conn.close()
+    with connection(get_db(config)) as conn:
+        cursor = conn.cursor()
+        updated = []
+        if checkin_date:
+            updated = cursor.execute(
+                "UPDATE hotels SET checkin_date = ? WHERE id = ? RETURNING id", (checkin_date, hotel_id)
+            ).fetchall()
+        if checkout_date:
+            updated = cursor.execute(
+                "UPDATE hotels SET checkout_date = ? WHERE id = ? RETURNING id",
+                (checkout_date, hotel_id),
+            ).fetchall()
+        conn.commit()
+
+    if updated:
         return f"Hotel {hotel_id} successfully updated."
     else:
-        conn.close()
         return f"No hotel found with ID {hotel_id}."
 
 
-@tool
-def cancel_hotel(hotel_id: int) -> str:
+@db_tool
+def cancel_hotel(hotel_id: int, *, config: RunnableConfig) -> str:
     """
     Cancel a hotel by its ID.
 
@@ -121,15 +145,13 @@ def cancel_hotel(hotel_id: int) -> str:
     Returns:
         str: A message indicating whether the hotel was successfully cancelled or not.
     """
-    conn = sqlite3.connect(db)
-    cursor = conn.cursor()
-
-    cursor.execute("UPDATE hotels SET booked = 0 WHERE id = ?", (hotel_id,))
-    conn.commit()
+    with connection(get_db(config)) as conn:
+        updated = conn.execute(
+            "UPDATE hotels SET booked = 0 WHERE id = ? RETURNING id", (hotel_id,)
+        ).fetchall()
+        conn.commit()
 
-    if cursor.rowcount > 0:
-        conn.close()
+    if updated:
         return f"Hotel {hotel_id} successfully cancelled."
     else:
-        conn.close()
         return f"No hotel found with ID {hotel_id}."
@@ -2,22 +2,56 @@ import re
 from pathlib import Path
 
 import numpy as np
-import openai
-import pandas as pd
-import requests
-from langchain_core.tools import tool
+from lang_examples_common.utils.lazy_utils import Lazy
+from langchain_core.tools import StructuredTool
+from lg_tutorials.customer_support.artifacts import fetch_artifact
+from lg_tutorials.customer_support.async_tools import run_in_db_executor
+from lg_tutorials.customer_support.embedding_cache import EmbeddingCache, normalize_text
+from lg_tutorials.customer_support.lexical_index import BM25Index
+from lg_tutorials.customer_support.vector_index import ExactIndex, VectorIndex
+from lg_tutorials.customer_support.vector_store import VectorStore, normalize
+
+FAQ_URL = "https://storage.googleapis.com/benchmarks-artifacts/travel-db/swiss_faq.md"
+# sha256 of the FAQ the tutorial was written against (see `notebooks/swiss_faq.md`)
+FAQ_SHA256 = "864c718edfcf80ef46575a16180210ecb41c354a891bf397a0b29dcb96f585f1"
 
 
 class VectorStoreRetriever:
 
     md_file = Path("swiss_faq.md")
     vectors_file = Path("vectors")
-
-    def __init__(self, oai_client):
-
+    # float16 or int8 make the store 2x or 4x smaller, at a small cost in precision
+    vectors_dtype = "float32"
+    model = "text-embedding-3-small"
+    # hybrid mode answers from BM25 alone when its best doc matches at least this share
+    # of the query (by idf), and outscores the runner-up by this factor. Calibrated on 46
+    # questions labelled with their FAQ section (half worded like the FAQ, half
+    # paraphrased): 57% are answered by BM25 alone, all correctly, while every wrong
+    # BM25 top doc covered less than half of its query
+    min_lexical_coverage = 0.8
+    min_lexical_margin = 1.5
+    # reciprocal rank fusion constant: higher flattens the contribution of top ranks
+    rrf_k = 60
+
+    def __init__(
+        self,
+        oai_client,
+        async_oai_client=None,
+        embedding_cache: EmbeddingCache | None = None,
+        index: VectorIndex | None = None,
+    ):
+        """
+        `index` defaults to an exact scan over every doc. For large corpora, pass an
+        `IVFIndex` (see `vector_index`) to only score the most promising clusters.
+        `async_oai_client` is used by the async methods (`aquery`, ...), if given.
+        """
         self._docs = self.get_docs()
+        self._lexical = BM25Index([doc["page_content"] for doc in self._docs])
         self._client = oai_client
-        self._arr = self.get_vectors()
+        self._async_client = async_oai_client
+        self._cache = embedding_cache or EmbeddingCache()
+        self._store = self.get_vectors()
+        self._index = (index or ExactIndex()).build(self._store)
 
     def get_docs(self):
         self.download_if_needed()
@@ -26,14 +60,7 @@ class VectorStoreRetriever:
     def download_if_needed(self):
         if self.md_file.exists():
             return
-
-        response = requests.get(
-            "https://storage.googleapis.com/benchmarks-artifacts/travel-db/swiss_faq.md"
-        )
-        response.raise_for_status()
-        faq_text = response.text
-        with open(self.md_file, "w") as f:
-            f.write(faq_text)
+        fetch_artifact(FAQ_URL, self.md_file, sha256=FAQ_SHA256)
 
     def create_docs(self):
         with open(self.md_file, "r") as f:
@@ -41,35 +68,173 @@ class VectorStoreRetriever:
 
         return [{"page_content": txt} for txt in re.split(r"(?=\n##)", faq_text)]
 
-    def get_vectors(self):
-        if self.vectors_file.exists():
-            return pd.read_pickle(self.vectors_file)
-
-        embeddings = self._client.embeddings.create(
-            model="text-embedding-3-small", input=[doc["page_content"] for doc in self._docs]
-        )
-        vectors = np.array([emb.embedding for emb in embeddings.data])
-        pd.to_pickle(vectors, self.vectors_file)
-        return vectors
-
-    def query(self, query: str, k: int = 5) -> list[dict]:
-        embed = self._client.embeddings.create(model="text-embedding-3-small", input=[query])
-        # "@" is just a matrix multiplication in numpy
-        scores = np.array(embed.data[0].embedding) @ self._arr.T
-        # get the top k scores...
-        top_k_idx = np.argpartition(scores, -k)[-k:]
-        # but order is not guaranteed, so now we order, but the amount to order
-        # is just k <<< num docs
-        top_k_idx_sorted = top_k_idx[np.argsort(-scores[top_k_idx])]
-        return [{**self._docs[idx], "similarity": scores[idx]} for idx in top_k_idx_sorted]
+    def get_vectors(self) -> VectorStore:
+        # only the docs that changed since the store was built get embedded
+        store = VectorStore(self.vectors_file, dtype=self.vectors_dtype)
+        return store.sync([doc["page_content"] for doc in self._docs], self.model, self.embed_documents)
+
+    def embed_documents(self, texts: list[str]) -> np.ndarray:
+        embeddings = self._client.embeddings.create(model=self.model, input=texts)
+        return np.array([emb.embedding for emb in embeddings.data])
+
+    def _missing_embeddings(self, queries: list[str]) -> tuple[list, dict[str, str]]:
+        """Cached embedding of each query (or None), and the queries to embed"""
+        embeddings = [self._cache.get(query, self.model) for query in queries]
+        # normalized text -> query, so we don't embed the same query twice
+        missing = {normalize_text(q): q for q, e in zip(queries, embeddings) if e is None}
+        return embeddings, missing
+
+    def _add_embeddings(self, queries: list[str], embeddings: list, missing: dict[str, str], data) -> np.ndarray:
+        """Cache the embeddings `data` of the `missing` queries, and fill them in"""
+        new = {
+            key: self._cache.put(query, self.model, item.embedding)
+            for (key, query), item in zip(missing.items(), data)
+        }
+        return np.stack([new[normalize_text(q)] if e is None else e for q, e in zip(queries, embeddings)])
+
+    def embed_queries(self, queries: list[str]) -> np.ndarray:
+        """Embed `queries`, with a single request for all those not in the cache"""
+        embeddings, missing = self._missing_embeddings(queries)
+        if not missing:
+            return np.stack(embeddings)
+        embed = self._client.embeddings.create(model=self.model, input=list(missing.values()))
+        return self._add_embeddings(queries, embeddings, missing, embed.data)
+
+    async def aembed_queries(self, queries: list[str]) -> np.ndarray:
+        """
+        Same as `embed_queries`, with the async client (the cache, on disk, is read and
+        written in the DB executor). Without an async client, runs `embed_queries` there.
+        """
+        if self._async_client is None:
+            return await run_in_db_executor(self.embed_queries, queries)
+        embeddings, missing = await run_in_db_executor(self._missing_embeddings, queries)
+        if not missing:
+            return np.stack(embeddings)
+        embed = await self._async_client.embeddings.create(model=self.model, input=list(missing.values()))
+        return await run_in_db_executor(self._add_embeddings, queries, embeddings, missing, embed.data)
+
+    def embed_query(self, query: str) -> np.ndarray:
+        return self.embed_queries([query])[0]
+
+    def _vector_results(self, query_embeddings: np.ndarray, k: int) -> list[list[dict]]:
+        scores, ids = self._index.search(normalize(query_embeddings), k)
+        return [
+            [
+                {**self._docs[idx], "similarity": float(score)}
+                for score, idx in zip(row_scores, row_ids)
+                # approximate indexes pad with -1 when they find less than k docs
+                if idx >= 0
+            ]
+            for row_scores, row_ids in zip(scores, ids)
+        ]
+
+    def query_batch(self, queries: list[str], k: int = 5) -> list[list[dict]]:
+        """
+        Retrieve the top `k` docs for each query, with their cosine similarity.
+        All queries are embedded in one request, and (with the default exact index)
+        scored in one matrix product.
+        """
+        return self._vector_results(self.embed_queries(queries), k)
+
+    async def aquery_batch(self, queries: list[str], k: int = 5) -> list[list[dict]]:
+        return self._vector_results(await self.aembed_queries(queries), k)
+
+    def lexical_query(self, query: str, k: int = 5, confident_only: bool = False) -> list[dict] | None:
+        """
+        Top `k` docs by BM25 score, without any network call. With `confident_only`,
+        returns None unless the best doc is a clear match (see `min_lexical_coverage`)
+        """
+        scores, ids = self._lexical.search(query, max(k, 2))
+        if confident_only:
+            if not len(ids):
+                return None
+            runner_up = scores[1] if len(scores) > 1 else 0.0
+            if (
+                scores[0] < self.min_lexical_margin * runner_up
+                or self._lexical.coverage(query, ids[0]) < self.min_lexical_coverage
+            ):
+                return None
+        return [{**self._docs[idx], "score": float(score)} for score, idx in zip(scores[:k], ids[:k])]
+
+    def _fuse(
+        self,
+        results: list[list[dict] | None],
+        queries: list[str],
+        query_embeddings: np.ndarray,
+        k: int,
+        num_candidates: int,
+    ) -> list[list[dict]]:
+        """
+        Fill the missing `results` fusing the BM25 and vector rankings of their queries,
+        in order (`query_embeddings` has a row per missing result)
+        """
+        pending = [row for row, result in enumerate(results) if result is None]
+        _, vector_ids = self._index.search(normalize(query_embeddings), num_candidates)
+        for row, row_vector_ids in zip(pending, vector_ids):
+            _, lexical_ids = self._lexical.search(queries[row], num_candidates)
+            fused = {}
+            for ranking in (lexical_ids, row_vector_ids[row_vector_ids >= 0]):
+                for rank, idx in enumerate(ranking.tolist()):
+                    fused[idx] = fused.get(idx, 0.0) + 1 / (self.rrf_k + rank + 1)
+            top = sorted(fused.items(), key=lambda item: item[1], reverse=True)[:k]
+            results[row] = [{**self._docs[idx], "score": score} for idx, score in top]
+        return results
+
+    def hybrid_query_batch(self, queries: list[str], k: int = 5, num_candidates: int = 20) -> list[list[dict]]:
+        """
+        Retrieve the top `k` docs for each query, fusing the BM25 and vector rankings of
+        their top `num_candidates` with reciprocal rank fusion. Queries that BM25 alone
+        answers confidently are not embedded at all; the rest share one embeddings request.
+        """
+        results = [self.lexical_query(query, k, confident_only=True) for query in queries]
+        pending = [query for query, result in zip(queries, results) if result is None]
+        if not pending:
+            return results
+        return self._fuse(results, queries, self.embed_queries(pending), k, num_candidates)
+
+    async def ahybrid_query_batch(self, queries: list[str], k: int = 5, num_candidates: int = 20) -> list[list[dict]]:
+        results = [self.lexical_query(query, k, confident_only=True) for query in queries]
+        pending = [query for query, result in zip(queries, results) if result is None]
+        if not pending:
+            return results
+        return self._fuse(results, queries, await self.aembed_queries(pending), k, num_candidates)
+
+    def query(self, query: str, k: int = 5, hybrid: bool = False) -> list[dict]:
+        if hybrid:
+            return self.hybrid_query_batch([query], k=k)[0]
+        return self.query_batch([query], k=k)[0]
+
+    async def aquery(self, query: str, k: int = 5, hybrid: bool = False) -> list[dict]:
+        if hybrid:
+            return (await self.ahybrid_query_batch([query], k=k))[0]
+        return (await self.aquery_batch([query], k=k))[0]
+
+
+def _create_retriever() -> VectorStoreRetriever:
+    # openai alone takes longer to import than the rest of this module
+    import openai
+
+    return VectorStoreRetriever(openai.Client(), openai.AsyncClient())
+
+
+# built on the first `lookup_policy` call (downloading the FAQ and embedding it if
+# needed), so importing the tools doesn't need network or an API key.
+# Call `retriever.warm_up()` to build it in the background ahead of time.
+retriever = Lazy(_create_retriever)
+
+
+def _lookup_policy(query: str) -> str:
+    """Consult the company policies to check whether certain options are permitted.
+    Use this before making any flight changes performing other 'write' events."""
+    retrieved_docs = retriever.get().query(query, k=2, hybrid=True)
+    return "\n\n".join([doc["page_content"] for doc in retrieved_docs])
 
 
-retriever = VectorStoreRetriever(openai.Client())
+async def _alookup_policy(query: str) -> str:
+    # building the retriever may download and embed the FAQ, which blocks
+    vector_retriever = retriever.get() if retriever.initialized else await run_in_db_executor(retriever.get)
+    retrieved_docs = await vector_retriever.aquery(query, k=2, hybrid=True)
+    return "\n\n".join([doc["page_content"] for doc in retrieved_docs])
 
 
-@tool
-def lookup_policy(query: str) -> str:
-    """Consult the company policies to check whether certain options are permitted.
-    Use this before making any flight changes performing other 'write' events."""
-    retrieved_docs = retriever.query(query, k=2)
-    return "\n\n".join([doc["page_content"] for doc in retrieved_docs])
+lookup_policy = StructuredTool.from_function(func=_lookup_policy, coroutine=_alookup_policy, name="lookup_policy")
@@ -1,17 +1,92 @@
+import asyncio
+import functools
 import json
 import logging
+import sqlite3
+import time
 
 from lang_examples_common.utils.display_utils import wrap_text
 from langchain.schema import AIMessage, HumanMessage
 from langchain_core.messages import ToolMessage
 from langchain_core.runnables import RunnableLambda
 from langgraph.prebuilt import ToolNode
+from lg_tutorials.customer_support.async_tools import limit_session_concurrency
 
 logging.basicConfig(format="%(asctime)s - %(message)s")
 log = logging.getLogger("lang-examples")
 log.setLevel(logging.INFO)
 
 
+# SQLite errors where the same call would probably succeed a moment later: another
+# connection held the lock for longer than `busy_timeout`. A failed write was rolled back.
+TRANSIENT_ERRORS = ("database is locked", "database table is locked")
+
+
+def is_transient_error(error: Exception) -> bool:
+    return isinstance(error, sqlite3.OperationalError) and any(
+        message in str(error) for message in TRANSIENT_ERRORS
+    )
+
+
+def format_tool_error(error: Exception) -> str:
+    """
+    Content of the `ToolMessage` for a call that raised. Only that call is answered with
+    it, so the LLM knows the other calls of the same turn went through.
+    """
+    if is_transient_error(error):
+        hint = "The database was busy. Only this call failed, and it can be retried as is."
+    else:
+        hint = "Only this call failed: please fix your mistakes and retry just this one."
+    return json.dumps({"error": type(error).__name__, "message": str(error), "hint": hint})
+
+
+def retry_transient_errors(tools: list, max_attempts: int = 3, backoff: float = 0.1) -> list:
+    """
+    Copies of `tools` retrying calls that fail with a transient error (see
+    `is_transient_error`), up to `max_attempts` in total, waiting `backoff` seconds
+    before the first retry and doubling it each time. Only tools built from functions
+    (e.g. with `@tool` or `db_tool`) are wrapped; others are returned as they are.
+    """
+
+    def retry_func(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            for attempt in range(max_attempts):
+                try:
+                    return func(*args, **kwargs)
+                except sqlite3.OperationalError as e:
+                    if not is_transient_error(e) or attempt == max_attempts - 1:
+                        raise
+                    log.warning(f"{func.__name__} failed with {e!r}, retrying ({attempt + 1}/{max_attempts - 1})")
+                    time.sleep(backoff * 2**attempt)
+
+        return wrapper
+
+    def retry_coroutine(coroutine):
+        @functools.wraps(coroutine)
+        async def wrapper(*args, **kwargs):
+            for attempt in range(max_attempts):
+                try:
+                    return await coroutine(*args, **kwargs)
+                except sqlite3.OperationalError as e:
+                    if not is_transient_error(e) or attempt == max_attempts - 1:
+                        raise
+                    log.warning(f"{coroutine.__name__} failed with {e!r}, retrying ({attempt + 1}/{max_attempts - 1})")
+                    await asyncio.sleep(backoff * 2**attempt)
+
+        return wrapper
+
+    retrying = []
+    for tool in tools:
+        update = {}
+        if getattr(tool, "func", None) is not None:
+            update["func"] = retry_func(tool.func)
+        if getattr(tool, "coroutine", None) is not None:
+            update["coroutine"] = retry_coroutine(tool.coroutine)
+        retrying.append(tool.model_copy(update=update) if update else tool)
+    return retrying
+
+
 def handle_tool_error(state) -> dict:
     # this "error" key is the one we specify below as "exception_key"
     error = state.get("error")
@@ -27,8 +102,30 @@ def handle_tool_error(state) -> dict:
     }
 
 
-def create_tool_node_with_fallback(tools: list) -> dict:
-    return ToolNode(tools).with_fallbacks(
+def create_tool_node_with_fallback(
+    tools: list,
+    max_concurrency_per_session: int | None = 4,
+    isolate_errors: bool = True,
+    max_attempts: int = 3,
+):
+    """
+    On the async path (`graph.ainvoke` / `astream`), the tool calls of a turn run
+    concurrently, at most `max_concurrency_per_session` at a time per `thread_id`
+    (None for no limit). The sync path runs them in a thread pool, as before.
+
+    With `isolate_errors`, a call that raises gets its own error `ToolMessage` (see
+    `format_tool_error`), and the other calls keep their results. Otherwise, any error
+    answers every call of the turn with it (`handle_tool_error`), so the LLM redoes
+    all of them. Transient DB errors are retried up to `max_attempts` times first.
+    """
+    if max_attempts > 1:
+        tools = retry_transient_errors(tools, max_attempts)
+    if max_concurrency_per_session is not None:
+        tools = limit_session_concurrency(tools, max_concurrency_per_session)
+    if isolate_errors:
+        return ToolNode(tools, handle_tool_errors=format_tool_error)
+    # errors must reach the fallback, whatever the default of this langgraph version
+    return ToolNode(tools, handle_tool_errors=False).with_fallbacks(
         [RunnableLambda(handle_tool_error)],
         exception_key="error",
     )
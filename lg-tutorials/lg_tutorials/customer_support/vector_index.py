@@ -0,0 +1,209 @@
+"""
+Search indexes over a `VectorStore`.
+
+`ExactIndex` scores every vector, which is what you want for a corpus the size of
+`swiss_faq.md`. `IVFIndex` is an approximate (inverted file) index for much larger
+corpora: vectors are clustered with (spherical) k-means, and a query only scores the
+vectors in the `n_probe` clusters whose centroids are closest to it. `n_lists` and
+`n_probe` are the recall / latency knobs: more probes means better recall but more
+vectors scored per query.
+
+To compare them on your data, run `benchmark`, or this module for a synthetic run:
+    python -m lg_tutorials.customer_support.vector_index
+"""
+
+import time
+from pathlib import Path
+
+import numpy as np
+from lg_tutorials.customer_support.vector_store import VectorStore, _save_atomic, normalize
+
+
+def top_k(scores: np.ndarray, k: int, ids: np.ndarray | None = None):
+    """Top `k` (scores, ids) of each row of `scores`, sorted by decreasing score"""
+    k = min(k, scores.shape[1])
+    # get the top k scores of each row...
+    top_k_idx = np.argpartition(scores, -k, axis=1)[:, -k:]
+    # but order is not guaranteed, so now we order, but the amount to order
+    # is just k <<< num docs
+    top_k_scores = np.take_along_axis(scores, top_k_idx, axis=1)
+    order = np.argsort(-top_k_scores, axis=1)
+    top_k_idx = np.take_along_axis(top_k_idx, order, axis=1)
+    top_k_scores = np.take_along_axis(top_k_scores, order, axis=1)
+    return top_k_scores, (top_k_idx if ids is None else ids[top_k_idx])
+
+
+class VectorIndex:
+    """
+    Interface of the indexes. `search` takes normalized queries, one per row, and returns
+    the (scores, ids) of their top `k` vectors, each of shape (num_queries, k)
+    """
+
+    def build(self, store: VectorStore) -> "VectorIndex":
+        raise NotImplementedError
+
+    def search(self, queries: np.ndarray, k: int) -> tuple[np.ndarray, np.ndarray]:
+        raise NotImplementedError
+
+
+class ExactIndex(VectorIndex):
+
+    def build(self, store: VectorStore) -> "ExactIndex":
+        self.store = store
+        return self
+
+    def search(self, queries, k):
+        return top_k(self.store.scores(queries), k)
+
+
+class IVFIndex(VectorIndex):
+
+    def __init__(
+        self,
+        n_lists: int | None = None,
+        n_probe: int = 8,
+        n_iter: int = 20,
+        max_train_size: int = 50_000,
+        seed: int = 0,
+    ):
+        # None means ~4 * sqrt(num vectors), a usual starting point
+        self.n_lists = n_lists
+        self.n_probe = n_probe
+        self.n_iter = n_iter
+        self.max_train_size = max_train_size
+        self.seed = seed
+
+    def _index_file(self, store: VectorStore) -> Path:
+        return store.path.with_name(f"{store.path.name}.ivf.npz")
+
+    def build(self, store: VectorStore) -> "IVFIndex":
+        """Load the index saved next to the store, or train it if it's missing or stale"""
+        self.store = store
+        index_file = self._index_file(store)
+        if index_file.exists():
+            saved = np.load(index_file)
+            if str(saved["build"]) == store.manifest["build"] and (
+                self.n_lists is None or len(saved["centroids"]) == self.n_lists
+            ):
+                self.centroids, self.order, self.offsets = (
+                    saved["centroids"], saved["order"], saved["offsets"]
+                )
+                return self
+
+        self.train(store)
+        # written atomically, like the store's files, so a crash or a concurrent reader
+        # never sees a truncated index (and through a file object, or np.savez would add
+        # another ".npz")
+        _save_atomic(
+            index_file,
+            lambda f: np.savez(
+                f,
+                centroids=self.centroids,
+                order=self.order,
+                offsets=self.offsets,
+                build=store.manifest["build"],
+            ),
+        )
+        return self
+
+    def _assign(self, vectors: np.ndarray, centroids: np.ndarray, batch_size=8192) -> np.ndarray:
+        return np.concatenate(
+            [
+                np.argmax(vectors[i : i + batch_size] @ centroids.T, axis=1)
+                for i in range(0, len(vectors), batch_size)
+            ]
+        )
+
+    def train(self, store: VectorStore):
+        vectors = store.vectors()
+        num_vectors = len(vectors)
+        n_lists = self.n_lists or max(1, int(4 * np.sqrt(num_vectors)))
+        n_lists = min(n_lists, num_vectors)
+        rng = np.random.default_rng(self.seed)
+
+        # spherical k-means (cosine distance) on a sample
+        sample_size = min(num_vectors, max(self.max_train_size, 40 * n_lists))
+        sample = vectors[rng.choice(num_vectors, size=sample_size, replace=False)]
+        centroids = sample[rng.choice(sample_size, size=n_lists, replace=False)]
+        for _ in range(self.n_iter):
+            assignment = self._assign(sample, centroids)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignment, sample)
+            counts = np.bincount(assignment, minlength=n_lists)
+            # restart empty clusters from random points
+            empty = counts == 0
+            sums[empty] = sample[rng.choice(sample_size, size=empty.sum())]
+            centroids = normalize(sums)
+
+        # inverted lists: the ids of list `l` are order[offsets[l]:offsets[l + 1]]
+        assignment = self._assign(vectors, centroids)
+        self.centroids = centroids
+        self.order = np.argsort(assignment, kind="stable")
+        self.offsets = np.concatenate(([0], np.cumsum(np.bincount(assignment, minlength=n_lists))))
+
+    def search(self, queries, k):
+        n_probe = min(self.n_probe, len(self.centroids))
+        _, probes = top_k(queries @ self.centroids.T, n_probe)
+
+        all_scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        all_ids = np.full((len(queries), k), -1)
+        for row, (query, lists) in enumerate(zip(queries, probes)):
+            # sorted, so we read the store (likely memory-mapped) sequentially
+            ids = np.sort(
+                np.concatenate([self.order[self.offsets[l] : self.offsets[l + 1]] for l in lists])
+            )
+            if not len(ids):
+                continue
+            scores = self.store.vectors(ids) @ query
+            scores, ids = top_k(scores[None], k, ids=ids)
+            all_scores[row, : scores.shape[1]] = scores[0]
+            all_ids[row, : ids.shape[1]] = ids[0]
+        return all_scores, all_ids
+
+
+def benchmark(index: VectorIndex, reference: VectorIndex, queries: np.ndarray, k: int = 10) -> dict:
+    """
+    recall@k of `index` against `reference` (usually an `ExactIndex`), and the p50 / p99
+    latency of both, in ms per single query
+    """
+
+    def run(idx):
+        latencies, ids = [], []
+        for query in queries:
+            start = time.perf_counter()
+            _, query_ids = idx.search(query[None], k)
+            latencies.append((time.perf_counter() - start) * 1000)
+            ids.append(query_ids[0])
+        return np.array(latencies), ids
+
+    latencies, ids = run(index)
+    ref_latencies, ref_ids = run(reference)
+    recall = np.mean([len(set(a) & set(b)) / len(b) for a, b in zip(ids, ref_ids)])
+    return {
+        f"recall@{k}": float(recall),
+        "p50_ms": float(np.percentile(latencies, 50)),
+        "p99_ms": float(np.percentile(latencies, 99)),
+        "exact_p50_ms": float(np.percentile(ref_latencies, 50)),
+        "exact_p99_ms": float(np.percentile(ref_latencies, 99)),
+    }
+
+
+if __name__ == "__main__":
+    import tempfile
+
+    # clustered synthetic data, roughly like a large corpus of policy chunks
+    rng = np.random.default_rng(0)
+    num_docs, dim, num_topics = 50_000, 256, 500
+    topics = rng.normal(size=(num_topics, dim))
+    docs = topics[rng.integers(num_topics, size=num_docs)] + 1.5 * rng.normal(size=(num_docs, dim))
+    queries = normalize(
+        topics[rng.integers(num_topics, size=200)] + 1.5 * rng.normal(size=(200, dim))
+    )
+
+    with tempfile.TemporaryDirectory() as tmp:
+        store = VectorStore(Path(tmp) / "vectors")
+        store.sync([str(i) for i in range(num_docs)], "synthetic", lambda texts: docs)
+        exact = ExactIndex().build(store)
+        for n_probe in (1, 4, 8, 16, 32):
+            ivf = IVFIndex(n_probe=n_probe).build(store)
+            print(f"n_probe={n_probe}", benchmark(ivf, exact, queries, k=10))
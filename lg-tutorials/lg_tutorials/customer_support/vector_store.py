@@ -0,0 +1,181 @@
+"""
+On-disk store for the policy embeddings.
+
+The matrix is a `.npy` file opened with `mmap_mode="r"`, so loading it doesn't deserialize
+anything, and every process reading it shares the same pages through the OS cache.
+Vectors are stored L2-normalized, so a dot product against them is already a cosine
+similarity. Next to the matrix, a JSON manifest records which model produced the vectors,
+their dimension and dtype, and a content hash per document. That's what lets `sync` re-embed only the sections
+of the FAQ that actually changed, and throw everything away if the model did.
+
+    vectors.json                the manifest, pointing to the files below
+    vectors.<build>.npy         (num_docs, dim) matrix, in `dtype`
+    vectors.<build>.scales.npy  per-row scales, only for int8
+    vectors.lock                held by `sync`, so one process at a time reads or writes
+
+`<build>` is derived from the manifest contents, and the manifest is written last, so a
+reader always sees a consistent set of files, even if a writer crashes halfway. Older
+builds are deleted once the new manifest is in place, under the lock, so no other process
+can be between reading the manifest and opening the files it points to.
+"""
+
+import fcntl
+import hashlib
+import json
+import os
+import tempfile
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Callable
+
+import numpy as np
+
+MANIFEST_VERSION = 1
+DTYPES = ("float32", "float16", "int8")
+
+
+def content_hash(text: str) -> str:
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    """L2-normalize each row (leaving all-zero rows as they are)"""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1
+    return vectors / norms
+
+
+def _save_atomic(path: Path, save: Callable):
+    with tempfile.NamedTemporaryFile(dir=path.parent, suffix=path.suffix, delete=False) as f:
+        save(f)
+    os.replace(f.name, path)
+
+
+@contextmanager
+def _locked(path: Path):
+    with open(path, "w") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class VectorStore:
+
+    def __init__(self, path: str | Path, dtype: str = "float32"):
+        if dtype not in DTYPES:
+            raise ValueError(f"dtype must be one of {DTYPES}, got {dtype}")
+        self.path = Path(path)
+        self.manifest_file = self.path.with_suffix(".json")
+        self.lock_file = self.path.with_suffix(".lock")
+        self.dtype = dtype
+        self.matrix = None
+        self.scales = None
+        self.manifest = None
+
+    def _build_files(self, build: str) -> tuple[Path, Path]:
+        name = f"{self.path.name}.{build}"
+        return self.path.with_name(f"{name}.npy"), self.path.with_name(f"{name}.scales.npy")
+
+    def _load(self):
+        self.manifest = json.loads(self.manifest_file.read_text())
+        matrix_file, scales_file = self._build_files(self.manifest["build"])
+        self.matrix = np.load(matrix_file, mmap_mode="r")
+        self.scales = np.load(scales_file) if self.manifest["dtype"] == "int8" else None
+
+    def _is_compatible(self, model: str) -> bool:
+        if not self.manifest_file.exists():
+            return False
+        manifest = json.loads(self.manifest_file.read_text())
+        return (
+            manifest.get("version") == MANIFEST_VERSION
+            and manifest["model"] == model
+            and self._build_files(manifest["build"])[0].exists()
+        )
+
+    def vectors(self, rows=slice(None)) -> np.ndarray:
+        """The stored vectors as float32 (dequantized if needed)"""
+        vectors = np.asarray(self.matrix[rows], dtype=np.float32)
+        if self.scales is not None:
+            vectors *= self.scales[rows, None]
+        return vectors
+
+    def scores(self, queries: np.ndarray) -> np.ndarray:
+        """
+        Dot product of each query (one per row) against every stored vector, in a single
+        matrix-matrix product. For normalized queries, these are cosine similarities.
+        """
+        scores = queries.astype(np.float32) @ self.matrix.T.astype(np.float32, copy=False)
+        if self.scales is not None:
+            scores *= self.scales
+        return scores
+
+    def sync(self, texts: list[str], model: str, embed: Callable[[list[str]], np.ndarray]):
+        """
+        Make the store match `texts`, calling `embed` only for texts whose hash isn't
+        stored yet (all of them if there's no store, or it was built with another model).
+        Changing `dtype` converts the stored vectors without embedding anything.
+        Other processes syncing the same store wait for this one, and then find it
+        up to date, rather than embedding the same texts again.
+        """
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with _locked(self.lock_file):
+            return self._sync(texts, model, embed)
+
+    def _sync(self, texts: list[str], model: str, embed: Callable[[list[str]], np.ndarray]):
+        hashes = [content_hash(text) for text in texts]
+        known = {}
+        if self._is_compatible(model):
+            self._load()
+            if (
+                self.manifest["hashes"] == hashes
+                and self.manifest["dtype"] == self.dtype
+                and self.manifest.get("normalized")
+            ):
+                return self
+            known = {h: idx for idx, h in enumerate(self.manifest["hashes"])}
+
+        missing = {h: text for h, text in zip(hashes, texts) if h not in known}
+        new_vectors = {}
+        if missing:
+            embedded = np.asarray(embed(list(missing.values())), dtype=np.float32)
+            new_vectors = dict(zip(missing, embedded))
+
+        dim = next(iter(new_vectors.values())).shape[0] if new_vectors else self.matrix.shape[1]
+        vectors = np.empty((len(hashes), dim), dtype=np.float32)
+        for row, h in enumerate(hashes):
+            vectors[row] = new_vectors[h] if h in new_vectors else self.vectors(known[h])
+        self._write(normalize(vectors), hashes, model)
+        self._load()
+        return self
+
+    def _write(self, vectors: np.ndarray, hashes: list[str], model: str):
+        manifest = dict(
+            version=MANIFEST_VERSION,
+            model=model,
+            dim=int(vectors.shape[1]),
+            dtype=self.dtype,
+            normalized=True,
+            hashes=hashes,
+        )
+        manifest["build"] = content_hash(json.dumps(manifest))[:16]
+        matrix_file, scales_file = self._build_files(manifest["build"])
+
+        if self.dtype == "int8":
+            # symmetric per-row quantization: row ~= int8 row * scale
+            scales = np.abs(vectors).max(axis=1) / 127
+            scales[scales == 0] = 1
+            matrix = np.round(vectors / scales[:, None]).astype(np.int8)
+            _save_atomic(scales_file, lambda f: np.save(f, scales.astype(np.float32)))
+        else:
+            matrix = vectors.astype(self.dtype)
+        _save_atomic(matrix_file, lambda f: np.save(f, matrix))
+        _save_atomic(self.manifest_file, lambda f: f.write(json.dumps(manifest).encode()))
+
+        # files from previous builds are no longer referenced. Processes that still have
+        # them mapped keep reading them fine, as unlinking doesn't affect open mappings
+        for file in self.path.parent.glob(f"{self.path.name}.*.npy"):
+            if file not in (matrix_file, scales_file):
+                file.unlink(missing_ok=True)
@@ -0,0 +1,101 @@
+import sqlite3
+from datetime import datetime, timedelta
+
+import pytest
+from lg_tutorials.customer_support.database import create_indexes, shift_dates_in_place
+from lg_tutorials.customer_support.db_pool import close_pool
+
+AIRPORTS = ["BSL", "ZRH", "GVA", "CDG", "LHR", "AMS", "FRA", "MUC"]
+LOCATIONS = ["Basel", "Zurich", "Geneva"]
+
+
+def make_travel_db(path: str, num_flights: int = 200, num_tickets: int = 60) -> str:
+    """
+    A small DB with the tables and columns of the tutorial's travel DB, and its
+    timestamps ("2024-04-01 10:00:00.000+03", or "\\N" for missing ones)
+    """
+    conn = sqlite3.connect(path)
+    conn.executescript(
+        """
+        CREATE TABLE flights (flight_id INTEGER, flight_no TEXT, scheduled_departure TEXT,
+            scheduled_arrival TEXT, departure_airport TEXT, arrival_airport TEXT, status TEXT,
+            aircraft_code TEXT, actual_departure TEXT, actual_arrival TEXT);
+        CREATE TABLE tickets (ticket_no TEXT, book_ref TEXT, passenger_id TEXT);
+        CREATE TABLE ticket_flights (ticket_no TEXT, flight_id INTEGER, fare_conditions TEXT, amount REAL);
+        CREATE TABLE boarding_passes (ticket_no TEXT, flight_id INTEGER, boarding_no INTEGER, seat_no TEXT);
+        CREATE TABLE bookings (book_ref TEXT, book_date TEXT, total_amount REAL);
+        CREATE TABLE hotels (id INTEGER, name TEXT, location TEXT, price_tier TEXT,
+            checkin_date TEXT, checkout_date TEXT, booked INTEGER);
+        CREATE TABLE car_rentals (id INTEGER, name TEXT, location TEXT, price_tier TEXT,
+            start_date TEXT, end_date TEXT, booked INTEGER);
+        CREATE TABLE trip_recommendations (id INTEGER, name TEXT, location TEXT, keywords TEXT,
+            details TEXT, booked INTEGER);
+        """
+    )
+    start = datetime(2024, 4, 1)
+    for flight_id in range(num_flights):
+        departure = start + timedelta(hours=5 * flight_id)
+        arrival = departure + timedelta(hours=2)
+        # the last flights haven't departed yet
+        departed = flight_id < num_flights * 3 // 4
+        conn.execute(
+            "INSERT INTO flights VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                flight_id,
+                f"LX{flight_id:04d}",
+                f"{departure:%Y-%m-%d %H:%M:%S}.000+03",
+                f"{arrival:%Y-%m-%d %H:%M:%S}.000+03",
+                AIRPORTS[flight_id % len(AIRPORTS)],
+                AIRPORTS[(flight_id + 1) % len(AIRPORTS)],
+                "Arrived" if departed else "Scheduled",
+                "319",
+                f"{departure:%Y-%m-%d %H:%M:%S}.000+03" if departed else "\\N",
+                f"{arrival:%Y-%m-%d %H:%M:%S}.000+03" if departed else "\\N",
+            ),
+        )
+    for ticket in range(num_tickets):
+        ticket_no, book_ref = f"T{ticket:04d}", f"B{ticket:04d}"
+        flight_id = num_flights - num_tickets + ticket
+        conn.execute("INSERT INTO tickets VALUES (?, ?, ?)", (ticket_no, book_ref, f"P{ticket // 2:03d}"))
+        conn.execute("INSERT INTO ticket_flights VALUES (?, ?, ?, ?)", (ticket_no, flight_id, "Economy", 100.0))
+        conn.execute("INSERT INTO boarding_passes VALUES (?, ?, ?, ?)", (ticket_no, flight_id, 1, "1A"))
+        conn.execute("INSERT INTO bookings VALUES (?, ?, ?)", (book_ref, "2024-04-01 10:00:00.000+03", 100.0))
+    for item in range(30):
+        location = LOCATIONS[item % len(LOCATIONS)]
+        for table in ("hotels", "car_rentals"):
+            conn.execute(
+                f"INSERT INTO {table} VALUES (?, ?, ?, ?, ?, ?, 0)",
+                (item, f"{location} {table[:-1]} {item}", location, "Midscale", "2024-04-20", "2024-04-25"),
+            )
+        conn.execute(
+            "INSERT INTO trip_recommendations VALUES (?, ?, ?, ?, ?, 0)",
+            (item, f"Trip {item}", location, "museum, art" if item % 2 else "hiking, nature", "details"),
+        )
+    conn.commit()
+    conn.close()
+    return path
+
+
+@pytest.fixture
+def travel_db(tmp_path):
+    """Build a travel DB with `travel_db(name)` under `tmp_path`, closing its pool afterwards"""
+    paths = []
+
+    def make(name: str = "travel.sqlite", **kwargs) -> str:
+        path = make_travel_db(str(tmp_path / name), **kwargs)
+        paths.append(path)
+        return path
+
+    yield make
+    for path in paths:
+        close_pool(path)
+
+
+@pytest.fixture
+def base_db(travel_db):
+    """A travel DB with its indexes, and its dates shifted to the present"""
+    path = travel_db("base.sqlite")
+    conn = sqlite3.connect(path)
+    create_indexes(conn)
+    conn.close()
+    return shift_dates_in_place(path)
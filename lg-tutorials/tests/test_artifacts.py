@@ -0,0 +1,183 @@
+import hashlib
+import http.server
+import threading
+
+import pytest
+import requests
+from lg_tutorials.customer_support import artifacts
+from lg_tutorials.customer_support.artifacts import fetch_artifact
+
+URL = "https://example.com/travel.sqlite"
+
+
+class FakeResponse:
+    def __init__(
+        self, status_code: int, body: bytes = b"", headers: dict | None = None, fail_after: int | None = None
+    ):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self._body = body
+        self._fail_after = fail_after
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise RuntimeError(f"HTTP {self.status_code}")
+
+    def iter_content(self, chunk_size: int):
+        for start in range(0, len(self._body), 4):
+            if self._fail_after is not None and start >= self._fail_after:
+                raise ConnectionError("connection reset")
+            yield self._body[start : start + 4]
+
+
+class FakeServer:
+    """Serves one file, honoring `Range`, `If-Range` and `If-None-Match` like a real server"""
+
+    def __init__(self, body: bytes, etag: str = '"v1"'):
+        self.body = body
+        self.etag = etag
+        self.requests: list[dict] = []
+        # the next response breaks after this many bytes
+        self.fail_after: int | None = None
+
+    def get(self, url, headers=None, stream=False, timeout=None):
+        headers = headers or {}
+        self.requests.append(headers)
+        fail_after, self.fail_after = self.fail_after, None
+        if headers.get("If-None-Match") == self.etag:
+            return FakeResponse(304)
+        range_ = headers.get("Range")
+        if range_ and headers.get("If-Range", self.etag) == self.etag:
+            start = int(range_.removeprefix("bytes=").removesuffix("-"))
+            if start >= len(self.body):
+                return FakeResponse(416)
+            return FakeResponse(206, self.body[start:], {"ETag": self.etag}, fail_after)
+        return FakeResponse(200, self.body, {"ETag": self.etag}, fail_after)
+
+
+def _fetch(server: FakeServer, tmp_path, **kwargs) -> bytes:
+    dest = fetch_artifact(URL, tmp_path / "dest", cache_dir=tmp_path / "cache", session=server, **kwargs)
+    return dest.read_bytes()
+
+
+def test_resumes_interrupted_download(tmp_path):
+    server = FakeServer(b"0123456789" * 10)
+    server.fail_after = 40
+    with pytest.raises(ConnectionError):
+        _fetch(server, tmp_path)
+
+    assert _fetch(server, tmp_path) == server.body
+    assert server.requests[-1] == {"Range": "bytes=40-", "If-Range": '"v1"'}
+
+
+def test_resume_restarts_when_file_changed(tmp_path):
+    server = FakeServer(b"0123456789" * 10)
+    server.fail_after = 40
+    with pytest.raises(ConnectionError):
+        _fetch(server, tmp_path)
+
+    # a new version, which mustn't be stitched to the first 40 bytes of the old one
+    server.body, server.etag = b"abcdefghij" * 12, '"v2"'
+    assert _fetch(server, tmp_path) == server.body
+
+
+def test_checksum_mismatch(tmp_path):
+    server = FakeServer(b"corrupted")
+    expected = hashlib.sha256(b"the real file").hexdigest()
+    with pytest.raises(ValueError, match="Checksum mismatch"):
+        _fetch(server, tmp_path, sha256=expected)
+    assert not list((tmp_path / "cache" / "objects").iterdir())
+    assert not list((tmp_path / "cache" / "partial").iterdir())
+
+    # the next attempt starts from scratch, rather than resuming the bad download
+    server.body = b"the real file"
+    assert _fetch(server, tmp_path, sha256=expected) == b"the real file"
+    assert "Range" not in server.requests[-1]
+
+
+def test_refresh(tmp_path):
+    server = FakeServer(b"first version")
+    assert _fetch(server, tmp_path) == b"first version"
+    assert _fetch(server, tmp_path) == b"first version"
+    assert len(server.requests) == 1
+
+    # unchanged: revalidated, but not downloaded again
+    assert _fetch(server, tmp_path, refresh=True) == b"first version"
+    assert server.requests[-1] == {"If-None-Match": '"v1"'}
+
+    server.body, server.etag = b"second version", '"v2"'
+    assert _fetch(server, tmp_path) == b"first version"
+    assert _fetch(server, tmp_path, refresh=True) == b"second version"
+
+
+class RangeHandler(http.server.BaseHTTPRequestHandler):
+    """Serves `server.body`, honoring `Range`, `If-Range` and `If-None-Match`"""
+
+    def do_GET(self):
+        server = self.server
+        server.requests.append(dict(self.headers))
+        if self.headers.get("If-None-Match") == server.etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        start, status = 0, 200
+        range_ = self.headers.get("Range")
+        if range_ and self.headers.get("If-Range", server.etag) == server.etag:
+            start = int(range_.removeprefix("bytes=").removesuffix("-"))
+            if start >= len(server.body):
+                self.send_response(416)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            status = 206
+        body = server.body[start:]
+        self.send_response(status)
+        self.send_header("ETag", server.etag)
+        self.send_header("Content-Length", str(len(body)))
+        if status == 206:
+            self.send_header("Content-Range", f"bytes {start}-{len(server.body) - 1}/{len(server.body)}")
+        self.end_headers()
+        # the connection drops after `fail_after` bytes, once
+        fail_after, server.fail_after = server.fail_after, None
+        self.wfile.write(body if fail_after is None else body[:fail_after])
+        self.wfile.flush()
+        if fail_after is not None:
+            self.close_connection = True
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def http_server():
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), RangeHandler)
+    server.body, server.etag, server.fail_after, server.requests = b"0123456789" * 1000, '"v1"', None, []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_resume_over_http(http_server, tmp_path, monkeypatch):
+    # a chunk cut short by the dropped connection is lost, so what's kept is whole chunks
+    monkeypatch.setattr(artifacts, "CHUNK_SIZE", 1000)
+    url = f"http://127.0.0.1:{http_server.server_address[1]}/travel.sqlite"
+    kwargs = dict(cache_dir=tmp_path / "cache", session=requests.Session())
+    http_server.fail_after = 4000
+    with pytest.raises(requests.RequestException):
+        fetch_artifact(url, tmp_path / "dest", **kwargs)
+
+    assert fetch_artifact(url, tmp_path / "dest", **kwargs).read_bytes() == http_server.body
+    assert http_server.requests[-1]["Range"] == "bytes=4000-"
+    assert http_server.requests[-1]["If-Range"] == '"v1"'
+
+    # unchanged: a 304, so nothing is downloaded again
+    assert fetch_artifact(url, tmp_path / "dest", refresh=True, **kwargs).read_bytes() == http_server.body
+    assert http_server.requests[-1]["If-None-Match"] == '"v1"'
@@ -0,0 +1,62 @@
+import pytest
+from langchain_core.messages import AIMessage, HumanMessage, ToolMessage
+from lg_tutorials.customer_support import context_window
+from lg_tutorials.customer_support.context_window import count_tokens, fit_messages
+
+
+@pytest.fixture
+def models(monkeypatch):
+    """Count a token per word (the encodings need a download), recording the model counted for"""
+    counted = []
+
+    def num_tokens(text: str, model: str) -> int:
+        counted.append(model)
+        return len(text.split())
+
+    monkeypatch.setattr(context_window, "num_tokens", num_tokens)
+    monkeypatch.setattr(context_window, "_token_model", lambda model: model)
+    monkeypatch.setattr(context_window, "_token_counts", context_window.OrderedDict())
+    return counted
+
+
+def _words(n: int) -> str:
+    return " ".join(["word"] * n)
+
+
+def test_history_starts_with_a_human_message(models):
+    call = {"name": "search_flights", "args": {}, "id": "call-1"}
+    messages = [
+        HumanMessage(_words(50)),
+        AIMessage("", tool_calls=[call]),
+        ToolMessage(_words(5), tool_call_id="call-1"),
+        AIMessage(_words(2)),
+        HumanMessage(_words(3)),
+        AIMessage(_words(3)),
+        HumanMessage(_words(4)),
+    ]
+    # room for everything but the first human message
+    budget = sum(count_tokens(message) for message in messages) - 1
+    assert fit_messages(messages, budget) == messages[4:]
+    assert fit_messages(messages, budget + 1) == messages
+
+
+def test_counts_with_the_model_encoding(models):
+    count_tokens(HumanMessage(_words(3)), "gpt-4o-mini")
+    assert models == ["gpt-4o-mini"]
+    # cached per model
+    count_tokens(HumanMessage(_words(3)), "gpt-4o-mini")
+    count_tokens(HumanMessage(_words(3)), "gpt-3.5-turbo")
+    assert models == ["gpt-4o-mini", "gpt-3.5-turbo"]
+
+
+def test_unknown_models_are_estimated(monkeypatch):
+    def get_encoding(model: str):
+        if model != context_window.DEFAULT_MODEL:
+            raise ValueError(f"Unknown encoding {model}")
+
+    monkeypatch.setattr(context_window, "get_encoding", get_encoding)
+    context_window._token_model.cache_clear()
+    try:
+        assert context_window._token_model("llama3.2") == context_window.DEFAULT_MODEL
+    finally:
+        context_window._token_model.cache_clear()
@@ -0,0 +1,145 @@
+import sqlite3
+from datetime import datetime, timezone
+
+import pytest
+from lg_tutorials.customer_support import database, queries
+from lg_tutorials.customer_support.database import (
+    PLAN_CHECKS,
+    WRITE_TABLES,
+    SnapshotManager,
+    check_query_plans,
+    create_indexes,
+    shift_dates_in_place,
+)
+from lg_tutorials.customer_support.db_pool import close_pool, connection, write_transaction
+from lg_tutorials.customer_support.tools import flights, hotels
+from lg_tutorials.customer_support.tools.flights import (
+    cancel_ticket,
+    fetch_user_flight_information,
+    update_ticket_to_new_flight,
+)
+from lg_tutorials.customer_support.tools.hotels import book_hotel, search_hotels
+
+
+def _config(db: str, passenger_id: str = "P025") -> dict:
+    return {"configurable": {"db": db, "passenger_id": passenger_id}}
+
+
+def _hotel_booked(db: str, hotel_id: int, full_text: bool = False) -> int:
+    arguments = {"location": "Basel", "full_text": full_text, "limit": 50}
+    page = search_hotels.invoke(arguments, config=_config(db))
+    return next(hotel["booked"] for hotel in page["results"] if hotel["id"] == hotel_id)
+
+
+def _flights(db: str) -> dict[str, int]:
+    with connection(db) as conn:
+        query = "SELECT ticket_no, flight_id FROM ticket_flights WHERE ticket_no IN ('T0050', 'T0051')"
+        return dict(conn.execute(query))
+
+
+def test_snapshots_are_isolated(base_db, tmp_path):
+    manager = SnapshotManager(base_db, directory=str(tmp_path))
+    with manager.session("a") as first, manager.session("b") as second:
+        # cached by `search_hotels`, until the booking bumps the version of `hotels`
+        assert _hotel_booked(first, 3) == 0
+        assert book_hotel.invoke({"hotel_id": 3}, config=_config(first)) == "Hotel 3 successfully booked."
+        assert update_ticket_to_new_flight.invoke(
+            {"ticket_no": "T0050", "new_flight_id": 195}, config=_config(first)
+        ) == "Ticket successfully updated to new flight."
+        cancelled = cancel_ticket.invoke({"ticket_no": "T0051"}, config=_config(first))
+        assert cancelled == "Ticket successfully cancelled."
+
+        assert _hotel_booked(first, 3) == 1
+        assert _hotel_booked(first, 3, full_text=True) == 1
+        assert _flights(first) == {"T0050": 195}
+        # the boarding pass is still for the old flight
+        assert fetch_user_flight_information.invoke({}, config=_config(first)) == []
+        for db in (second, base_db):
+            assert _hotel_booked(db, 3) == 0
+            assert _flights(db) == {"T0050": 190, "T0051": 191}
+            assert len(fetch_user_flight_information.invoke({}, config=_config(db))) == 2
+
+        # only the changed rows are stored in the snapshot
+        with connection(first) as conn:
+            stored = {
+                table: conn.execute(f"SELECT count(*) FROM main.{table}_delta").fetchone()[0]
+                for table in WRITE_TABLES
+            }
+        assert stored == {"ticket_flights": 3, "hotels": 1, "car_rentals": 0, "trip_recommendations": 0}
+
+
+def test_snapshot_writes_dont_lock_each_other(base_db, tmp_path):
+    manager = SnapshotManager(base_db, directory=str(tmp_path))
+    with manager.session("a") as first, manager.session("b") as second:
+        with write_transaction(first):
+            # the base DB, attached to both snapshots, isn't locked by the first one
+            cancelled = cancel_ticket.invoke({"ticket_no": "T0051"}, config=_config(second))
+            assert cancelled == "Ticket successfully cancelled."
+            with write_transaction(base_db):
+                pass
+        assert _flights(first) == {"T0050": 190, "T0051": 191}
+        assert _flights(second) == {"T0050": 190}
+
+
+def test_query_plans_use_indexes(base_db):
+    with connection(base_db) as conn:
+        check_query_plans(conn)
+
+    # without the index on passenger ids, finding the user's tickets reads all of them
+    with connection(base_db) as conn:
+        conn.execute("DROP INDEX idx_tickets_passenger_id_ticket_no_book_ref")
+    with pytest.raises(RuntimeError, match="fetch_user_flight_information"):
+        shift_dates_in_place(base_db)
+
+
+def test_query_plans_cover_the_tools_statements():
+    statements = set(PLAN_CHECKS.values())
+    assert flights.USER_FLIGHTS_QUERY in statements
+    assert flights.VALIDATE_CHANGE in statements
+    assert hotels.BOOK_HOTEL in statements
+
+
+@pytest.mark.parametrize("unixepoch", [True, False], ids=["unixepoch", "strftime"])
+def test_epoch_columns(travel_db, monkeypatch, unixepoch):
+    if not unixepoch:
+        # as on SQLite < 3.38
+        monkeypatch.setattr(queries, "UNIXEPOCH_VERSION", (99, 0, 0))
+    path = travel_db()
+    conn = sqlite3.connect(path)
+    conn.execute("UPDATE flights SET scheduled_departure = '2024-05-01 10:00:00.123456+03:00' WHERE flight_id = 1")
+    conn.execute("UPDATE flights SET scheduled_departure = '\\N' WHERE flight_id = 2")
+    create_indexes(conn)
+
+    rows = conn.execute(
+        "SELECT scheduled_departure, scheduled_departure_epoch FROM flights WHERE flight_id < 3 ORDER BY flight_id"
+    ).fetchall()
+    conn.close()
+    assert rows[0][1] == int(datetime.fromisoformat("2024-04-01 00:00:00+03:00").timestamp())
+    assert rows[1][1] == int(datetime.fromisoformat("2024-05-01 10:00:00+03:00").timestamp())
+    assert rows[2][1] is None
+
+
+def test_update_modes_agree(travel_db, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    travel_db(database.BACKUP_FILE)
+    copied = database.update_dates(str(tmp_path / "copied.sqlite"))
+    shifted = database.update_dates(str(tmp_path / "shifted.sqlite"), in_place=True)
+
+    def latest(db: str) -> tuple[str, str]:
+        with connection(db) as conn:
+            return conn.execute("SELECT max(scheduled_departure), max(book_date) FROM flights, bookings").fetchone()
+
+    try:
+        for copied_time, shifted_time in zip(latest(copied), latest(shifted)):
+            # same text format, and the same dates (give or take the time between both calls)
+            assert copied_time[19:] == shifted_time[19:] == ".000+03"
+            difference = datetime.fromisoformat(copied_time) - datetime.fromisoformat(shifted_time)
+            assert abs(difference.total_seconds()) <= 2
+        # the most recent departure is now
+        with connection(shifted) as conn:
+            query = "SELECT max(actual_departure) FROM flights WHERE actual_departure != '\\N'"
+            (departure,) = conn.execute(query).fetchone()
+        assert abs((datetime.now(timezone.utc) - datetime.fromisoformat(departure)).total_seconds()) <= 2
+    finally:
+        close_pool(copied)
+        close_pool(shifted)
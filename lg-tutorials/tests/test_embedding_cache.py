@@ -0,0 +1,21 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from lg_tutorials.customer_support.db_pool import close_pool
+from lg_tutorials.customer_support.embedding_cache import EmbeddingCache
+
+
+def test_stats_under_concurrency(tmp_path):
+    path = str(tmp_path / "embeddings.sqlite")
+    cache = EmbeddingCache(path, max_memory_entries=10)
+    try:
+        for i in range(20):
+            cache.put(f"query {i}", "model", [float(i)] * 4)
+        # the first 10 are only on disk, the last 10 also in memory, and the rest missing
+        texts = [f"query {i}" for i in range(30)] * 20
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            list(executor.map(lambda text: cache.get(text, "model"), texts))
+        stats = cache.stats
+        assert stats.memory_hits + stats.disk_hits + stats.misses == len(texts)
+        assert stats.misses == 10 * 20
+    finally:
+        close_pool(path)
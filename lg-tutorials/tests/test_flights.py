@@ -0,0 +1,33 @@
+import time
+
+from lg_tutorials.customer_support.db_pool import connection
+from lg_tutorials.customer_support.tools.flights import search_itineraries, update_ticket_to_new_flight
+
+
+def _change(db: str, new_flight_id: int) -> str:
+    config = {"configurable": {"db": db, "passenger_id": "P025"}}
+    return update_ticket_to_new_flight.invoke({"ticket_no": "T0050", "new_flight_id": new_flight_id}, config=config)
+
+
+def test_update_ticket_to_new_flight(base_db):
+    assert _change(base_db, 10_000) == "Invalid new flight ID provided."
+    assert _change(base_db, 0).startswith("Not permitted to reschedule")
+    assert _change(base_db, 195) == "Ticket successfully updated to new flight."
+
+
+def test_update_ticket_to_flight_without_departure_time(base_db):
+    with connection(base_db) as conn:
+        conn.execute("UPDATE flights SET scheduled_departure = '\\N' WHERE flight_id = 195")
+    assert _change(base_db, 195) == "Invalid new flight ID provided."
+
+
+def test_search_itineraries_from_now(base_db, monkeypatch):
+    config = {"configurable": {"db": base_db, "passenger_id": "P025"}}
+    arguments = {"departure_airport": "BSL", "arrival_airport": "ZRH"}
+    itineraries = search_itineraries.invoke(arguments, config=config)
+    assert [itinerary["legs"][0]["flight_id"] for itinerary in itineraries] == [152]
+
+    # 20 hours later, that flight is gone, and the next one is more than a day away
+    now = time.time()
+    monkeypatch.setattr(time, "time", lambda: now + 20 * 3600)
+    assert search_itineraries.invoke(arguments, config=config) == []
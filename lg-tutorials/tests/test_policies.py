@@ -0,0 +1,76 @@
+from pathlib import Path
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+from lg_tutorials.customer_support.db_pool import close_pool
+from lg_tutorials.customer_support.embedding_cache import EmbeddingCache
+from lg_tutorials.customer_support.tools.policies import VectorStoreRetriever
+
+FAQ = Path(__file__).parents[1] / "notebooks" / "swiss_faq.md"
+
+# (query, index of the FAQ section that answers it)
+KEYWORD_QUERIES = [
+    ("Do I need to reconfirm my flight?", 0),
+    ("Can a name be changed after a booking is made?", 1),
+    ("Will my special meal be included in the rebooking?", 1),
+    ("booking for more than nine passengers", 2),
+    ("Invoices for Greece, India, Italy or Spain", 3),
+    ("American Express security number", 4),
+    ("3-D Secure authentication", 5),
+    ("POWERPAY reminder fee", 6),
+    ("currency conversion option exchange rate", 7),
+    ("HON Circle Senator fare", 8),
+]
+# the words of the answer aren't those of the question, so BM25 alone can't be trusted
+PARAPHRASES = [
+    "can my wife take my place on the plane",
+    "is my card data safe with you",
+    "I need a receipt for my employer's expense report",
+    "can I take an earlier plane the same day",
+    "can I buy now and settle the bill later",
+]
+
+
+class FakeEmbeddings:
+    """Random (but fixed per text) embeddings, recording the texts embedded"""
+
+    def __init__(self):
+        self.embedded: list[str] = []
+
+    def create(self, model: str, input: list[str]):
+        self.embedded.extend(input)
+        vectors = [np.random.default_rng(abs(hash(text))).normal(size=8) for text in input]
+        return SimpleNamespace(data=[SimpleNamespace(embedding=vector.tolist()) for vector in vectors])
+
+
+@pytest.fixture
+def retriever(tmp_path):
+    class Retriever(VectorStoreRetriever):
+        md_file = FAQ
+        vectors_file = tmp_path / "vectors"
+
+    client = SimpleNamespace(embeddings=FakeEmbeddings())
+    cache = str(tmp_path / "embeddings.sqlite")
+    yield Retriever(client, embedding_cache=EmbeddingCache(cache))
+    close_pool(cache)
+
+
+def test_lexical_fast_path(retriever):
+    for query, section in KEYWORD_QUERIES:
+        results = retriever.lexical_query(query, k=2, confident_only=True)
+        assert results is not None, query
+        assert results[0]["page_content"] == retriever._docs[section]["page_content"], query
+
+
+def test_paraphrases_use_hybrid_path(retriever):
+    for query in PARAPHRASES:
+        assert retriever.lexical_query(query, k=2, confident_only=True) is None, query
+
+    embeddings = retriever._client.embeddings
+    embeddings.embedded.clear()
+    queries = [KEYWORD_QUERIES[0][0], *PARAPHRASES]
+    results = retriever.hybrid_query_batch(queries, k=2)
+    assert [len(result) for result in results] == [2] * len(queries)
+    # only the paraphrases were embedded
+    assert embeddings.embedded == PARAPHRASES
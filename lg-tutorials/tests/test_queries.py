@@ -0,0 +1,47 @@
+import sqlite3
+
+from lg_tutorials.customer_support.database import create_indexes
+from lg_tutorials.customer_support.queries import has_fts, table_columns
+from lg_tutorials.customer_support.tools.hotels import search_hotels
+
+
+def _index(path: str):
+    conn = sqlite3.connect(path)
+    create_indexes(conn)
+    conn.close()
+
+
+def test_has_fts_per_database(travel_db):
+    indexed, plain = travel_db("indexed.sqlite"), travel_db("plain.sqlite")
+    _index(indexed)
+
+    # whichever DB is asked first, the other one gets its own answer
+    for first, second in ((indexed, plain), (plain, indexed)):
+        with sqlite3.connect(first) as conn_first, sqlite3.connect(second) as conn_second:
+            assert has_fts(conn_first, "hotels") == (first == indexed)
+            assert has_fts(conn_second, "hotels") == (second == indexed)
+
+
+def test_table_columns_per_database(travel_db):
+    first, second = travel_db("first.sqlite"), travel_db("second.sqlite")
+    with sqlite3.connect(second) as conn:
+        conn.execute("ALTER TABLE hotels ADD COLUMN stars INTEGER")
+
+    with sqlite3.connect(first) as conn:
+        assert "stars" not in table_columns(conn, "hotels")
+    with sqlite3.connect(second) as conn:
+        assert "stars" in table_columns(conn, "hotels")
+
+
+def test_full_text_search_falls_back_without_index(travel_db):
+    indexed, plain = travel_db("indexed.sqlite"), travel_db("plain.sqlite")
+    _index(indexed)
+
+    results = {}
+    for db in (indexed, plain, indexed):
+        page = search_hotels.invoke(
+            {"location": "Basel", "full_text": True}, config={"configurable": {"db": db}}
+        )
+        results.setdefault(db, set()).update(hotel["id"] for hotel in page["results"])
+    assert results[indexed] == results[plain]
+    assert results[plain] == {item for item in range(30) if item % 3 == 0}
@@ -0,0 +1,36 @@
+import json
+import threading
+import time
+
+import numpy as np
+from lg_tutorials.customer_support.vector_store import VectorStore
+
+
+def test_concurrent_syncs(tmp_path):
+    texts = ["a", "b", "c"]
+    embedded = []
+
+    def embed(batch: list[str]) -> np.ndarray:
+        embedded.extend(batch)
+        time.sleep(0.05)  # so the other sync starts meanwhile
+        return np.random.default_rng(len(embedded)).normal(size=(len(batch), 4))
+
+    stores = [VectorStore(tmp_path / "vectors") for _ in range(2)]
+    threads = [threading.Thread(target=store.sync, args=(texts, "model", embed)) for store in stores]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # the second one found the store built by the first
+    assert embedded == texts
+    manifest = json.loads((tmp_path / "vectors.json").read_text())
+    assert [path.name for path in tmp_path.glob("vectors.*.npy")] == [f"vectors.{manifest['build']}.npy"]
+    for store in stores:
+        assert store.manifest == manifest
+
+    # a new build replaces the old one
+    stores[0].sync(texts + ["d"], "model", embed)
+    assert embedded == texts + ["d"]
+    assert len(list(tmp_path.glob("vectors.*.npy"))) == 1
+    assert stores[0].vectors().shape == (4, 4)